@@ -3,11 +3,16 @@ import argparse
 from pprint import pprint
 
 from helixerprep.export.exporter import HelixerExportController
+from helixerprep.core.helpers import X_ENCODINGS, LABEL_ENCODINGS
+from helixerprep.export.writer import COMPRESSIONS
 
 
 def main(args):
-    controller = HelixerExportController(args.db_path_in, args.out_dir, args.only_test_set)
+    controller = HelixerExportController(args.db_path_in, args.out_dir, args.only_test_set,
+                                         append=args.resume or args.append_genomes != '')
 
+    if args.append_genomes != '':
+        args.genomes = args.append_genomes
     if args.genomes != '':
         args.genomes = args.genomes.split(',')
     if args.exclude_genomes != '':
@@ -15,7 +20,13 @@ def main(args):
 
     controller.export(chunk_size=args.chunk_size, genomes=args.genomes, exclude=args.exclude_genomes,
                       val_size=args.val_size, one_hot=args.one_hot,
-                      split_coordinates=args.split_coordinates, keep_errors=args.keep_errors)
+                      split_coordinates=args.split_coordinates, keep_errors=args.keep_errors,
+                      max_chunks=args.max_chunks_in_memory, workers=args.workers, seed=args.seed,
+                      x_encoding=args.x_encoding, label_encoding=args.label_encoding,
+                      write_buffer_mb=args.write_buffer_mb, rows_per_chunk=args.h5_rows_per_chunk,
+                      compression=args.h5_compression, compression_level=args.h5_compression_level,
+                      cache_dir=args.cache_dir, cache_size_mb=args.cache_size_mb,
+                      contiguous=args.contiguous, stats=args.stats)
 
 
 if __name__ == '__main__':
@@ -24,6 +35,14 @@ if __name__ == '__main__':
     io.add_argument('--db-path-in', type=str, required=True,
                     help='Path to the Helixer SQLite input database.')
     io.add_argument('--out-dir', type=str, required=True, help='Output dir for encoded data files.')
+    io.add_argument('--resume', action='store_true',
+                    help=('Continue an interrupted export into the files in --out-dir. Coordinates '
+                          'that were completely written are skipped. Has to be run with the same '
+                          'arguments as the interrupted export.'))
+    io.add_argument('--append-genomes', type=str, default='',
+                    help=('Comma seperated list of species names to be added to the existing files '
+                          'in --out-dir. Has to be run with the same data generation parameters as '
+                          'the existing files. Can not be combined with --genomes or --exclude-genomes.'))
 
     genomes = parser.add_argument_group("Genome selection")
     genomes.add_argument('--genomes', type=str, default='',
@@ -48,9 +67,62 @@ if __name__ == '__main__':
                       help='Whether to only output a single file named test_data.h5')
     data.add_argument('--keep_errors', action="store_true",
                       help="Set this flag if entirely erroneous sequences should _not_ be excluded")
+    data.add_argument('--x-encoding', type=str, default='float16', choices=X_ENCODINGS,
+                      help=('How /data/X is stored. base_codes stores one uint8 code per base instead '
+                            'of 4 float16 values, which is expanded again when the data is read.'))
+    data.add_argument('--label-encoding', type=str, default='int8', choices=LABEL_ENCODINGS,
+                      help=('How /data/y and /data/sample_weights are stored. compact stores one uint8 '
+                            'class index per base and bit-packs the sample weights. Needs --one-hot.'))
+    data.add_argument('--seed', type=int, default=None,
+                      help=('Seed for the train/validation split. With a seed the output is the same '
+                            'for every run, regardless of the number of workers.'))
+
+    layout = parser.add_argument_group("HDF5 layout")
+    layout.add_argument('--contiguous', action='store_true',
+                        help=('Store each coordinate strand as one contiguous array instead of chunks. '
+                              'The chunks are then cut at read time with the chunk size of the reader, '
+                              'so the data does not need to be exported again for a different chunk '
+                              'size. --chunk-size is then only the amount of bases numerified at once. '
+                              'Needs --split-coordinates or --only-test-set.'))
+    layout.add_argument('--h5-rows-per-chunk', type=int, default=1,
+                        help=('How many samples of X, y and sample_weights are stored together in one '
+                              'HDF5 chunk. Larger chunks mean fewer chunks are read and decompressed per '
+                              'batch, but more unneeded data is read when batches are shuffled.'))
+    layout.add_argument('--h5-compression', type=str, default='lzf', choices=COMPRESSIONS,
+                        help='Compression codec. blosc and zstd need the hdf5plugin package.')
+    layout.add_argument('--h5-compression-level', type=int, default=None,
+                        help='Compression level for gzip, blosc and zstd, the codec default if not set.')
+
+    resources = parser.add_argument_group("Resource usage")
+    resources.add_argument('--max-chunks-in-memory', type=int, default=0,
+                           help=('Numerify and save coordinates in groups of at most this many chunks, '
+                                 'so the memory usage does not depend on the longest coordinate. '
+                                 'The default of 0 numerifies each coordinate as a whole.'))
+    resources.add_argument('--workers', type=int, default=1,
+                           help=('Number of processes numerifying coordinates in parallel. '
+                                 'Everything is still written by the main process in the original '
+                                 'order of the coordinates. With --max-chunks-in-memory the '
+                                 'coordinates are handed to the workers in parts of that many chunks, '
+                                 'so the memory usage stays bounded as well.'))
+    resources.add_argument('--write-buffer-mb', type=float, default=256,
+                           help=('Encoded chunks of many coordinates are buffered up to this size and '
+                                 'then written to the h5 files in one block.'))
+    resources.add_argument('--cache-dir', type=str, default=None,
+                           help=('Directory of a cache of the encoded chunks of each coordinate. '
+                                 'Coordinates with the same sequence, features and data generation '
+                                 'parameters are copied from the cache instead of being numerified '
+                                 'again. No cache is used if not set.'))
+    resources.add_argument('--cache-size-mb', type=float, default=10000,
+                           help='The least recently used cache entries are removed beyond this size.')
+    resources.add_argument('--stats', action='store_true',
+                           help=('Measure the time spent in each export stage and the throughput per '
+                                 'genome, which is printed at the end and saved to '
+                                 'export_stats.json in --out-dir.'))
 
     args = parser.parse_args()
     assert not (args.genomes and args.exclude_genomes), 'Can not include and exclude together'
+    assert not (args.append_genomes and (args.genomes or args.exclude_genomes)), \
+        'Can not append and select genomes together'
     assert not args.split_coordinates and args.only_test_set, 'Can not split and not split'
     pprint(vars(args))
     print()
@@ -0,0 +1,165 @@
+"""reading files exported with --contiguous as if they were exported in chunks of any size"""
+import h5py
+import numpy as np
+
+from .helpers import Stepper, data_layout, label_encoding
+
+
+def open_data_file(path, chunk_size=None, keep_errors=False):
+    """Opens an exported h5 file for reading. Files exported with --contiguous are wrapped in
+    a VirtualChunkFile with chunks of chunk_size, chunked files are returned as they are."""
+    h5_file = h5py.File(path, 'r')
+    if data_layout(h5_file) == 'contiguous':
+        if not chunk_size:
+            h5_file.close()
+            raise ValueError('{} was exported contiguously and needs a chunk size'.format(path))
+        return VirtualChunkFile(h5_file, chunk_size, keep_errors=keep_errors)
+    return h5_file
+
+
+def _range_counts(ranges, positions):
+    """For sorted, non overlapping [start, end) ranges returns how many positions before each
+    of positions are covered by a range"""
+    if not len(ranges):
+        return np.zeros(len(positions), dtype=np.int64)
+    covered = np.concatenate([[0], np.cumsum(ranges[:, 1] - ranges[:, 0])])
+    idx = np.searchsorted(ranges[:, 0], positions, side='right')
+    # the part of the last range that started before the position but ends after it
+    overhang = np.where(idx > 0, np.maximum(ranges[np.maximum(idx - 1, 0), 1] - positions, 0), 0)
+    return covered[idx] - overhang
+
+
+class VirtualChunkDataset(object):
+    """Read only view of a per base dataset of /bases, that is indexed like the /data dataset
+    of a chunked export with the same chunk size. Each chunk is sliced from the bases when it
+    is read and zero padded to the chunk size."""
+    def __init__(self, bases, row_starts, row_lengths, chunk_size, pack_bits=False):
+        self.bases = bases
+        self.row_starts = row_starts
+        self.row_lengths = row_lengths
+        self.chunk_size = chunk_size
+        # bit-pack the chunks like the sample weights of compact chunked exports
+        self.pack_bits = pack_bits
+        if pack_bits:
+            self.shape = (len(row_starts), (chunk_size + 7) // 8)
+            self.dtype = np.dtype(np.uint8)
+        else:
+            self.shape = (len(row_starts), chunk_size) + bases.shape[1:]
+            self.dtype = bases.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        rest = ()
+        if isinstance(idx, tuple):
+            idx, rest = idx[0], idx[1:]
+        if isinstance(idx, slice):
+            rows = np.arange(*idx.indices(len(self)))
+        else:
+            rows = np.asarray(idx)
+        single = rows.ndim == 0
+        rows = np.atleast_1d(rows)
+        out = np.zeros((len(rows), self.chunk_size) + self.bases.shape[1:], dtype=self.bases.dtype)
+        for i, row in enumerate(rows):
+            start, length = self.row_starts[row], self.row_lengths[row]
+            out[i, :length] = self.bases[start:start + length]
+        if self.pack_bits:
+            out = np.packbits(out.astype(bool), axis=-1)
+        if single:
+            out = out[0]
+        elif rest:
+            # the rows are the first axis of out
+            rest = (slice(None),) + rest
+        return out[rest] if rest else out
+
+
+class VirtualChunkFile(object):
+    """Mimics the h5 file of a chunked export for a file exported with --contiguous, so it can
+    be used by HelixerSequence and the helpers. The strands are cut with the same Stepper
+    semantics as during a chunked export, so the chunks are exactly what a chunked export
+    with chunk_size (and the same keep_errors) would have stored. The per base datasets are
+    only read when a chunk is indexed, the per chunk metadata is computed once from /strands
+    and /ranges."""
+    def __init__(self, h5_file, chunk_size, keep_errors=False):
+        assert isinstance(chunk_size, int) and chunk_size > 0
+        self.h5_file = h5_file
+        self.chunk_size = chunk_size
+        self.keep_errors = keep_errors
+        self.attrs = dict(h5_file.attrs)
+        self.attrs['chunk_size'] = str(chunk_size)
+        self.attrs['keep_errors'] = str(keep_errors)
+        self.filename = h5_file.filename
+
+        strands = {key: np.array(h5_file['/strands/' + key]) for key in h5_file['strands'].keys()}
+        row_strands, row_starts, row_lengths, start_ends = [], [], [], []
+        for i, (offset, length, is_plus_strand) in enumerate(zip(strands['offsets'],
+                                                                 strands['lengths'],
+                                                                 strands['is_plus_strand'])):
+            steps = np.array(list(Stepper(end=int(length), by=chunk_size).step_to_end()),
+                             dtype=np.int64).reshape((-1, 2))
+            if is_plus_strand:
+                starts = offset + steps[:, 0]
+                strand_start_ends = steps
+            else:
+                # the minus strand is stored reversed, so its chunks are the reversed steps
+                steps = steps[::-1]
+                starts = offset + length - steps[:, 1]
+                strand_start_ends = steps[:, ::-1]
+            row_strands.append(np.full(len(steps), i, dtype=np.int64))
+            row_starts.append(starts)
+            row_lengths.append(steps[:, 1] - steps[:, 0])
+            start_ends.append(strand_start_ends)
+        row_strands = np.concatenate(row_strands) if row_strands else np.zeros(0, dtype=np.int64)
+        row_starts = np.concatenate(row_starts) if row_starts else np.zeros(0, dtype=np.int64)
+        row_lengths = np.concatenate(row_lengths) if row_lengths else np.zeros(0, dtype=np.int64)
+        start_ends = (np.concatenate(start_ends) if start_ends
+                      else np.zeros((0, 2), dtype=np.int64))
+
+        row_ends = row_starts + row_lengths
+        n_error_bases = (_range_counts(h5_file['/ranges/error'][:], row_ends)
+                         - _range_counts(h5_file['/ranges/error'][:], row_starts))
+        n_genic_bases = (_range_counts(h5_file['/ranges/genic'][:], row_ends)
+                         - _range_counts(h5_file['/ranges/genic'][:], row_starts))
+        is_padded = row_lengths < chunk_size
+        if not keep_errors:
+            keep = n_error_bases < row_lengths
+            row_strands, row_starts, row_lengths = row_strands[keep], row_starts[keep], row_lengths[keep]
+            start_ends, n_error_bases = start_ends[keep], n_error_bases[keep]
+            n_genic_bases, is_padded = n_genic_bases[keep], is_padded[keep]
+
+        # the same as for the zero padded chunks, where the padding is masked and for one-hot
+        # labels not intergenic
+        one_hot = self.attrs.get('one_hot') == 'True'
+        fully_intergenic = n_genic_bases == 0
+        if one_hot:
+            fully_intergenic &= ~is_padded
+        self.datasets = {
+            'err_samples': (n_error_bases > 0) | is_padded,
+            'fully_intergenic_samples': fully_intergenic,
+            'gc_contents': strands['gc_contents'][row_strands],
+            'coord_lengths': strands['coord_lengths'][row_strands],
+            'species': strands['species'][row_strands],
+            'seqids': strands['seqids'][row_strands],
+            'start_ends': start_ends,
+            'row_lengths': row_lengths.astype(np.int32),
+        }
+        for key in ['X', 'y', 'sample_weights']:
+            pack_bits = key == 'sample_weights' and label_encoding(h5_file) == 'compact'
+            self.datasets[key] = VirtualChunkDataset(h5_file['/bases/' + key], row_starts,
+                                                     row_lengths, chunk_size, pack_bits=pack_bits)
+
+    def __contains__(self, path):
+        path = path.strip('/')
+        return path.startswith('data/') and path[5:] in self.datasets
+
+    def __getitem__(self, path):
+        path = path.strip('/')
+        if path == 'data':
+            return self.datasets
+        if not path.startswith('data/') or path[5:] not in self.datasets:
+            raise KeyError(path)
+        return self.datasets[path[5:]]
+
+    def close(self):
+        self.h5_file.close()
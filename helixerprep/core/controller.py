@@ -1,5 +1,9 @@
 import os
 import csv
+import time
+import numpy as np
+import multiprocessing
+from itertools import islice
 from shutil import copyfile
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
@@ -8,6 +12,7 @@ import geenuff
 from geenuff.base.helpers import full_db_path, reverse_complement
 from geenuff.base.orm import Coordinate, Genome
 from helixerprep.core.orm import Mer, MetaInformation
+from helixerprep.core.kmers import init_kmer_worker, count_coord_mers
 
 
 class HelixerController(object):
@@ -36,56 +41,119 @@ class HelixerController(object):
                 geenuff.orm.Base.metadata.tables[table].create(self.engine)
         self.session = sessionmaker(bind=self.engine)()
 
-    def _add_mers_of_seqid(self, species, seqid, mers):
-        print(species, seqid)
-        genome_id = self.session.query(Genome.id).filter(Genome.species == species).one()[0]
-        coord_id = (self.session.query(Coordinate.id)
-                       .filter(Coordinate.genome_id == genome_id)
-                       .filter(Coordinate.seqid == seqid)
-                       .one())[0]
-        for mer_sequence, count in mers.items():
-            mer = Mer(coordinate_id=coord_id,
-                      mer_sequence=mer_sequence,
-                      count=count,
-                      length=len(mer_sequence))
-            self.session.add(mer)
-        self.session.commit()
+    @staticmethod
+    def _collapse_mers(seqids, mers, counts):
+        """Sums up the counts of each kmer and its reverse complement per seqid. The reverse
+        complement is only computed once for each distinct kmer of the block. Returns the
+        seqids, the canonical (lexicographically smaller) kmers and their summed counts."""
+        unique_mers, mer_idx = np.unique(mers, return_inverse=True)
+        rcs = np.array([''.join(reverse_complement(mer)) for mer in unique_mers], dtype=unique_mers.dtype)
+        canonical = np.where(rcs < unique_mers, rcs, unique_mers)
+        unique_canonical, canonical_idx = np.unique(canonical, return_inverse=True)
+        unique_seqids, seqid_idx = np.unique(seqids, return_inverse=True)
+        keys = seqid_idx.astype(np.int64) * len(unique_canonical) + canonical_idx[mer_idx]
+        unique_keys, key_idx = np.unique(keys, return_inverse=True)
+        summed = np.zeros(len(unique_keys), dtype=np.int64)
+        np.add.at(summed, key_idx, counts)
+        return (unique_seqids[unique_keys // len(unique_canonical)],
+                unique_canonical[unique_keys % len(unique_canonical)], summed)
+
+    def _insert_mers(self, coord_ids, seqids, mers, counts):
+        """Inserts the collapsed kmers with one executemany in one transaction"""
+        unknown = set(seqids) - set(coord_ids)
+        if unknown:
+            raise ValueError('kmers of unknown seqids found: {}'.format(sorted(unknown)[:10]))
+        rows = [{'coordinate_id': coord_ids[seqid], 'mer_sequence': mer, 'count': int(count),
+                 'length': len(mer)} for seqid, mer, count in zip(seqids, mers, counts)]
+        return self._insert_mer_rows(rows)
+
+    def _insert_mer_rows(self, rows):
+        with self.engine.begin() as connection:
+            connection.execute(Mer.__table__.insert(), rows)
+        return len(rows)
 
-    def add_mer_counts_to_db(self):
+    def _add_mers_of_genome(self, genome, kmer_file, block_size):
+        """Adds the kmers of one genome from kmer_file, which is read in blocks of block_size lines.
+        The rows of the seqid at the end of a block are carried over to the next one, as its
+        kmers can continue there. Returns the amount of lines read and of kmers inserted."""
+        coord_ids = dict(self.session.query(Coordinate.seqid, Coordinate.id)
+                             .filter(Coordinate.genome_id == genome.id)
+                             .all())
+        n_lines, n_inserted = 0, 0
+        carry = []
+        with open(kmer_file) as f:
+            next(f, None)  # skip header
+            while True:
+                block = list(islice(f, block_size))
+                lines = carry + block
+                if not lines:
+                    break
+                n_lines += len(block)
+                rows = np.array([line.rstrip('\n').split('\t')[:3] for line in lines])
+                seqids, mers, counts = rows[:, 0], rows[:, 1], rows[:, 2].astype(np.int64)
+                carry = []
+                if block:
+                    # the kmers are ordered by coordinate, so only the last seqid can continue
+                    other_seqids = np.flatnonzero(seqids != seqids[-1])
+                    split = other_seqids[-1] + 1 if len(other_seqids) else 0
+                    carry = lines[split:]
+                    seqids, mers, counts = seqids[:split], mers[:split], counts[:split]
+                if len(seqids):
+                    n_inserted += self._insert_mers(coord_ids,
+                                                    *self._collapse_mers(seqids, mers, counts))
+        return n_lines, n_inserted
+
+    def add_mer_counts_to_db(self, block_size=10 ** 6):
         """Tries to add all kmer counts it can find for each coordinate in the db
         Assumes the kmer file to contain non-collapsed kmers ordered by coordinate first and kmer
-        sequence second"""
+        sequence second. Each file is parsed in blocks of block_size lines, each of which is
+        collapsed and inserted at once."""
         genomes_in_db = self.session.query(Genome).all()
-        for i, genome in enumerate(genomes_in_db):
-            kmer_file = os.path.join(self.meta_info_root_path, genomes_in_db[i].species,
+        for genome in genomes_in_db:
+            kmer_file = os.path.join(self.meta_info_root_path, genome.species,
                                      'meta_collection', 'kmers', 'kmers.tsv')
             if os.path.exists(kmer_file):
-                last_seqid = ''
-                seqid_mers = {}  # here we collect the sum of the
-                for i, line in enumerate(open(kmer_file)):
-                    # loop setup
-                    if i == 0:
-                        continue  # skip header
-                    seqid, mer_sequence, count, _ = line.strip().split('\t')
-                    count = int(count)
-                    if i == 1:
-                        last_seqid = seqid
-
-                    # insert coordinate mers
-                    if last_seqid != seqid:
-                        self._add_mers_of_seqid(genome.species, last_seqid, seqid_mers)
-                        seqid_mers = {}
-                        last_seqid = seqid
+                start = time.time()
+                n_lines, n_inserted = self._add_mers_of_genome(genome, kmer_file, block_size)
+                duration = time.time() - start
+                print('Kmers from file {} added: {} lines collapsed into {} kmers in {:.1f}s '
+                      '({:.0f} lines/s)\n'.format(kmer_file, n_lines, n_inserted, duration,
+                                                   n_lines / max(duration, 1e-9)))
 
-                    # figure out kmer collapse
-                    rc = ''.join(reverse_complement(mer_sequence))
-                    key = rc if rc < mer_sequence else mer_sequence
-                    if key in seqid_mers:
-                        seqid_mers[key] += count
-                    else:
-                        seqid_mers[key] = count
-                self._add_mers_of_seqid(genome.species, last_seqid, seqid_mers)
-                print('Kmers from file {} added\n'.format(kmer_file))
+    def count_mers_in_db(self, max_k=6, workers=1, max_rows=10 ** 6):
+        """Counts the canonical kmers of length 1 to max_k of each coordinate directly from the
+        sequences in the db, for all genomes that have no kmer counts yet (e.g. from kmers.tsv).
+        The coordinates are counted by a pool of worker processes, which load the sequences
+        themselves, and the counts are inserted in blocks of up to max_rows."""
+        for genome in self.session.query(Genome).all():
+            has_mers = (self.session.query(Mer.id)
+                            .join(Coordinate, Mer.coordinate_id == Coordinate.id)
+                            .filter(Coordinate.genome_id == genome.id)
+                            .first())
+            if has_mers is not None:
+                print('Kmers of {} already in the db, not counting them'.format(genome.species))
+                continue
+            coords = (self.session.query(Coordinate.id, Coordinate.length)
+                          .filter(Coordinate.genome_id == genome.id)
+                          .all())
+            # the longest first, so the pool is not waiting on one long coordinate at the end
+            tasks = [(coord_id, max_k) for coord_id, _ in sorted(coords, key=lambda c: -c[1])]
+            start = time.time()
+            rows, n_inserted = [], 0
+            with multiprocessing.Pool(workers, initializer=init_kmer_worker,
+                                      initargs=(self.db_path,)) as pool:
+                for coord_id, mer_counts in pool.imap_unordered(count_coord_mers, tasks):
+                    rows += [{'coordinate_id': coord_id, 'mer_sequence': mer, 'count': count,
+                              'length': len(mer)} for mer, count in mer_counts.items()]
+                    if len(rows) >= max_rows:
+                        n_inserted += self._insert_mer_rows(rows)
+                        rows = []
+            if rows:
+                n_inserted += self._insert_mer_rows(rows)
+            duration = time.time() - start
+            n_bases = sum([length for _, length in coords])
+            print('Kmers of {} counted: {} kmers of {} coordinates in {:.1f}s ({:.0f} bp/s)'.format(
+                genome.species, n_inserted, len(coords), duration, n_bases / max(duration, 1e-9)))
 
     def add_meta_info_to_db(self):
         """For each genome found in the db, the function tries to insert meta data from the
@@ -1,4 +1,348 @@
 # some helpers for handling / sorting / or checking sort of our h5 files
+import numpy as np
+
+
+AMBIGUITY_DECODE = {
+    'C': [1., 0., 0., 0.],
+    'A': [0., 1., 0., 0.],
+    'T': [0., 0., 1., 0.],
+    'G': [0., 0., 0., 1.],
+    'Y': [0.5, 0., 0.5, 0.],
+    'R': [0., 0.5, 0., 0.5],
+    'W': [0., 0.5, 0.5, 0.],
+    'S': [0.5, 0., 0., 0.5],
+    'K': [0., 0., 0.5, 0.5],
+    'M': [0.5, 0.5, 0., 0.],
+    'D': [0., 0.33, 0.33, 0.33],
+    'V': [0.33, 0.33, 0., 0.33],
+    'H': [0.33, 0.33, 0.33, 0.],
+    'B': [0.33, 0., 0.33, 0.33],
+    'N': [0.25, 0.25, 0.25, 0.25]
+}
+
+# /data/X can be stored as one uint8 code per base instead of 4 float16 values
+# code 0 is the zero padding, the bases follow in the order of AMBIGUITY_DECODE
+X_ENCODINGS = ['float16', 'base_codes']
+BASE_CODES = {bp: i + 1 for i, bp in enumerate(AMBIGUITY_DECODE.keys())}
+BASE_CODE_DECODE = np.zeros((len(BASE_CODES) + 1, 4), dtype=np.float16)
+for _bp, _code in BASE_CODES.items():
+    BASE_CODE_DECODE[_code] = AMBIGUITY_DECODE[_bp]
+del _bp, _code
+
+
+def x_encoding(h5):
+    """files written before the encoding was recorded always have float16 X"""
+    encoding = h5.attrs.get('x_encoding', 'float16')
+    if isinstance(encoding, bytes):
+        encoding = encoding.decode()
+    return encoding
+
+
+def decode_base_codes(codes):
+    """Expands uint8 base codes of any shape into the float16 matrix of shape (*codes.shape, 4)
+    that would have been stored as X otherwise"""
+    return np.take(BASE_CODE_DECODE, codes, axis=0)
+
+
+def read_x(h5, idx=slice(None)):
+    """reads /data/X[idx] as float16 matrix independent of how it was stored"""
+    x = h5['data/X'][idx]
+    if x_encoding(h5) == 'base_codes':
+        x = decode_base_codes(x)
+    return x
+
+
+# for one-hot exports /data/y can be stored as one uint8 class index per base and
+# /data/sample_weights bit-packed, 8 bases per byte
+# class index 0 is the zero padding, the one-hot classes follow as 1-4
+LABEL_ENCODINGS = ['int8', 'compact']
+CLASS_INDEX_DECODE = np.concatenate([np.zeros((1, 4)), np.eye(4)]).astype(np.int8)
+
+
+def label_encoding(h5):
+    """files written before the encoding was recorded always have int8 y and sample_weights"""
+    encoding = h5.attrs.get('label_encoding', 'int8')
+    if isinstance(encoding, bytes):
+        encoding = encoding.decode()
+    return encoding
+
+
+def decode_class_indexes(class_indexes):
+    """Expands uint8 class indexes of any shape into one-hot int8 labels of shape
+    (*class_indexes.shape, 4)"""
+    return np.take(CLASS_INDEX_DECODE, class_indexes, axis=0)
+
+
+def unpack_sample_weights(packed, chunk_size):
+    """Unpacks bit-packed sample weights of shape (..., ceil(chunk_size / 8)) into int8 0/1
+    sample weights of shape (..., chunk_size)"""
+    return np.unpackbits(packed, axis=-1, count=chunk_size).view(np.int8)
+
+
+def read_y(h5, idx=slice(None)):
+    """reads the rows idx of /data/y as int8 labels independent of how they were stored"""
+    y = h5['data/y'][idx]
+    if label_encoding(h5) == 'compact':
+        y = decode_class_indexes(y)
+    return y
+
+
+def read_sample_weights(h5, idx=slice(None)):
+    """reads the rows idx of /data/sample_weights as int8 0/1 independent of how they were stored"""
+    sample_weights = h5['data/sample_weights'][idx]
+    if label_encoding(h5) == 'compact':
+        sample_weights = unpack_sample_weights(sample_weights, h5['data/y'].shape[1])
+    return sample_weights
+
+
+def block_shuffle(idx, block_size, window=1, rng=np.random):
+    """Shuffles idx in blocks of block_size consecutive (after sorting) indexes, so batches
+    mostly consist of a few contiguous runs of rows that are cheap to read from h5 chunks and
+    compressed blocks. The order of the blocks is shuffled and then the indexes within each
+    window of window consecutive blocks, so a batch mixes rows of up to window blocks."""
+    idx = np.sort(np.asarray(idx))
+    blocks = [idx[i:i + block_size] for i in range(0, len(idx), block_size)]
+    order = rng.permutation(len(blocks))
+    shuffled = [np.concatenate([blocks[b] for b in order[i:i + window]])
+                for i in range(0, len(order), window)]
+    for part in shuffled:
+        rng.shuffle(part)
+    return np.concatenate(shuffled) if shuffled else idx
+
+
+def read_rows(dset, sorted_idx, n_cols=None):
+    """Reads the rows sorted_idx of dset with one slice per run of consecutive indexes instead
+    of a (much slower) h5py point selection. Only the first n_cols columns are read if given."""
+    sorted_idx = np.asarray(sorted_idx, dtype=np.int64)
+    cols = slice(None) if n_cols is None else slice(0, n_cols)
+    if not len(sorted_idx):
+        return dset[0:0, cols]
+    run_starts = np.flatnonzero(np.diff(sorted_idx) != 1) + 1
+    bounds = zip(np.concatenate([[0], run_starts]), np.concatenate([run_starts, [len(sorted_idx)]]))
+    parts = [dset[sorted_idx[s]:sorted_idx[e - 1] + 1, cols] for s, e in bounds]
+    return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+
+class Stepper(object):
+    """Cuts [0, end) into chunks of length by, where the last two chunks share the rest equally,
+    if it is shorter than twice by. Lives here as the chunks of contiguous exports are only cut
+    when they are read."""
+    def __init__(self, end, by):
+        self.at = 0
+        self.end = end
+        self.by = by
+
+    def step(self):
+        prev = self.at
+        # fits twice or more, just step
+        if prev + self.by * 2 <= self.end:
+            new = prev + self.by
+        # fits less than twice, take half way point (to avoid an end of just a few bp)
+        elif prev + self.by < self.end:
+            new = prev + (self.end - prev) // 2
+        # doesn't fit at all
+        else:
+            new = self.end
+        self.at = new
+        return prev, new
+
+    def step_to_end(self):
+        while self.at < self.end:
+            yield self.step()
+
+
+# files exported with --contiguous store each coordinate strand as one run of bases instead of
+# chunks, see helixerprep.core.contiguous
+LAYOUTS = ['chunked', 'contiguous']
+
+
+def data_layout(h5):
+    """files written before the layout was recorded are always chunked"""
+    layout = h5.attrs.get('layout', 'chunked')
+    if isinstance(layout, bytes):
+        layout = layout.decode()
+    return layout
+
+
+# the /summary group is written by the exporter (or scripts/add_summary_index.py for older files),
+# so readers of huge files don't have to scan the per chunk datasets on every start
+def _add_runs(runs, keys, offset):
+    """Appends [*values, start, end] for each run of equal values in the key arrays to runs,
+    extending the last run if it continues at offset"""
+    change = np.zeros(len(keys[0]) - 1, dtype=bool)
+    for key in keys:
+        change |= key[1:] != key[:-1]
+    starts = np.concatenate([[0], np.flatnonzero(change) + 1])
+    ends = np.concatenate([starts[1:], [len(keys[0])]])
+    for start, end in zip(starts, ends):
+        values = [key[start] for key in keys]
+        if runs and runs[-1][:-2] == values and runs[-1][-1] == offset + start:
+            runs[-1][-1] = offset + end
+        else:
+            runs.append(values + [offset + start, offset + end])
+
+
+def write_summary(h5_file, block_size=2 ** 20):
+    """(Re)writes the /summary group of an exported h5 file. It has the counts of all, erroneous
+    and fully intergenic rows and the range of the log coordinate lengths as attributes and the
+    datasets clean_idx and genic_idx with the indexes of the error free and the not fully
+    intergenic rows. The row ranges of each run of rows of the same species are stored in
+    species and species_ranges, the ones of each seqid in seqids_species, seqids and
+    seqid_ranges. The per chunk datasets are read in blocks of block_size rows."""
+    n_rows = h5_file['data/X'].shape[0] if 'data/X' in h5_file else 0
+    clean_idx, genic_idx = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    log_length_min, log_length_max = np.nan, np.nan
+    species_runs, seqid_runs = [], []
+    for offset in range(0, n_rows, block_size):
+        block = slice(offset, min(offset + block_size, n_rows))
+        clean_idx.append(np.flatnonzero(~h5_file['data/err_samples'][block]) + offset)
+        genic_idx.append(np.flatnonzero(~h5_file['data/fully_intergenic_samples'][block]) + offset)
+        log_lengths = np.log(h5_file['data/coord_lengths'][block].astype(np.float64))
+        log_length_min = np.nanmin([log_length_min, np.min(log_lengths)])
+        log_length_max = np.nanmax([log_length_max, np.max(log_lengths)])
+        species, seqids = h5_file['data/species'][block], h5_file['data/seqids'][block]
+        _add_runs(species_runs, [species], offset)
+        _add_runs(seqid_runs, [species, seqids], offset)
+    clean_idx, genic_idx = np.concatenate(clean_idx), np.concatenate(genic_idx)
+
+    if 'summary' in h5_file:
+        del h5_file['summary']
+    summary = h5_file.create_group('summary')
+    summary.attrs['n_rows'] = n_rows
+    summary.attrs['n_err_samples'] = n_rows - len(clean_idx)
+    summary.attrs['n_fully_intergenic_samples'] = n_rows - len(genic_idx)
+    summary.attrs['log_length_min'] = log_length_min
+    summary.attrs['log_length_max'] = log_length_max
+    summary.create_dataset('clean_idx', data=clean_idx)
+    summary.create_dataset('genic_idx', data=genic_idx)
+    summary.create_dataset('species', data=np.array([r[0] for r in species_runs], dtype='S25'))
+    summary.create_dataset('species_ranges',
+                           data=np.array([r[1:] for r in species_runs], dtype=np.int64).reshape(-1, 2))
+    summary.create_dataset('seqids_species', data=np.array([r[0] for r in seqid_runs], dtype='S25'))
+    summary.create_dataset('seqids', data=np.array([r[1] for r in seqid_runs], dtype='S50'))
+    summary.create_dataset('seqid_ranges',
+                           data=np.array([r[2:] for r in seqid_runs], dtype=np.int64).reshape(-1, 2))
+
+
+def read_summary(h5):
+    """Returns the /summary group, or None if there is none or it does not match the data anymore"""
+    if 'summary' not in h5 or 'data/X' not in h5:
+        return None
+    summary = h5['summary']
+    if summary.attrs['n_rows'] != h5['data/X'].shape[0]:
+        return None
+    return summary
+
+
+def sequence_start_rows(h5, summary=None):
+    """Returns the first row of each species and of each seqid per species as
+    ({species: row}, {species: {seqid: row}}), both as absolute row indexes of the file. They are
+    taken from the summary (see read_summary()) if there is one, otherwise /data/species and
+    /data/seqids are scanned."""
+    species_rows, seqid_rows = {}, {}
+    if summary is not None:
+        # only the first row range of each species and seqid is needed
+        for species, (start, _) in zip(summary['species'], summary['species_ranges']):
+            species_rows.setdefault(species.decode('utf-8'), int(start))
+            seqid_rows.setdefault(species.decode('utf-8'), {})
+        for species, seqid, (start, _) in zip(summary['seqids_species'], summary['seqids'],
+                                              summary['seqid_ranges']):
+            seqid_rows[species.decode('utf-8')].setdefault(seqid.decode('utf-8'), int(start))
+        return species_rows, seqid_rows
+
+    species_arr = np.array(h5['/data/species'])
+    seqids_arr = np.array(h5['/data/seqids'])
+    for species, start in zip(*np.unique(species_arr, return_index=True)):
+        species_idx = np.flatnonzero(species_arr == species)
+        seqids, seqid_starts = np.unique(seqids_arr[species_idx], return_index=True)
+        species_rows[species.decode('utf-8')] = int(start)
+        seqid_rows[species.decode('utf-8')] = {seqid.decode('utf-8'): int(species_idx[i])
+                                               for seqid, i in zip(seqids, seqid_starts)}
+    return species_rows, seqid_rows
+
+
+def pool_labels(y, sw, pool_size):
+    """Pools decoded labels y of shape (rows, bases, classes) and sample weights of shape
+    (rows, bases) into timesteps of pool_size bases, after clipping the bases that do not fill
+    a whole timestep. Returns the sample weights of the timesteps, where any erroneous base
+    marks the whole timestep as error, and the class membership of the timesteps, with a 1 for
+    every class that occurs in it."""
+    n_steps = y.shape[1] // pool_size
+    y = y[:, :n_steps * pool_size].reshape((y.shape[0], n_steps, pool_size, y.shape[-1]))
+    sw = sw[:, :n_steps * pool_size].reshape((sw.shape[0], n_steps, pool_size))
+    pooled_sw = np.all(sw != 0, axis=2).astype(np.int8)
+    classes = np.any(y == 1, axis=2).astype(np.int8)
+    return pooled_sw, classes
+
+
+def class_weighted(pooled_sw, classes, class_weights):
+    """Multiplies the pooled sample weights with the class weights of all classes occurring in
+    each timestep, which gives even more weight to transitions between classes"""
+    return pooled_sw * np.dot(classes, class_weights)
+
+
+# the pooled sample weight and class membership of a timestep are stored together as one uint8,
+# with one bit per class and the highest bit set if the timestep is free of errors
+POOLED_SW_BIT = 7
+
+
+def encode_pooled(pooled_sw, classes):
+    """Encodes the output of pool_labels() into one uint8 code per timestep"""
+    assert classes.shape[-1] < POOLED_SW_BIT
+    bits = (2 ** np.arange(classes.shape[-1])).astype(np.uint8)
+    codes = np.dot(classes.astype(np.uint8), bits).astype(np.uint8)
+    return codes | (pooled_sw.astype(np.uint8) << POOLED_SW_BIT)
+
+
+def pooled_sample_weights(codes, n_classes, class_weights=None):
+    """Decodes the pooled sample weights from codes of encode_pooled(), multiplied with the
+    class weights like class_weighted() if there are any, with a lookup table of all codes"""
+    all_codes = np.arange(256, dtype=np.uint8)
+    table = (all_codes >> POOLED_SW_BIT).astype(np.int8)
+    if class_weights is not None:
+        classes = (all_codes[:, None] >> np.arange(n_classes, dtype=np.uint8)) & 1
+        table = class_weighted(table, classes.astype(np.int8), class_weights)
+    return np.take(table, codes)
+
+
+def pooled_group_name(pool_size):
+    return 'pooled_{}'.format(pool_size)
+
+
+def write_pooled(h5_file, pool_size, block_size=2 ** 12):
+    """(Re)writes the /pooled_<pool_size> group of an exported h5 file. Its dataset codes has
+    the output of pool_labels() of all rows encoded with encode_pooled(), so the sequences of
+    the models only have to look up their sample weights instead of pooling every batch. The
+    rows are pooled in blocks of block_size."""
+    n_rows, chunk_size = h5_file['data/y'].shape[:2]
+    n_steps = chunk_size // pool_size
+    name = pooled_group_name(pool_size)
+    if name in h5_file:
+        del h5_file[name]
+    group = h5_file.create_group(name)
+    group.attrs['n_rows'] = n_rows
+    group.attrs['n_classes'] = read_y(h5_file, slice(0, 1)).shape[-1]
+    codes = group.create_dataset('codes', shape=(n_rows, n_steps), dtype=np.uint8,
+                                 chunks=(1, n_steps) if n_rows and n_steps else None,
+                                 compression='lzf', shuffle=True)
+    for offset in range(0, n_rows, block_size):
+        block = slice(offset, min(offset + block_size, n_rows))
+        codes[block] = encode_pooled(*pool_labels(read_y(h5_file, block),
+                                                  read_sample_weights(h5_file, block), pool_size))
+
+
+def read_pooled(h5, pool_size):
+    """Returns the /pooled_<pool_size> group, or None if there is none or it does not match the
+    data anymore"""
+    name = pooled_group_name(pool_size)
+    if name not in h5 or 'data/y' not in h5:
+        return None
+    pooled = h5[name]
+    if pooled.attrs['n_rows'] != h5['data/y'].shape[0]:
+        return None
+    return pooled
+
+
 def mk_seqonly_keys(h5):
     return [a + b for a, b in zip(h5['data/species'],
                                   h5['data/seqids'])]
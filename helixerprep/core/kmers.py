@@ -0,0 +1,91 @@
+"""counting the canonical kmers of the coordinate sequences directly, instead of importing them
+from precomputed jellyfish kmers.tsv files"""
+import os
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from geenuff.base.orm import Coordinate
+
+BASES = 'ACGT'
+# 2 bit code of every byte of a sequence, -1 for everything that is not one of the four bases,
+# the codes sort like the bases so a smaller code is a lexicographically smaller kmer
+BASE_CODES = np.full(256, -1, dtype=np.int8)
+for _i, _base in enumerate(BASES):
+    BASE_CODES[ord(_base)] = _i
+    BASE_CODES[ord(_base.lower())] = _i
+
+
+def rc_codes(k):
+    """The code of the reverse complement of each of the 4 ** k kmer codes of length k"""
+    codes = np.arange(4 ** k, dtype=np.int64)
+    rc = np.zeros_like(codes)
+    for _ in range(k):
+        # the complement of a code is 3 - code, and the last base becomes the first
+        rc = rc * 4 + (3 - codes % 4)
+        codes //= 4
+    return rc
+
+
+def code_to_mer(code, k):
+    return ''.join([BASES[(code >> (2 * (k - 1 - i))) & 3] for i in range(k)])
+
+
+def count_kmers(sequence, max_k, block_size=10 ** 7):
+    """Counts all kmers of length 1 to max_k of sequence with rolling 2 bit codes. Kmers that
+    contain anything but ACGT are not counted. Each kmer is counted together with its reverse
+    complement under the lexicographically smaller of the two, like the collapsed kmers.tsv counts.
+    Returns one array of 4 ** k counts per k, indexed by the kmer code.
+    The sequence is encoded in blocks of block_size bases, so the memory usage does not depend
+    on the length of the sequence."""
+    counts = [np.zeros(4 ** k, dtype=np.int64) for k in range(1, max_k + 1)]
+    raw = np.frombuffer(sequence.encode('ASCII'), dtype=np.uint8)
+    for start in range(0, len(raw), block_size):
+        # overlapping with the next block, so the kmers across the border are counted once
+        block = BASE_CODES[raw[start:start + block_size + max_k - 1]]
+        is_base = block >= 0
+        bases = np.where(is_base, block, 0).astype(np.int64)
+        n_not_bases = np.concatenate([[0], np.cumsum(~is_base)])
+        codes = bases
+        for k in range(1, max_k + 1):
+            if k > 1:
+                codes = codes[:-1] * 4 + bases[k - 1:]
+            # only the kmers that start in this block and contain only bases
+            n_starts = min(block_size, len(codes))
+            is_valid = n_not_bases[k:k + n_starts] == n_not_bases[:n_starts]
+            counts[k - 1] += np.bincount(codes[:n_starts][is_valid], minlength=4 ** k)
+    for k in range(1, max_k + 1):
+        canonical = np.minimum(np.arange(4 ** k), rc_codes(k))
+        counts[k - 1] = np.bincount(canonical, weights=counts[k - 1],
+                                    minlength=4 ** k).astype(np.int64)
+    return counts
+
+
+def canonical_mer_counts(sequence, max_k):
+    """The non zero counts of count_kmers() as dict of kmer to count"""
+    out = {}
+    for k, k_counts in enumerate(count_kmers(sequence, max_k), start=1):
+        for code in np.flatnonzero(k_counts):
+            out[code_to_mer(int(code), k)] = int(k_counts[code])
+    return out
+
+
+# each worker process keeps its own db session
+_worker_session = None
+
+
+def init_kmer_worker(db_path):
+    global _worker_session
+    # read only, as only the main process writes the counts
+    engine = create_engine('sqlite:///file:{}?mode=ro&uri=true'.format(os.path.abspath(db_path)),
+                           echo=False)
+    _worker_session = sessionmaker(bind=engine)()
+
+
+def count_coord_mers(task):
+    """Loads the sequence of a coordinate in the worker and returns its canonical_mer_counts()"""
+    coord_id, max_k = task
+    sequence = (_worker_session.query(Coordinate.sequence)
+                               .filter(Coordinate.id == coord_id)
+                               .one())[0]
+    return coord_id, canonical_mer_counts(sequence, max_k)
@@ -0,0 +1,105 @@
+"""caching the per row datasets of an exported h5 file as uncompressed .npy files, that are memory
+mapped instead of decompressed again in every epoch and by every training run on the node"""
+import os
+import shutil
+import fcntl
+import hashlib
+import tempfile
+import numpy as np
+
+from .contiguous import open_data_file
+
+CACHED_KEYS = ['X', 'y', 'sample_weights']
+
+
+def source_fingerprint(h5_file, sample_bytes=2 ** 20):
+    """A hash of the file behind h5_file, that changes whenever the file is rewritten. It uses the
+    size, modification time and the first and last sample_bytes of the file instead of all of
+    it, so looking up the cache of a large file stays cheap. The chunk size and keep_errors of
+    files exported with --contiguous are part of it, as they change the rows."""
+    path = os.path.realpath(h5_file.filename)
+    stat = os.stat(path)
+    sha = hashlib.sha1()
+    sha.update('{}:{}:{}:{}:{}'.format(path, stat.st_size, stat.st_mtime_ns,
+                                       getattr(h5_file, 'chunk_size', ''),
+                                       getattr(h5_file, 'keep_errors', '')).encode())
+    with open(path, 'rb') as f:
+        sha.update(f.read(sample_bytes))
+        f.seek(max(stat.st_size - sample_bytes, 0))
+        sha.update(f.read(sample_bytes))
+    return sha.hexdigest()[:16]
+
+
+def _write_npy(dset, path, block_rows):
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=dset.dtype, shape=dset.shape)
+    for start in range(0, dset.shape[0], block_rows):
+        out[start:start + block_rows] = dset[start:start + block_rows]
+    out.flush()
+    del out
+
+
+def cache_dir_of(h5_file, cache_root, block_rows=1024):
+    """Returns the folder in cache_root with one .npy file of each of CACHED_KEYS of h5_file,
+    writing it first if it does not exist yet. Concurrent callers wait on a lock file for the
+    one writing the cache, which is written to a temporary folder and renamed when complete,
+    so a cache folder is never seen half written."""
+    os.makedirs(cache_root, exist_ok=True)
+    name = '{}_{}'.format(os.path.basename(h5_file.filename), source_fingerprint(h5_file))
+    cache_dir = os.path.join(cache_root, name)
+    with open(cache_dir + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.isdir(cache_dir):
+            dsets = [h5_file['/data/' + key] for key in CACHED_KEYS]
+            n_bytes = sum([int(np.prod(d.shape)) * np.dtype(d.dtype).itemsize for d in dsets])
+            free = shutil.disk_usage(cache_root).free
+            if n_bytes > free:
+                raise ValueError('caching {} needs {:.1f} GB, but only {:.1f} GB are free in '
+                                 '{}'.format(h5_file.filename, n_bytes / 2 ** 30, free / 2 ** 30,
+                                             cache_root))
+            print('caching {} uncompressed in {} ({:.1f} MB)'.format(h5_file.filename, cache_dir,
+                                                                    n_bytes / 2 ** 20))
+            tmp_dir = tempfile.mkdtemp(dir=cache_root, prefix='.' + name)
+            try:
+                for key, dset in zip(CACHED_KEYS, dsets):
+                    _write_npy(dset, os.path.join(tmp_dir, key + '.npy'), block_rows)
+                os.rename(tmp_dir, cache_dir)
+            except BaseException:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+    return cache_dir
+
+
+class MemmapCachedFile(object):
+    """Wraps an opened h5 file (or VirtualChunkFile), serving the datasets of CACHED_KEYS from
+    read only memory maps of their cache in cache_root, everything else from the wrapped file.
+    Slices of the memory maps are views without a copy and all processes mapping the same cache
+    share its pages in the page cache. The maps can also be used by forked processes, the wrapped
+    file has to be reopened there with reopen()."""
+    def __init__(self, h5_file, cache_root):
+        self.h5_file = h5_file
+        self.attrs = h5_file.attrs
+        self.filename = h5_file.filename
+        self.cache_dir = cache_dir_of(h5_file, cache_root)
+        self.datasets = {key: np.load(os.path.join(self.cache_dir, key + '.npy'), mmap_mode='r')
+                         for key in CACHED_KEYS}
+
+    def reopen(self):
+        """Opens the wrapped file again (as VirtualChunkFile with the same chunk size if it was
+        one), for forked processes that can not safely use the h5 handle inherited from the main
+        process. The memory maps are kept."""
+        self.h5_file = open_data_file(self.filename, getattr(self.h5_file, 'chunk_size', None),
+                                      keep_errors=getattr(self.h5_file, 'keep_errors', False))
+        self.attrs = self.h5_file.attrs
+
+    def __contains__(self, path):
+        return path in self.h5_file
+
+    def __getitem__(self, path):
+        path = path.strip('/')
+        if path.startswith('data/') and path[5:] in self.datasets:
+            return self.datasets[path[5:]]
+        return self.h5_file[path]
+
+    def close(self):
+        self.datasets = {}
+        self.h5_file.close()
@@ -3,6 +3,8 @@ import numpy as np
 import h5py
 import csv
 
+from helixerprep.core.helpers import read_x, read_y
+
 
 class CoverageCounter(object):
 
@@ -21,7 +23,12 @@ class CoverageCounter(object):
 
     def get_latest_arrays(self, i, h5):
         for h5_key, key in CoverageCounter.ARRAYS:
-            self.latest[key] = h5[h5_key][i]
+            if h5_key == 'data/X':
+                self.latest[key] = read_x(h5, i)
+            elif h5_key == 'data/y':
+                self.latest[key] = read_y(h5, i)
+            else:
+                self.latest[key] = h5[h5_key][i]
 
     @staticmethod
     def setup_fully_binned_counts(lab_dim, n_cov_bins):
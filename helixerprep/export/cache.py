@@ -0,0 +1,153 @@
+"""on disk cache of the encoded chunks of single coordinates, so that exporting the same
+coordinates again (e.g. with a different genome selection) only has to copy them"""
+import os
+import time
+import h5py
+import hashlib
+import numpy as np
+
+# increase whenever the numerification or encoding changes, so old entries are not found anymore
+CACHE_VERSION = 2
+# the datasets that only depend on what goes into the key, the per coordinate metadata
+# (gc content, length, species and seqid) is filled in again from the coordinate
+CACHED_KEYS = ['X', 'y', 'sample_weights', 'err_samples', 'fully_intergenic_samples', 'start_ends',
+               'row_lengths']
+
+
+def coord_cache_key(sequence, coord_features, chunk_size, one_hot, keep_errors, x_encoding,
+                    label_encoding):
+    """sha256 of the coordinate sequence, its features and all export parameters that change
+    the encoded chunks"""
+    features = sorted([(f.start, f.end, f.is_plus_strand, str(f.type)) for f in coord_features])
+    params = [CACHE_VERSION, chunk_size, one_hot, keep_errors, x_encoding, label_encoding]
+    key = hashlib.sha256()
+    key.update(str(params).encode())
+    key.update(str(features).encode())
+    key.update(sequence.encode())
+    return key.hexdigest()
+
+
+class CoordCache(object):
+    """Content addressed cache with one small h5 file per coordinate, named after its key.
+    New entries are written to a temporary file that is only renamed once the coordinate is
+    complete, so interrupted exports never leave partial entries behind.
+    Once the cache grows beyond max_size_mb the least recently used entries are removed. An
+    entry counts as used when it is written, pinned or loaded, which updates its modification
+    time. Pinned entries, that are going to be loaded later, are never removed by this cache,
+    so it can temporarily exceed max_size_mb by them."""
+
+    def __init__(self, cache_dir, max_size_mb=10000):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.max_size_bytes = int(max_size_mb * 2 ** 20)
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.size_bytes = 0
+        self.pinned = set()
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.tmp'):
+                # left over from an interrupted export, unless another export is still writing it
+                if entry.stat().st_mtime < time.time() - 24 * 3600:
+                    os.remove(entry.path)
+            elif entry.name.endswith('.h5'):
+                self.size_bytes += entry.stat().st_size
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.h5')
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def pin(self, key):
+        """Protects the entry of key from eviction until it is loaded, e.g. while it waits behind
+        coordinates that are still numerified and stored. Returns False if there is no entry."""
+        try:
+            # the newest entry for other exports sharing the cache as well
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            return False
+        self.pinned.add(key)
+        return True
+
+    def load(self, key, max_chunks=0):
+        """Yields the cached (arrays, n_masked_bases, n_intergenic_bases) of a coordinate in groups
+        of at most max_chunks chunks, or all at once if max_chunks is 0. The counts are only
+        passed on with the first group."""
+        self.hits += 1
+        path = self._path(key)
+        os.utime(path)
+        with h5py.File(path, 'r') as h5_file:
+            # open, so it can be removed now
+            self.pinned.discard(key)
+            n_masked_bases = int(h5_file.attrs['n_masked_bases'])
+            n_intergenic_bases = int(h5_file.attrs['n_intergenic_bases'])
+            n_chunks = h5_file['X'].shape[0]
+            step = max_chunks if max_chunks else max(n_chunks, 1)
+            for i in range(0, max(n_chunks, 1), step):
+                arrays = {key: h5_file[key][i:i + step] for key in CACHED_KEYS} if n_chunks else None
+                yield arrays, n_masked_bases, n_intergenic_bases
+                n_masked_bases, n_intergenic_bases = 0, 0
+
+    def store(self, key, coord_outputs):
+        """Passes on coord_outputs, which have to be (arrays, n_masked_bases, n_intergenic_bases)
+        with arrays None for groups without chunks, while writing them into a new entry"""
+        self.misses += 1
+        tmp_path = self._path(key) + '.{}.tmp'.format(os.getpid())
+        n_masked_bases, n_intergenic_bases = 0, 0
+        with h5py.File(tmp_path, 'w') as h5_file:
+            for arrays, n_masked, n_intergenic in coord_outputs:
+                n_masked_bases += n_masked
+                n_intergenic_bases += n_intergenic
+                if arrays is not None:
+                    self._append(h5_file, arrays)
+                yield arrays, n_masked, n_intergenic
+            if 'X' not in h5_file:
+                # a coordinate without any (valid) chunks
+                self._append(h5_file, None)
+            h5_file.attrs['n_masked_bases'] = n_masked_bases
+            h5_file.attrs['n_intergenic_bases'] = n_intergenic_bases
+        os.replace(tmp_path, self._path(key))
+        self.size_bytes += os.path.getsize(self._path(key))
+        if self.size_bytes > self.max_size_bytes:
+            self._evict()
+
+    @staticmethod
+    def _append(h5_file, arrays):
+        if arrays is None:
+            for key in CACHED_KEYS:
+                h5_file.create_dataset(key, shape=(0,), dtype=np.int8)
+            return
+        for key in CACHED_KEYS:
+            array = arrays[key]
+            if key not in h5_file:
+                h5_file.create_dataset(key, shape=(0,) + array.shape[1:],
+                                       maxshape=(None,) + array.shape[1:], chunks=True,
+                                       dtype=array.dtype, compression='lzf')
+            dset = h5_file[key]
+            old_len = dset.shape[0]
+            dset.resize(old_len + len(array), axis=0)
+            dset[old_len:] = array
+
+    def _evict(self):
+        """Removes the least recently used entries until the cache is within its size again.
+        The directory is rescanned, as other exports can share the same cache."""
+        pinned_paths = set([self._path(key) for key in self.pinned])
+        entries = [entry for entry in os.scandir(self.cache_dir)
+                   if entry.name.endswith('.h5') and entry.path not in pinned_paths]
+        entries = sorted([(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                          for entry in entries])
+        self.size_bytes = sum([size for _, size, _ in entries])
+        # the pinned entries still count towards the size
+        for path in pinned_paths:
+            if os.path.exists(path):
+                self.size_bytes += os.path.getsize(path)
+        for _, size, path in entries:
+            if self.size_bytes <= self.max_size_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # already evicted by another export
+                pass
+            self.size_bytes -= size
+            self.evictions += 1
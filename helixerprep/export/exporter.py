@@ -3,69 +3,153 @@ import h5py
 import copy
 import time
 import numpy as np
-import random
 import datetime
-from itertools import compress
-from collections import defaultdict
+import multiprocessing
+from itertools import islice
+from collections import defaultdict, deque, namedtuple
 from sklearn.model_selection import train_test_split
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
 
 from geenuff.base.orm import Coordinate, Genome, Feature
 from geenuff.base.helpers import full_db_path
 from geenuff.applications.exporter import GeenuffExportController
-from .numerify import CoordNumerifier
+from ..core.orm import Mer
+from ..core.helpers import X_ENCODINGS, LABEL_ENCODINGS, write_summary, data_layout, Stepper
+from .numerify import (CoordNumerifier, encode_base_codes, encode_class_indexes,
+                       pack_sample_weights)
+from .writer import BufferedH5Writer, ContiguousH5Writer
+from .cache import CoordCache, coord_cache_key
+from .stats import ExportStats
+
+# the attributes of a Feature needed for numerification, picklable to be sent to worker processes
+FeatureRecord = namedtuple('FeatureRecord', ['start', 'end', 'is_plus_strand', 'type'])
+GenomeRecord = namedtuple('GenomeRecord', ['id', 'species'])
+
+
+class CoordRecord(namedtuple('CoordRecord', ['id', 'seqid', 'length', 'sequence', 'genome'])):
+    """The attributes of a Coordinate needed for numerification, loaded as plain rows so they
+    neither stay in the session nor trigger any lazy loads"""
+    __slots__ = ()
+
+    def __str__(self):
+        # without the sequence
+        return '<Coordinate {}, {}, length: {}>'.format(self.id, self.seqid, self.length)
+
+
+def _query_coord_records(session, coord_ids):
+    """Loads the coordinates with the given ids and their genomes with one query,
+    returns a dict of coordinate id to CoordRecord"""
+    query = (session.query(Coordinate.id, Coordinate.seqid, Coordinate.length, Coordinate.sequence,
+                           Genome.id, Genome.species)
+                    .join(Genome, Coordinate.genome_id == Genome.id)
+                    .filter(Coordinate.id.in_(list(coord_ids))))
+    return {row[0]: CoordRecord(row[0], row[1], row[2], row[3], GenomeRecord(row[4], row[5]))
+            for row in query}
+
+# each worker process of a parallel export keeps its own db session
+_worker_session = None
+# and the coordinate of its last task, as the parts of a coordinate are queued one after another
+_worker_coord = None
+
+
+def _init_numerify_worker(db_path_in):
+    global _worker_session
+    if db_path_in.startswith('sqlite:///'):
+        db_path_in = db_path_in[len('sqlite:///'):]
+    # read only, as only the main process should ever write anything
+    engine = create_engine('sqlite:///file:{}?mode=ro&uri=true'.format(os.path.abspath(db_path_in)),
+                           echo=False)
+    _worker_session = sessionmaker(bind=engine)()
+
+
+def _numerify_in_worker(task):
+    """Numerifies one part of a coordinate, or all of it if part is None. Unless encode_args
+    is None the outputs are also padded and encoded here, so the main process only writes them."""
+    global _worker_coord
+    coord_id, coord_features, numerify_args, part, encode_args = task
+    timings = numerify_args['timings']
+    if _worker_coord is None or _worker_coord.id != coord_id:
+        start = time.perf_counter()
+        _worker_coord = _query_coord_records(_worker_session, [coord_id])[coord_id]
+        if timings is not None:
+            timings['db_fetch'] += time.perf_counter() - start
+    coord_info = HelixerExportController._coord_info(_worker_coord, coord_features)
+    numerify_outputs = HelixerExportController._numerify_coord(
+        None, _worker_coord, coord_features, parts=None if part is None else [part], **numerify_args)
+    if encode_args is not None:
+        numerify_outputs = HelixerExportController._encoded_outputs(numerify_outputs,
+                                                                    timings=timings, **encode_args)
+    numerify_outputs = list(numerify_outputs)
+    # the timings measured in the worker are passed back with the coordinate
+    coord_info['timings'] = timings
+    return coord_info, numerify_outputs
 
 
 class HelixerExportController(object):
-    def __init__(self, db_path_in, data_dir, only_test_set=False):
+    list_in_list_out = ['inputs', 'labels', 'label_masks', 'start_ends']
+    one_in_list_out = ['gc_contents', 'coord_lengths', 'species', 'seqids']
+
+    def __init__(self, db_path_in, data_dir, only_test_set=False, append=False):
+        """With append the existing files in data_dir are reused and only the coordinates that
+        are not yet in their manifests get exported, so an interrupted export can be resumed
+        and new genomes can be added"""
         self.db_path_in = db_path_in
         self.only_test_set = only_test_set
+        self.append = append
         self.geenuff_exporter = GeenuffExportController(self.db_path_in, longest=True)
-        if not os.path.isdir(data_dir):
+        self.gc_contents = None
+        self.n_mer_queries = 0
+        self.x_encoding = 'float16'
+        self.label_encoding = 'int8'
+        self.writers = {}
+        self.cache = None
+        self.stats = None
+        self.data_dir = data_dir
+        if self.append:
+            file_mode = 'r+'
+        elif not os.path.isdir(data_dir):
             os.makedirs(data_dir)
+            file_mode = 'w'
         elif os.listdir(data_dir):
             print('Output directory must be empty or not existing')
             exit()
+        else:
+            file_mode = 'w'
         if self.only_test_set:
             print('Exporting all data into test_data.h5')
-            self.h5_test = h5py.File(os.path.join(data_dir, 'test_data.h5'), 'w')
+            self.h5_test = h5py.File(os.path.join(data_dir, 'test_data.h5'), file_mode)
         else:
             print('Splitting data into training_data.h5 and validation_data.h5')
-            self.h5_train = h5py.File(os.path.join(data_dir, 'training_data.h5'), 'w')
-            self.h5_val = h5py.File(os.path.join(data_dir, 'validation_data.h5'), 'w')
+            self.h5_train = h5py.File(os.path.join(data_dir, 'training_data.h5'), file_mode)
+            self.h5_val = h5py.File(os.path.join(data_dir, 'validation_data.h5'), file_mode)
 
     @staticmethod
-    def _split_sequences(flat_data, val_size):
+    def _split_sequences(arrays, val_size, random_state):
         """Basically does the same as sklearn.model_selection.train_test_split except
         it does not always fill the test arrays with at least one element.
-        Expects the arrays to be in the order: inputs, labels, label_masks
+        Expects a dict of arrays with one entry per chunk along the first axis.
         """
-        train_arrays, val_arrays = {}, {}
-        for key in flat_data:
-            train_arrays[key] = []
-            val_arrays[key] = []
-
-        for i in range(len(flat_data['inputs'])):
-            if random.random() > val_size:
-                for key in flat_data:
-                    train_arrays[key].append(flat_data[key][i])
-            else:
-                for key in flat_data:
-                    val_arrays[key].append(flat_data[key][i])
+        is_train = random_state.random_sample(len(arrays['X'])) > val_size
+        train_arrays = {key: array[is_train] for key, array in arrays.items()}
+        val_arrays = {key: array[~is_train] for key, array in arrays.items()}
         return train_arrays, val_arrays
 
-    def _save_data(self, h5_file, flat_data, chunk_size, n_y_cols):
+    @staticmethod
+    def _flat_data_to_arrays(flat_data, chunk_size, n_y_cols, x_encoding, label_encoding):
+        """Pads, stacks and encodes flat_data into one array per dataset of the /data group"""
         inputs = flat_data['inputs']
         labels = flat_data['labels']
         label_masks = flat_data['label_masks']
         # convert to numpy arrays
 
         # zero-pad each sequence to chunk_size
-        # this is inefficient if there could be a batch with only sequences smaller than
-        # chunk_size, but taking care of that introduces a lot of extra complexity
+        # the true lengths are kept in row_lengths, so readers can trim the padding of batches
+        # with only sequences smaller than chunk_size
         n_seq = len(inputs)
-        X = np.zeros((n_seq, chunk_size, 4), dtype=inputs[0].dtype)
-        y = np.zeros((n_seq, chunk_size, n_y_cols), dtype=labels[0].dtype)
-        sample_weights = np.zeros((n_seq, chunk_size), dtype=label_masks[0].dtype)
+        X = np.zeros((n_seq, chunk_size, 4), dtype=np.float16)
+        y = np.zeros((n_seq, chunk_size, n_y_cols), dtype=np.int8)
+        sample_weights = np.zeros((n_seq, chunk_size), dtype=np.int8)
         for j in range(n_seq):
             sample_len = len(inputs[j])
             X[j, :sample_len, :] = inputs[j]
@@ -77,85 +161,98 @@ class HelixerExportController(object):
             fully_intergenic_samples = np.all(y[:, :, 0] == 1, axis=1)
         else:
             fully_intergenic_samples = np.all(y[:, :, 0] == 0, axis=1)
-        gc_contents = np.array(flat_data['gc_contents'], dtype=np.uint64)
-        coord_lengths = np.array(flat_data['coord_lengths'], dtype=np.uint64)
-        start_ends = np.array(flat_data['start_ends'], dtype=np.int64)
-        # check if this is the first batch to save
-        dset_keys = [
-            'X', 'y', 'sample_weights', 'gc_contents', 'coord_lengths', 'err_samples',
-            'fully_intergenic_samples', 'start_ends', 'species', 'seqids'
-        ]
-        if '/data/X' in h5_file:
-            for dset_key in dset_keys:
-                dset = h5_file['/data/' + dset_key]
-                old_len = dset.shape[0]
-                dset.resize(old_len + n_seq, axis=0)
-        else:
-            old_len = 0
-            h5_file.create_dataset('/data/X',
-                                   shape=(n_seq, chunk_size, 4),
-                                   maxshape=(None, chunk_size, 4),
-                                   chunks=(1, chunk_size, 4),
-                                   dtype='float16',
-                                   compression='lzf',
-                                   shuffle=True)  # only for the compression
-            h5_file.create_dataset('/data/y',
-                                   shape=(n_seq, chunk_size, n_y_cols),
-                                   maxshape=(None, chunk_size, n_y_cols),
-                                   chunks=(1, chunk_size, n_y_cols),
-                                   dtype='int8',
-                                   compression='lzf',
-                                   shuffle=True)
-            h5_file.create_dataset('/data/sample_weights',
-                                   shape=(n_seq, chunk_size),
-                                   maxshape=(None, chunk_size),
-                                   chunks=(1, chunk_size),
-                                   dtype='int8',
-                                   compression='lzf',
-                                   shuffle=True)
-            h5_file.create_dataset('/data/gc_contents',
-                                   shape=(n_seq,),
-                                   maxshape=(None,),
-                                   dtype='uint64',
-                                   compression='lzf')
-            h5_file.create_dataset('/data/coord_lengths',
-                                   shape=(n_seq,),
-                                   maxshape=(None,),
-                                   dtype='uint64',
-                                   compression='lzf')
-            h5_file.create_dataset('/data/err_samples',
-                                   shape=(n_seq,),
-                                   maxshape=(None,),
-                                   dtype='bool',
-                                   compression='lzf')
-            h5_file.create_dataset('/data/fully_intergenic_samples',
-                                   shape=(n_seq,),
-                                   maxshape=(None,),
-                                   dtype='bool',
-                                   compression='lzf')
-            h5_file.create_dataset('/data/species',
-                                   shape=(n_seq,),
-                                   maxshape=(None,),
-                                   dtype='S25',
-                                   compression='lzf')
-            h5_file.create_dataset('/data/seqids',
-                                   shape=(n_seq,),
-                                   maxshape=(None,),
-                                   dtype='S50',
-                                   compression='lzf')
-            h5_file.create_dataset('/data/start_ends',
-                                   shape=(n_seq, 2),
-                                   maxshape=(None, 2),
-                                   dtype='int64',
-                                   compression='lzf')
-        # add new data
-        dsets = [X, y, sample_weights, gc_contents, coord_lengths, err_samples,
-                 fully_intergenic_samples, start_ends, flat_data['species'], flat_data['seqids']]
-        for dset_key, data in zip(dset_keys, dsets):
-            h5_file['/data/' + dset_key][old_len:] = data
-        h5_file.flush()
-
-    def _split_coords_by_N90(self, genome_coords, val_size):
+        if x_encoding == 'base_codes':
+            # one uint8 code per base, see helixerprep.core.helpers.BASE_CODES
+            X = encode_base_codes(X)
+        if label_encoding == 'compact':
+            # one uint8 class index per base and 8 bit-packed sample weights per byte,
+            # see helixerprep.core.helpers.read_y() and read_sample_weights()
+            y = encode_class_indexes(y)
+            sample_weights = pack_sample_weights(sample_weights)
+        arrays = {
+            'X': X,
+            'y': y,
+            'sample_weights': sample_weights,
+            'gc_contents': np.array(flat_data['gc_contents'], dtype=np.uint64),
+            'coord_lengths': np.array(flat_data['coord_lengths'], dtype=np.uint64),
+            'err_samples': err_samples,
+            'fully_intergenic_samples': fully_intergenic_samples,
+            'start_ends': np.array(flat_data['start_ends'], dtype=np.int64).reshape((n_seq, 2)),
+            'row_lengths': np.array([len(i) for i in inputs], dtype=np.int32),
+            'species': np.array(flat_data['species'], dtype='S25'),
+            'seqids': np.array(flat_data['seqids'], dtype='S50'),
+        }
+        return arrays
+
+    @staticmethod
+    def _encoded_outputs(numerify_outputs, chunk_size, n_y_cols, x_encoding, label_encoding,
+                         timings=None):
+        """Yields the outputs of _numerify_coord() with the flat_data turned into the arrays of
+        the /data group, or None for groups without chunks"""
+        for flat_data, n_masked, n_intergenic in numerify_outputs:
+            arrays = None
+            if flat_data['inputs']:
+                start = time.perf_counter()
+                arrays = HelixerExportController._flat_data_to_arrays(
+                    flat_data, chunk_size, n_y_cols, x_encoding, label_encoding)
+                if timings is not None:
+                    timings['encode'] += time.perf_counter() - start
+            # free all datasets so we don't keep two all the time
+            del flat_data
+            yield arrays, n_masked, n_intergenic
+
+    def _write_contiguous_coord(self, writer, coord_id, numerify_outputs, one_hot):
+        """Writes the chunks of both strands of a coordinate as two contiguous runs of bases,
+        returns the amount of chunks, masked and intergenic bases like the chunked export"""
+        n_chunks, n_masked_bases, n_intergenic_bases = 0, 0, 0
+        strand = None
+        for flat_data, n_masked, n_intergenic in numerify_outputs:
+            n_chunks += len(flat_data['inputs'])
+            n_masked_bases += n_masked
+            n_intergenic_bases += n_intergenic
+            for i in range(len(flat_data['inputs'])):
+                # the start ends are flipped for the minus strand
+                is_plus_strand = bool(flat_data['start_ends'][i][0] < flat_data['start_ends'][i][1])
+                if strand is not None and strand[0] != is_plus_strand:
+                    writer.finish_strand(*strand)
+                strand = (is_plus_strand, coord_id, flat_data['gc_contents'][i],
+                          flat_data['coord_lengths'][i], flat_data['species'][i],
+                          flat_data['seqids'][i])
+                X = np.asarray(flat_data['inputs'][i], dtype=np.float16)
+                y = np.asarray(flat_data['labels'][i], dtype=np.int8)
+                sample_weights = np.asarray(flat_data['label_masks'][i], dtype=np.int8)
+                if one_hot:
+                    is_genic = y[:, 0] != 1
+                else:
+                    is_genic = y[:, 0] != 0
+                if self.x_encoding == 'base_codes':
+                    X = encode_base_codes(X)
+                if self.label_encoding == 'compact':
+                    # the sample weights stay one byte per base, so they can be sliced anywhere
+                    y = encode_class_indexes(y)
+                writer.add_bases({'X': X, 'y': y, 'sample_weights': sample_weights},
+                                 is_error=sample_weights == 0, is_genic=is_genic)
+        # a coordinate can end up without any chunks, e.g. if it is completely erroneous
+        if strand is not None:
+            writer.finish_strand(*strand)
+        return n_chunks, n_masked_bases, n_intergenic_bases
+
+    def _add_coord_metadata(self, arrays, coord_id, coord_info):
+        """Adds the per coordinate datasets, that are not part of the cache entries, to arrays
+        loaded from the cache"""
+        n_chunks = len(arrays['X'])
+        arrays['gc_contents'] = np.full(n_chunks, self.gc_contents.get(coord_id, 0), dtype=np.uint64)
+        arrays['coord_lengths'] = np.full(n_chunks, coord_info['length'], dtype=np.uint64)
+        arrays['species'] = np.full(n_chunks, coord_info['species'].encode('ASCII'), dtype='S25')
+        arrays['seqids'] = np.full(n_chunks, coord_info['seqid'].encode('ASCII'), dtype='S50')
+        return arrays
+
+    def _cache_key(self, coord, coord_features, numerify_args):
+        return coord_cache_key(coord.sequence, coord_features, numerify_args['chunk_size'],
+                               numerify_args['one_hot'], numerify_args['keep_errors'],
+                               self.x_encoding, self.label_encoding)
+
+    def _split_coords_by_N90(self, genome_coords, val_size, random_state=None):
         """Splits the given coordinates in a train and val set. It does so by doing it individually for
         each the coordinates < N90 and >= N90 of each genome."""
         def N90_index(coords):
@@ -176,120 +273,510 @@ class HelixerExportController(object):
                     train_coord_ids += n90_split
                 else:
                     genome_train_coord_ids, genome_val_coord_ids = train_test_split(n90_split,
-                                                                                    test_size=val_size)
+                                                                                    test_size=val_size,
+                                                                                    random_state=random_state)
                     train_coord_ids += genome_train_coord_ids
                     val_coord_ids += genome_val_coord_ids
         return train_coord_ids, val_coord_ids
 
-    def _add_data_attrs(self, genomes, exclude, one_hot, keep_errors):
+    def _h5_files(self):
+        if self.only_test_set:
+            return [self.h5_test]
+        return [self.h5_train, self.h5_val]
+
+    def _add_data_attrs(self, genomes, exclude, one_hot, keep_errors, chunk_size, split_coordinates,
+                        layout='chunked'):
         attrs = {
             'timestamp': str(datetime.datetime.now()),
             'genomes': ','.join(genomes),
             'exclude': ','.join(exclude),
             'one_hot': str(one_hot),
             'keep_errors': str(keep_errors),
+            'chunk_size': str(chunk_size),
+            'split_coordinates': str(split_coordinates),
+            'x_encoding': self.x_encoding,
+            'label_encoding': self.label_encoding,
+            'layout': layout,
         }
-        for key, value in attrs.items():
-            if self.only_test_set:
-                self.h5_test.attrs[key] = value
-            else:
-                self.h5_train.attrs[key] = value
-                self.h5_val.attrs[key] = value
+        for h5_file in self._h5_files():
+            if self.append:
+                # everything but the genome selection has to stay the same when appending
+                for key in ['one_hot', 'keep_errors', 'chunk_size', 'split_coordinates',
+                            'x_encoding', 'label_encoding', 'layout']:
+                    if key in h5_file.attrs and h5_file.attrs[key] != attrs[key]:
+                        raise ValueError('Can not append to {}, {} was {} and is now {}'.format(
+                            h5_file.filename, key, h5_file.attrs[key], attrs[key]))
+                # an empty genome list means all genomes
+                if h5_file.attrs.get('genomes') and attrs['genomes']:
+                    previous = h5_file.attrs['genomes'].split(',')
+                    attrs['genomes'] = ','.join(previous + [g for g in genomes if g not in previous])
+                else:
+                    attrs['genomes'] = ''
+            for key, value in attrs.items():
+                h5_file.attrs[key] = value
+            # so the file is valid and can be appended to, even if nothing else is ever written
+            h5_file.flush()
+
+    def _finished_coord_ids(self, split_coordinates):
+        """Returns the ids of the coordinates that were completely written in a previous run and
+        truncates the files to exactly those. When sequences are split a coordinate is only
+        finished once it is in the manifests of both files."""
+        manifests = [writer.manifest_coord_ids() for writer in self.writers.values()]
+        if split_coordinates:
+            finished = set.union(*manifests)
+        else:
+            finished = set.intersection(*manifests)
+        for writer in self.writers.values():
+            writer.drop_unfinished(finished)
+        return finished
+
+    def _load_gc_contents(self, genome_ids):
+        """Bulk loads the gc content (the count of the collapsed 'C' mer) of all coordinates of
+        the given genomes with one query per genome into a dict of coordinate id to count"""
+        gc_contents = {}
+        for genome_id in genome_ids:
+            # need to hijack the session from geenuff_exporter as the Mer table does not exist there
+            query = (self.geenuff_exporter.session.query(Mer.coordinate_id, Mer.count)
+                         .join(Coordinate, Mer.coordinate_id == Coordinate.id)
+                         .filter(Coordinate.genome_id == genome_id)
+                         .filter(Mer.mer_sequence == 'C'))
+            gc_contents.update(query.all())
+            self.n_mer_queries += 1
+        return gc_contents
+
+    def _writer_totals(self):
+        """The seconds all writers spent writing and the bytes added to them so far"""
+        return (sum([writer.write_seconds for writer in self.writers.values()]),
+                sum([writer.bytes_added for writer in self.writers.values()]))
 
     def _close_files(self):
+        # write what is left in the buffers
+        for writer in self.writers.values():
+            writer.flush()
+        # so the readers don't have to scan the whole files on every start
+        for h5_file in self._h5_files():
+            if data_layout(h5_file) == 'chunked':
+                write_summary(h5_file)
         if self.only_test_set:
             self.h5_test.close()
         else:
             self.h5_train.close()
             self.h5_val.close()
 
-    def _numerify_coord(self, coord, coord_features, chunk_size, one_hot, keep_errors):
-        list_in_list_out = ['inputs', 'labels', 'label_masks', 'start_ends']
-        one_in_list_out = ['gc_contents', 'coord_lengths', 'species', 'seqids']
-        # will pre-organize all data and metadata to have one entry per chunk in flat_data below
+    @staticmethod
+    def _empty_flat_data():
+        # will pre-organize all data and metadata to have one entry per chunk
         flat_data = {}
-        for key in list_in_list_out + one_in_list_out:
+        for key in HelixerExportController.list_in_list_out + HelixerExportController.one_in_list_out:
             flat_data[key] = []
+        return flat_data
 
+    @staticmethod
+    def _coord_info(coord, coord_features):
+        """what is needed of a coordinate for the print out after it was numerified"""
+        return {
+            'name': str(coord),
+            'species': coord.genome.species,
+            'seqid': coord.seqid,
+            'n_features': len(coord_features),
+            'length': coord.length,
+        }
+
+    @staticmethod
+    def _numerify_coord(geenuff_exporter, coord, coord_features, chunk_size, one_hot, keep_errors,
+                        max_chunks=0, gc_contents=None, timings=None, parts=None):
+        """Generator that yields the numerified chunks of both strands of a coordinate as flat_data,
+        together with the amount of masked and intergenic bases in them.
+        If max_chunks is 0 everything is yielded at once, otherwise the chunks are numerified and
+        yielded in groups of at most max_chunks, so huge coordinates never have to be fully
+        held in memory. With max_chunks, parts can limit this to a list of
+        (is_plus_strand, first, last) chunk ranges, see _coord_parts()."""
+        flat_data = HelixerExportController._empty_flat_data()
         n_masked_bases, n_intergenic_bases = 0, 0
-        for is_plus_strand in [True, False]:
-            numerifier = CoordNumerifier(self.geenuff_exporter, coord, coord_features, is_plus_strand,
-                                         chunk_size, one_hot)
-            coord_data = numerifier.numerify()
-            # keep track of variables
-            n_masked_bases += sum(
-                [np.count_nonzero(m == 0) for m in coord_data['label_masks']])
-            if one_hot:
-                n_intergenic_bases += sum([np.count_nonzero(l[:, 0] == 1) for l in coord_data['labels']])
+        # the sequence is only encoded once for both strands
+        # the chunks that are completely masked as error are already dropped by the numerifier
+        numerifier = CoordNumerifier(geenuff_exporter, coord, coord_features, chunk_size, one_hot,
+                                     gc_contents=gc_contents, timings=timings,
+                                     keep_errors=keep_errors)
+        if parts is None:
+            parts = [(True, 0, None), (False, 0, None)]
+        else:
+            assert max_chunks, 'a coordinate can only be numerified in parts with max_chunks'
+        for is_plus_strand, first, last in parts:
+            if max_chunks:
+                strand_batches = numerifier.numerify_in_batches(is_plus_strand, max_chunks, first,
+                                                                last)
             else:
-                n_intergenic_bases += sum(
-                    [np.count_nonzero(np.all(l == 0, axis=1)) for l in coord_data['labels']])
-            # filter out sequences that are completely masked as error
-            if not keep_errors:
-                valid_data = [s.any() for s in coord_data['label_masks']]
-                for key in list_in_list_out:
-                    coord_data[key] = list(compress(coord_data[key], valid_data))
-            # add data
-            for key in list_in_list_out:
-                flat_data[key] += coord_data[key]
-            for key in one_in_list_out:
-                flat_data[key] += [coord_data[key]] * len(coord_data['inputs'])
-        masked_bases_percent = n_masked_bases / (coord.length * 2) * 100
-        intergenic_bases_percent = n_intergenic_bases / (coord.length * 2) * 100
-        return flat_data, coord, masked_bases_percent, intergenic_bases_percent
-
-    def export(self, chunk_size, genomes, exclude, val_size, one_hot, split_coordinates, keep_errors):
+                strand_batches = [numerifier.numerify(is_plus_strand)]
+            for coord_data in strand_batches:
+                # keep track of variables
+                n_masked_bases += coord_data['n_masked_bases']
+                n_intergenic_bases += coord_data['n_intergenic_bases']
+                # add data
+                for key in HelixerExportController.list_in_list_out:
+                    flat_data[key] += coord_data[key]
+                for key in HelixerExportController.one_in_list_out:
+                    flat_data[key] += [coord_data[key]] * len(coord_data['inputs'])
+                # pass on full groups of chunks
+                while max_chunks and len(flat_data['inputs']) >= max_chunks:
+                    out = {key: values[:max_chunks] for key, values in flat_data.items()}
+                    flat_data = {key: values[max_chunks:] for key, values in flat_data.items()}
+                    yield out, n_masked_bases, n_intergenic_bases
+                    n_masked_bases, n_intergenic_bases = 0, 0
+        # the last yield can be empty but always passes on the remaining counts
+        yield flat_data, n_masked_bases, n_intergenic_bases
+
+    @staticmethod
+    def _coord_parts(coord_len, chunk_size, max_chunks):
+        """Splits both strands of a coordinate into (is_plus_strand, first, last) ranges of at most
+        max_chunks chunks in the order of the export, which the workers numerify one at a time"""
+        n_chunks = len(list(Stepper(end=coord_len, by=chunk_size).step_to_end()))
+        return [(is_plus_strand, first, min(first + max_chunks, n_chunks))
+                for is_plus_strand in [True, False] for first in range(0, n_chunks, max_chunks)]
+
+    @staticmethod
+    def _feature_records(genome_coord_features):
+        """Replaces the Feature objects of the genome_query() output by FeatureRecord"""
+        return {genome_id: {coord_key: [FeatureRecord(f.start, f.end, f.is_plus_strand, f.type)
+                                        for f in features]
+                            for coord_key, features in coord_features.items()}
+                for genome_id, coord_features in genome_coord_features.items()}
+
+    def _coord_records(self, coord_keys, max_batch_bp=10 ** 8, max_batch_coords=500):
+        """Yields a CoordRecord for each (coord_id, coord_len) of coord_keys in the same order.
+        They are loaded in batches of up to max_batch_bp bases and max_batch_coords coordinates
+        with one query each, instead of lazily loading everything coordinate by coordinate."""
+        batch, batch_bp = [], 0
+        coord_keys = list(coord_keys)
+        for i, (coord_id, coord_len) in enumerate(coord_keys):
+            batch.append(coord_id)
+            batch_bp += coord_len
+            if batch_bp >= max_batch_bp or len(batch) >= max_batch_coords or i == len(coord_keys) - 1:
+                start = time.perf_counter()
+                coords = _query_coord_records(self.geenuff_exporter.session, batch)
+                if self.stats is not None:
+                    self.stats.add_seconds('db_fetch', time.perf_counter() - start,
+                                           coords[batch[0]].genome.species)
+                for batch_coord_id in batch:
+                    yield coords[batch_coord_id]
+                batch, batch_bp = [], 0
+
+    def _numerified_coords(self, genome_coord_features, numerify_args, workers, encode_args=None):
+        """Yields (coord_id, coord_info, numerify_outputs, cache_key) for all coordinates in their
+        original order, either numerified here one after another or by a pool of worker processes.
+        Unless encode_args is None the numerify_outputs are already turned into the arrays of the
+        /data group (see _encoded_outputs()), by the workers in a parallel export.
+        Each worker opens its own read only db session and gets the features as FeatureRecord.
+        With max_chunks the coordinates are split into parts of at most max_chunks chunks for the
+        workers (see _coord_parts()), so the results waiting for the writer are bounded by chunks
+        and not by the length of the coordinates.
+        With a cache the coordinates that are already in it are not numerified at all and
+        numerify_outputs is None for them. Without a cache the cache_key is always None.
+        The coordinates are loaded in bulk as CoordRecord and the session is cleared after
+        each genome, so nothing accumulates in it."""
+        if workers <= 1:
+            for coord_features_by_key in genome_coord_features.values():
+                coords = self._coord_records(coord_features_by_key.keys())
+                for coord, coord_features in zip(coords, coord_features_by_key.values()):
+                    timings = defaultdict(float) if self.stats is not None else None
+                    numerify_outputs, cache_key = self._numerify_or_cache(coord, coord_features,
+                                                                          numerify_args, timings)
+                    if numerify_outputs is not None and encode_args is not None:
+                        numerify_outputs = self._encoded_outputs(numerify_outputs, timings=timings,
+                                                                 **encode_args)
+                    coord_info = self._coord_info(coord, coord_features)
+                    coord_info['timings'] = timings
+                    yield coord.id, coord_info, numerify_outputs, cache_key
+                self.geenuff_exporter.session.expunge_all()
+            return
+
+        with multiprocessing.Pool(workers, initializer=_init_numerify_worker,
+                                  initargs=(self.db_path_in,)) as pool:
+            parts = self._submitted_parts(pool, genome_coord_features, numerify_args, encode_args)
+            # results are passed on strictly in order, and only the results of a bounded amount
+            # of parts are kept waiting for the writer
+            pending = deque(islice(parts, 2 * workers))
+            while pending:
+                coord_id, cache_key, coord_info, result, _ = pending[0]
+                if result is None:
+                    pending.popleft()
+                    pending.extend(islice(parts, 1))
+                    numerify_outputs = None
+                else:
+                    coord_info = result.get()[0]
+                    numerify_outputs = self._pending_outputs(pending, parts, coord_info)
+                del result
+                yield coord_id, coord_info, numerify_outputs, cache_key
+
+    def _submitted_parts(self, pool, genome_coord_features, numerify_args, encode_args):
+        """Submits the parts of the coordinates to the pool one at a time in their original order
+        and yields (coord_id, cache_key, coord_info, async_result, is_last_part) for each.
+        For coordinates that are in the cache there is a single entry without an async_result
+        and coord_info is only known after the first part of a coordinate is numerified."""
+        for coord_features_by_key in genome_coord_features.values():
+            if self.cache is not None:
+                # the sequences are needed for the cache keys
+                coords = self._coord_records(coord_features_by_key.keys())
+            else:
+                coords = [None] * len(coord_features_by_key)
+            for (coord_id, coord_len), coord in zip(coord_features_by_key.keys(), coords):
+                coord_features = coord_features_by_key[(coord_id, coord_len)]
+                cache_key = None
+                if coord is not None:
+                    cache_key = self._cache_key(coord, coord_features, numerify_args)
+                # pinned, as the stores of the coordinates before it could evict it otherwise
+                if cache_key is not None and self.cache.pin(cache_key):
+                    # nothing for the workers to do, but still passed on in order
+                    yield coord_id, cache_key, self._coord_info(coord, coord_features), None, True
+                    continue
+                gc_contents = {c_id: self.gc_contents[c_id] for c_id in [coord_id]
+                               if c_id in self.gc_contents}
+                if numerify_args['max_chunks']:
+                    coord_parts = self._coord_parts(coord_len, numerify_args['chunk_size'],
+                                                    numerify_args['max_chunks'])
+                else:
+                    coord_parts = [None]
+                for i, part in enumerate(coord_parts):
+                    timings = defaultdict(float) if self.stats is not None else None
+                    task = (coord_id, coord_features,
+                            dict(numerify_args, gc_contents=gc_contents, timings=timings),
+                            part, encode_args)
+                    yield (coord_id, cache_key, None, pool.apply_async(_numerify_in_worker, (task,)),
+                           i == len(coord_parts) - 1)
+            self.geenuff_exporter.session.expunge_all()
+
+    @staticmethod
+    def _pending_outputs(pending, parts, coord_info):
+        """Yields the outputs of all parts of the coordinate at the front of pending, submitting the
+        next part for each one that is taken out. The timings of the parts are added to the
+        ones in coord_info, which come from the first part."""
+        is_last_part, is_first_part = False, True
+        while not is_last_part:
+            _, _, _, result, is_last_part = pending.popleft()
+            pending.extend(islice(parts, 1))
+            part_info, numerify_outputs = result.get()
+            if coord_info['timings'] is not None and not is_first_part:
+                for stage, seconds in part_info['timings'].items():
+                    coord_info['timings'][stage] += seconds
+            is_first_part = False
+            # so the outputs of this part can be freed once they are written
+            del result, part_info
+            while numerify_outputs:
+                yield numerify_outputs.pop(0)
+
+    def _numerify_or_cache(self, coord, coord_features, numerify_args, timings=None):
+        """Returns (numerify_outputs, cache_key), numerify_outputs is None when the coordinate
+        is already in the cache"""
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self._cache_key(coord, coord_features, numerify_args)
+            if self.cache.pin(cache_key):
+                return None, cache_key
+        numerify_outputs = self._numerify_coord(self.geenuff_exporter, coord, coord_features,
+                                                gc_contents=self.gc_contents, timings=timings,
+                                                **numerify_args)
+        return numerify_outputs, cache_key
+
+    def export(self, chunk_size, genomes, exclude, val_size, one_hot, split_coordinates, keep_errors,
+               max_chunks=0, workers=1, seed=None, x_encoding='float16',
+               label_encoding='int8', write_buffer_mb=256, rows_per_chunk=1, compression='lzf',
+               compression_level=None, cache_dir=None, cache_size_mb=10000, contiguous=False,
+               stats=False):
+        """Numerifies and saves all selected coordinates. The output only depends on the seed
+        (if given) and not on the number of worker processes, as everything random happens here
+        in the main process in the order of the coordinates.
+        With a cache_dir the encoded chunks of each coordinate are kept in a CoordCache and
+        copied from there in later exports with the same parameters.
+        With contiguous each coordinate strand is stored as a whole (see ContiguousH5Writer),
+        and chunk_size is only the amount of bases numerified at once. Erroneous bases are
+        always kept, as the chunks are only cut when the data is read.
+        With stats the time spent in each export stage is measured (see ExportStats) and
+        written to export_stats.json next to the h5 files."""
+        if x_encoding not in X_ENCODINGS:
+            raise ValueError('Unknown x_encoding {}, choose from {}'.format(x_encoding, X_ENCODINGS))
+        self.x_encoding = x_encoding
+        if label_encoding not in LABEL_ENCODINGS:
+            raise ValueError('Unknown label_encoding {}, choose from {}'.format(label_encoding,
+                                                                                LABEL_ENCODINGS))
+        if label_encoding == 'compact' and not one_hot:
+            raise ValueError('The compact label encoding can only be used for one-hot labels')
+        self.label_encoding = label_encoding
+        if contiguous and not (split_coordinates or self.only_test_set):
+            raise ValueError('Sequences can only be split when they are exported as chunks')
+        if contiguous and (self.append or cache_dir is not None):
+            raise ValueError('Contiguous exports can not be appended to or cached')
+        random_state = np.random.RandomState(seed)
+        if stats:
+            self.stats = ExportStats()
+        if cache_dir is not None:
+            self.cache = CoordCache(cache_dir, max_size_mb=cache_size_mb)
+        writer_args = {
+            'max_buffer_mb': write_buffer_mb,
+            'rows_per_chunk': rows_per_chunk,
+            'compression': compression,
+            'compression_level': compression_level,
+        }
+        if contiguous:
+            writer_cls, layout = ContiguousH5Writer, 'contiguous'
+            del writer_args['rows_per_chunk']
+        else:
+            writer_cls, layout = BufferedH5Writer, 'chunked'
+        if self.only_test_set:
+            self.writers = {'test': writer_cls(self.h5_test, **writer_args)}
+        else:
+            self.writers = {'train': writer_cls(self.h5_train, **writer_args),
+                            'val': writer_cls(self.h5_val, **writer_args)}
+        self._add_data_attrs(genomes, exclude, one_hot, keep_errors, chunk_size, split_coordinates,
+                             layout)
+        start = time.perf_counter()
         genome_coord_features = self.geenuff_exporter.genome_query(genomes, exclude)
+        if self.stats is not None:
+            self.stats.add_seconds('db_fetch', time.perf_counter() - start)
+        # only keep plain records of the features, and not the orm objects in the session
+        genome_coord_features = self._feature_records(genome_coord_features)
+        self.geenuff_exporter.session.expunge_all()
         # make version without features for shorter downstream code
         genome_coords = {g_id: list(values.keys()) for g_id, values in genome_coord_features.items()}
+        if split_coordinates:
+            # done before skipping finished coordinates, so the same seed gives the same split
+            train_coords, val_coords = self._split_coords_by_N90(genome_coords, val_size, random_state)
+        if self.append:
+            finished_coord_ids = self._finished_coord_ids(split_coordinates)
+            for g_id, coord_features in genome_coord_features.items():
+                genome_coord_features[g_id] = {key: features for key, features in coord_features.items()
+                                               if key[0] not in finished_coord_ids}
+            genome_coords = {g_id: list(values.keys())
+                             for g_id, values in genome_coord_features.items()}
+            print('\n{} coordinates were already exported and are skipped'.format(
+                len(finished_coord_ids)))
         n_coords = sum([len(coords) for genome_id, coords in genome_coords.items()])
         print('\n{} coordinates chosen to numerify'.format(n_coords))
-        if split_coordinates:
-            train_coords, val_coords = self._split_coords_by_N90(genome_coords, val_size)
+        start = time.perf_counter()
+        self.gc_contents = self._load_gc_contents(genome_coords.keys())
+        if self.stats is not None:
+            self.stats.add_seconds('mer_lookup', time.perf_counter() - start)
 
         n_coords_done = 1
+        n_skipped_bases_total = 0
         n_y_cols = 4 if one_hot else 3
-        for genome_id, coords in genome_coords.items():
-            for (coord_id, coord_len) in coords:
-                coord = self.geenuff_exporter.get_coord_by_id(coord_id)
-                coord_features = genome_coord_features[genome_id][(coord_id, coord_len)]
-                numerify_outputs = self._numerify_coord(coord, coord_features, chunk_size, one_hot,
-                                                        keep_errors)
-                flat_data, coord, masked_bases_percent, intergenic_bases_percent = numerify_outputs
+        numerify_args = {
+            'chunk_size': chunk_size,
+            'one_hot': one_hot,
+            'keep_errors': keep_errors or contiguous,
+            'max_chunks': max_chunks,
+        }
+        if contiguous:
+            # the flat data is written base by base, see _write_contiguous_coord()
+            encode_args = None
+        else:
+            encode_args = {
+                'chunk_size': chunk_size,
+                'n_y_cols': n_y_cols,
+                'x_encoding': self.x_encoding,
+                'label_encoding': self.label_encoding,
+            }
+        numerified_coords = self._numerified_coords(genome_coord_features, numerify_args, workers,
+                                                    encode_args)
+        for coord_id, coord_info, numerify_outputs, cache_key in numerified_coords:
+            if split_coordinates:
+                assigned_set = 'train' if coord_id in train_coords else 'val'
+            elif self.only_test_set:
+                assigned_set = 'test'
+            n_chunks, n_train_chunks, n_val_chunks = 0, 0, 0
+            n_masked_bases, n_intergenic_bases, n_exported_bases = 0, 0, 0
+            timings = coord_info.get('timings')
+            if self.stats is not None and timings is None:
+                # coordinates copied from the cache were not numerified
+                timings = defaultdict(float)
+            write_seconds, bytes_added = self._writer_totals()
+            if contiguous:
+                # written as a whole, there are no chunks to pass on
+                start = time.perf_counter()
+                n_chunks, n_masked_bases, n_intergenic_bases = self._write_contiguous_coord(
+                    self.writers[assigned_set], coord_id, numerify_outputs, one_hot)
+                if timings is not None:
+                    # the time not spent writing was spent encoding
+                    timings['encode'] += (time.perf_counter() - start
+                                          - (self._writer_totals()[0] - write_seconds))
+                coord_outputs = []
+            elif numerify_outputs is None:
+                coord_outputs = self.cache.load(cache_key, max_chunks)
+            else:
+                coord_outputs = numerify_outputs
+                if cache_key is not None:
+                    coord_outputs = self.cache.store(cache_key, coord_outputs)
+            for arrays, n_masked, n_intergenic in coord_outputs:
+                n_masked_bases += n_masked
+                n_intergenic_bases += n_intergenic
+                if arrays is None:
+                    continue
+                n_chunks += len(arrays['X'])
+                n_exported_bases += int(np.sum(np.abs(np.diff(arrays['start_ends'], axis=1))))
+                if numerify_outputs is None:
+                    arrays = self._add_coord_metadata(arrays, coord_id, coord_info)
                 if split_coordinates or self.only_test_set:
-                    if split_coordinates:
-                        if coord_id in train_coords:
-                            self._save_data(self.h5_train, flat_data, chunk_size, n_y_cols)
-                            assigned_set = 'train'
-                        else:
-                            self._save_data(self.h5_val, flat_data, chunk_size, n_y_cols)
-                            assigned_set = 'val'
-                    elif self.only_test_set:
-                        self._save_data(self.h5_test, flat_data, chunk_size, n_y_cols)
-                        assigned_set = 'test'
-                    print(('{}/{} Numerified {} of {} with {} features in {} chunks '
-                           'with an error rate of {:.2f}%, and intergenic rate of {:.2f}% ({})').format(
-                               n_coords_done, n_coords,  coord, coord.genome.species,
-                               len(coord.features), len(flat_data['inputs']), masked_bases_percent,
-                               intergenic_bases_percent, assigned_set))
+                    self.writers[assigned_set].add(arrays)
                 else:
                     # split sequences
-                    train_data, val_data = self._split_sequences(flat_data, val_size=val_size)
-                    if train_data['inputs']:
-                        self._save_data(self.h5_train, train_data, chunk_size, n_y_cols)
-                    if val_data['inputs']:
-                        self._save_data(self.h5_val, val_data, chunk_size, n_y_cols)
-                    print(('{}/{} Numerified {} of {} with {} features in {} chunks '
-                           '(train: {}, test: {}) with an error rate of {:.2f}% and an '
-                           'intergenic rate of {:.2f}%').format(
-                               n_coords_done, n_coords, coord, coord.genome.species,
-                               len(coord.features), len(flat_data['inputs']), len(train_data['inputs']),
-                               len(val_data['inputs']), masked_bases_percent, intergenic_bases_percent))
-                n_coords_done += 1
-                # free all datasets so we don't keep two all the time
-                dset_keys = list(flat_data.keys())
-                for key in dset_keys:
-                    del flat_data[key]
-
-        self._add_data_attrs(genomes, exclude, one_hot, keep_errors)
+                    train_arrays, val_arrays = self._split_sequences(arrays, val_size, random_state)
+                    self.writers['train'].add(train_arrays)
+                    self.writers['val'].add(val_arrays)
+                    n_train_chunks += len(train_arrays['X'])
+                    n_val_chunks += len(val_arrays['X'])
+            # only now the coordinate is complete in the files it can end up in,
+            # contiguous files have no manifest
+            if contiguous:
+                pass
+            elif split_coordinates or self.only_test_set:
+                self.writers[assigned_set].finish_coord(coord_id)
+            else:
+                for writer in self.writers.values():
+                    writer.finish_coord(coord_id)
+            # the bases of the dropped erroneous chunks, contiguous exports keep everything
+            n_skipped_bases = 0 if contiguous else coord_info['length'] * 2 - n_exported_bases
+            n_skipped_bases_total += n_skipped_bases
+            if self.stats is not None:
+                new_write_seconds, new_bytes_added = self._writer_totals()
+                timings['h5_write'] += new_write_seconds - write_seconds
+                self.stats.add_coord(coord_info['species'], coord_info['length'] * 2, n_chunks,
+                                     new_bytes_added - bytes_added, timings, n_skipped_bases)
+
+            masked_bases_percent = n_masked_bases / (coord_info['length'] * 2) * 100
+            intergenic_bases_percent = n_intergenic_bases / (coord_info['length'] * 2) * 100
+            if split_coordinates or self.only_test_set:
+                print(('{}/{} Numerified {} of {} with {} features in {} chunks '
+                       'with an error rate of {:.2f}%, and intergenic rate of {:.2f}% ({})').format(
+                           n_coords_done, n_coords, coord_info['name'], coord_info['species'],
+                           coord_info['n_features'], n_chunks, masked_bases_percent,
+                           intergenic_bases_percent, assigned_set))
+            else:
+                print(('{}/{} Numerified {} of {} with {} features in {} chunks '
+                       '(train: {}, test: {}) with an error rate of {:.2f}% and an '
+                       'intergenic rate of {:.2f}%').format(
+                           n_coords_done, n_coords, coord_info['name'], coord_info['species'],
+                           coord_info['n_features'], n_chunks, n_train_chunks,
+                           n_val_chunks, masked_bases_percent, intergenic_bases_percent))
+            n_coords_done += 1
+
+        # the last flush happens when closing the files
+        write_seconds = self._writer_totals()[0]
+        h5_paths = [h5_file.filename for h5_file in self._h5_files()]
         self._close_files()
+        if self.stats is not None:
+            self.stats.add_seconds('h5_write', self._writer_totals()[0] - write_seconds)
+            file_bytes = {os.path.basename(path): os.path.getsize(path) for path in h5_paths}
+            report = self.stats.write(os.path.join(self.data_dir, 'export_stats.json'), file_bytes)
+        n_block_writes = sum([writer.n_block_writes for writer in self.writers.values()])
+        print('\nExported {} coordinates of {} genomes, the gc contents of {} coordinates were '
+              'loaded with {} queries, the data was written in {} blocks'.format(
+                  n_coords, len(genome_coords), len(self.gc_contents), self.n_mer_queries,
+                  n_block_writes))
+        if not keep_errors and not contiguous:
+            print('{} bases in chunks that were completely masked as error were skipped without '
+                  'encoding their sequence'.format(n_skipped_bases_total))
+        if self.cache is not None:
+            print('{} coordinates were copied from the cache and {} were numerified and added to it, '
+                  '{} entries were evicted'.format(self.cache.hits, self.cache.misses,
+                                                   self.cache.evictions))
+        if self.stats is not None:
+            ExportStats.print_summary(report)
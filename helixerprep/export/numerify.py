@@ -1,57 +1,73 @@
 """convert cleaned-db schema to numeric values describing gene structure"""
 
+import time
 import numpy as np
 import logging
+from itertools import compress
 from abc import ABC, abstractmethod
 from sqlalchemy.orm.exc import NoResultFound
 
 from geenuff.base import types
 from geenuff.base.orm import Coordinate, Genome
 from ..core.orm import Mer
-
-
-AMBIGUITY_DECODE = {
-    'C': [1., 0., 0., 0.],
-    'A': [0., 1., 0., 0.],
-    'T': [0., 0., 1., 0.],
-    'G': [0., 0., 0., 1.],
-    'Y': [0.5, 0., 0.5, 0.],
-    'R': [0., 0.5, 0., 0.5],
-    'W': [0., 0.5, 0.5, 0.],
-    'S': [0.5, 0., 0., 0.5],
-    'K': [0., 0., 0.5, 0.5],
-    'M': [0.5, 0.5, 0., 0.],
-    'D': [0., 0.33, 0.33, 0.33],
-    'V': [0.33, 0.33, 0., 0.33],
-    'H': [0.33, 0.33, 0.33, 0.],
-    'B': [0.33, 0., 0.33, 0.33],
-    'N': [0.25, 0.25, 0.25, 0.25]
-}
-
-
-class Stepper(object):
-    def __init__(self, end, by):
-        self.at = 0
-        self.end = end
-        self.by = by
-
-    def step(self):
-        prev = self.at
-        # fits twice or more, just step
-        if prev + self.by * 2 <= self.end:
-            new = prev + self.by
-        # fits less than twice, take half way point (to avoid an end of just a few bp)
-        elif prev + self.by < self.end:
-            new = prev + (self.end - prev) // 2
-        # doesn't fit at all
-        else:
-            new = self.end
-        self.at = new
-        return prev, new
-
-    def step_to_end(self):
-        while self.at < self.end:
-            yield self.step()
+from ..core.helpers import AMBIGUITY_DECODE, BASE_CODE_DECODE, Stepper
+
+
+# lookup tables indexed by the ASCII code of a base, so whole sequences can be encoded at once
+AMBIGUITY_LOOKUP = np.zeros((256, 4), dtype=np.float16)
+VALID_BASES = np.zeros((256,), dtype=bool)
+for _bp, _encoding in AMBIGUITY_DECODE.items():
+    AMBIGUITY_LOOKUP[ord(_bp)] = _encoding
+    VALID_BASES[ord(_bp)] = True
+del _bp, _encoding
+# the minus strand encoding is just the plus strand encoding with the base columns inverted
+AMBIGUITY_LOOKUP_MINUS = np.ascontiguousarray(np.flip(AMBIGUITY_LOOKUP, axis=1))
+
+
+def encode_sequence(sequence, is_plus_strand=True):
+    """Encodes a whole sequence string into a (len(sequence), 4) float16 matrix in one
+    vectorized table lookup. Bases are complemented but not reversed for the minus strand."""
+    codes = np.frombuffer(sequence.encode('ASCII'), dtype=np.uint8)
+    valid = VALID_BASES[codes]
+    if not np.all(valid):
+        unknown = bytes(np.unique(codes[~valid])).decode('ASCII')
+        raise ValueError('Unknown base(s) found in sequence: {}'.format(unknown))
+    lookup = AMBIGUITY_LOOKUP if is_plus_strand else AMBIGUITY_LOOKUP_MINUS
+    # np.take is considerably faster than fancy indexing for row gathers like this
+    return np.take(lookup, codes, axis=0)
+
+
+# the float16 rows of the decode table packed into one uint64 each, sorted for searchsorted
+_PACKED_BASE_ROWS = BASE_CODE_DECODE.view(np.uint64).ravel()
+_PACKED_ROW_ORDER = np.argsort(_PACKED_BASE_ROWS)
+_SORTED_PACKED_ROWS = _PACKED_BASE_ROWS[_PACKED_ROW_ORDER]
+
+
+def encode_base_codes(matrix):
+    """Converts a float16 matrix of shape (..., 4) as it comes out of the SequenceNumerifier
+    (including zero padding) into uint8 base codes of shape (...). Rows are matched as a whole
+    by viewing their 4 float16 values as one uint64. The complement of every code is a code
+    as well, so this works for both strands."""
+    matrix = np.ascontiguousarray(matrix, dtype=np.float16)
+    packed = matrix.view(np.uint64)[..., 0]
+    idx = np.clip(np.searchsorted(_SORTED_PACKED_ROWS, packed), 0, len(_SORTED_PACKED_ROWS) - 1)
+    if not np.all(_SORTED_PACKED_ROWS[idx] == packed):
+        raise ValueError('Matrix contains rows that are not a base encoding')
+    return _PACKED_ROW_ORDER[idx].astype(np.uint8)
+
+
+def encode_class_indexes(labels):
+    """Converts one-hot int8 labels of shape (..., 4) into uint8 class indexes of shape (...),
+    where 0 is kept for the all zero padding rows and the classes follow as 1-4"""
+    if not np.all(np.sum(labels, axis=-1) <= 1):
+        raise ValueError('Class indexes can only be stored for one-hot labels')
+    return np.dot(labels, np.arange(1, 5, dtype=np.int8)).astype(np.uint8)
+
+
+def pack_sample_weights(sample_weights):
+    """Bit-packs 0/1 sample weights of shape (..., chunk_size) into uint8 of
+    shape (..., ceil(chunk_size / 8))"""
+    return np.packbits(sample_weights.astype(bool), axis=-1)
 
 
 class Numerifier(ABC):
@@ -72,6 +88,11 @@ class Numerifier(ABC):
     def _unflipped_coord_to_matrix(self):
         pass
 
+    @abstractmethod
+    def range_to_matrices(self, start, end):
+        """Returns the (unflipped) matrix and error mask of only the bases [start, end)"""
+        pass
+
     def _gen_steps(self):
         partitioner = Stepper(end=self.coord.length, by=self.max_len)
         self.paired_steps = list(partitioner.step_to_end())
@@ -96,27 +117,72 @@ class Numerifier(ABC):
             error_masks.append(error_mask_slice)
         return data, error_masks
 
-    def _zero_matrix(self):
-        length = len(self.coord.sequence)
-        self.matrix = np.zeros((length, self.n_cols,), self.dtype)
-        # 0 means error so this can be used directly as sample weight later on
-        self.error_mask = np.ones((length,), np.int8)
+    def chunk_matrices(self, i):
+        """The data and error mask of only the i-th chunk of paired_steps"""
+        prev, current = self.paired_steps[i]
+        data_slice, error_mask_slice = self.range_to_matrices(prev, current)
+        if not self.is_plus_strand:
+            # invert directions
+            data_slice = np.flip(data_slice, axis=0)
+            error_mask_slice = np.flip(error_mask_slice, axis=0)
+        return data_slice, error_mask_slice
+
+    def iter_chunk_matrices(self):
+        """Streaming version of coord_to_matrices(). Yields the data and error mask of one chunk
+        at a time, each encoded for only the bases it covers, so the full length matrix
+        is never allocated."""
+        for i in range(len(self.paired_steps)):
+            yield self.chunk_matrices(i)
 
 
 class SequenceNumerifier(Numerifier):
-    def __init__(self, coord, is_plus_strand, max_len):
+    def __init__(self, coord, is_plus_strand, max_len, plus_strand=None):
+        """plus_strand can be the SequenceNumerifier of the plus strand of the same coordinate,
+        in which case the minus strand is derived as view of its matrix instead of encoding
+        the sequence a second time"""
+        assert plus_strand is None or (plus_strand.is_plus_strand and not is_plus_strand)
+        self.plus_strand = plus_strand
         super().__init__(n_cols=4, coord=coord, is_plus_strand=is_plus_strand,
                          max_len=max_len, dtype=np.float16)
 
     def _unflipped_coord_to_matrix(self):
         """Does not alter the error mask unlike in AnnotationNumerifier"""
-        self._zero_matrix()
-        for i, bp in enumerate(self.coord.sequence):
-            self.matrix[i] = AMBIGUITY_DECODE[bp]
-        if not self.is_plus_strand:
-            self.matrix = np.flip(self.matrix, axis=1)  # invert base
+        if self.plus_strand is not None:
+            if self.plus_strand.matrix is None:
+                self.plus_strand._unflipped_coord_to_matrix()
+            # the complement is just the plus strand with the base columns inverted
+            self.matrix = np.flip(self.plus_strand.matrix, axis=1)
+            self.error_mask = self.plus_strand.error_mask
+        else:
+            self.matrix = encode_sequence(self.coord.sequence, self.is_plus_strand)
+            self.error_mask = np.ones((self.matrix.shape[0],), np.int8)
         return self.matrix
 
+    def range_to_matrices(self, start, end):
+        matrix = encode_sequence(self.coord.sequence[start:end], self.is_plus_strand)
+        return matrix, np.ones((matrix.shape[0],), np.int8)
+
+    def window_chunk_matrices(self, indexes):
+        """The data of the chunks of paired_steps at the sorted indexes. Each run of consecutive
+        chunks covers one window of bases, which is encoded at once and then cut into the chunks
+        as views like in coord_to_matrices()"""
+        data = []
+        indexes = np.asarray(indexes, dtype=np.int64)
+        for run in np.split(indexes, np.flatnonzero(np.diff(indexes) != 1) + 1):
+            if not len(run):
+                continue
+            steps = [self.paired_steps[i] for i in run]
+            # the steps of the minus strand are reversed
+            start = min(steps[0][0], steps[-1][0])
+            end = max(steps[0][1], steps[-1][1])
+            window, _ = self.range_to_matrices(start, end)
+            for prev, current in steps:
+                data_slice = window[prev - start:current - start]
+                if not self.is_plus_strand:
+                    data_slice = np.flip(data_slice, axis=0)
+                data.append(data_slice)
+        return data
+
 
 class AnnotationNumerifier(Numerifier, ABC):
     """Base class for numerification of the labels. Outputs a matrix that
@@ -130,15 +196,21 @@ class AnnotationNumerifier(Numerifier, ABC):
         self.features = features
 
     def _unflipped_coord_to_matrix(self):
-        self._zero_matrix()
         self.update_matrix_and_error_mask()
 
     @abstractmethod
     def update_matrix_and_error_mask(self):
+        """Has to set both self.matrix and self.error_mask for the whole coordinate,
+        where an error mask value of 0 means error so it can be used directly as sample weight"""
         pass
 
 
 class BasePairAnnotationNumerifier(AnnotationNumerifier):
+    """Encodes the labels from the sorted feature intervals instead of filling a dense per
+    column matrix. The coordinate is cut at every feature boundary into segments, for which the
+    label and error state is constant. The output rows are then written in one go per segment,
+    so the peak memory stays at the size of the output.
+    """
     feature_to_col = {
         types.GeenuffFeature.geenuff_transcript: 0,
         types.GeenuffFeature.geenuff_cds: 1,
@@ -148,10 +220,17 @@ class BasePairAnnotationNumerifier(AnnotationNumerifier):
 
     def __init__(self, coord, features, is_plus_strand, max_len, one_hot):
         self.one_hot = one_hot
-        super().__init__(n_cols=3, coord=coord, features=features,
+        n_cols = 4 if one_hot else 3
+        super().__init__(n_cols=n_cols, coord=coord, features=features,
                          is_plus_strand=is_plus_strand, max_len=max_len)
-
-    def update_matrix_and_error_mask(self):
+        self.segment_bounds = None
+        self.segment_rows = None
+        self.segment_error_mask = None
+
+    def _feature_intervals(self):
+        """Sorts the features of this strand into half open [start, end) intervals for each of
+        the three label columns and the errors, returned as four (n, 2) arrays"""
+        intervals = [[] for _ in range(4)]
         for feature in self.features:
             # don't include features from the other strand
             if not feature.is_plus_strand == self.is_plus_strand:
@@ -162,85 +241,252 @@ class BasePairAnnotationNumerifier(AnnotationNumerifier):
                 start, end = end + 1, start + 1
             if feature.type in BasePairAnnotationNumerifier.feature_to_col.keys():
                 col = BasePairAnnotationNumerifier.feature_to_col[feature.type]
-                self.matrix[start:end, col] = 1
+                intervals[col].append((start, end))
             elif feature.type.value in BasePairAnnotationNumerifier.error_type_values:
-                self.error_mask[start:end] = 0
+                intervals[3].append((start, end))
             else:
                 raise ValueError('Unknown feature type found: {}'.format(feature.type.value))
+        out = []
+        for col_intervals in intervals:
+            arr = np.array(col_intervals, dtype=np.int64).reshape((-1, 2))
+            arr = np.clip(arr, 0, self.coord.length)
+            out.append(arr[arr[:, 0] < arr[:, 1]])
+        return out
+
+    def _gen_segments(self):
+        """Finds the state of each segment by counting the sorted interval starts and ends
+        up to the segment start. This is the same as a cumulative sum over a per base difference
+        array, but only evaluated at the segment boundaries."""
+        intervals = self._feature_intervals()
+        bounds = np.unique(np.concatenate([[0, self.coord.length]] + [i.ravel() for i in intervals]))
+        seg_starts = bounds[:-1]
+        covered = []
+        for arr in intervals:
+            n_open = (np.searchsorted(np.sort(arr[:, 0]), seg_starts, side='right')
+                      - np.searchsorted(np.sort(arr[:, 1]), seg_starts, side='right'))
+            covered.append(n_open > 0)
+        transcript, cds, intron, error = covered
 
-        # transform matrix into one-hot encoding for classical classification if desired
         if self.one_hot:
             # Class order: Intergenic, UTR, CDS, (non-coding Intron), Intron
-            # This could be done in a more efficient way, but this way we may catch bugs
-            # where non-standard classes are output in the multiclass output
-            one_hot_matrix = np.zeros((self.matrix.shape[0], 4), dtype=bool)
-            col_0, col_1, col_2 = self.matrix[:, 0], self.matrix[:, 1], self.matrix[:, 2]
-            # Intergenic
-            one_hot_matrix[:, 0] = np.logical_not(col_0)
-            # UTR
-            genic_non_coding = np.logical_and(col_0, np.logical_not(col_1))
-            one_hot_matrix[:, 1] = np.logical_and(genic_non_coding, np.logical_not(col_2))
-            # CDS
-            one_hot_matrix[:, 2] = np.logical_and(np.logical_and(col_0, col_1), np.logical_not(col_2))
-            # Introns
-            one_hot_matrix[:, 3] = np.logical_and(col_0, col_2)
-            self.matrix = one_hot_matrix.astype(np.int8)
-            # assert np.all(np.count_nonzero(self.matrix, axis=1) == 1)
+            classes = np.where(transcript, np.where(intron, 3, np.where(cds, 2, 1)), 0)
+            self.segment_rows = np.eye(4, dtype=np.int8)[classes]
+        else:
+            self.segment_rows = np.stack([transcript, cds, intron], axis=1).astype(np.int8)
+        self.segment_bounds = bounds
+        # 0 means error so this can be used directly as sample weight later on
+        self.segment_error_mask = np.logical_not(error).astype(np.int8)
+
+    def range_to_matrices(self, start, end):
+        """Returns the (unflipped) labels and error mask for the bases [start, end)
+        without encoding anything outside of that range"""
+        if self.segment_bounds is None:
+            self._gen_segments()
+        first = np.searchsorted(self.segment_bounds, start, side='right') - 1
+        last = np.searchsorted(self.segment_bounds, end, side='left')
+        seg_lengths = np.diff(np.clip(self.segment_bounds[first:last + 1], start, end))
+        matrix = np.repeat(self.segment_rows[first:last], seg_lengths, axis=0)
+        error_mask = np.repeat(self.segment_error_mask[first:last], seg_lengths)
+        return matrix, error_mask
+
+    def update_matrix_and_error_mask(self):
+        self.matrix, self.error_mask = self.range_to_matrices(0, self.coord.length)
+
+    def chunk_counts(self):
+        """Returns the amount of valid (not erroneous) and of intergenic bases in each chunk of
+        paired_steps, counted on the segments without encoding any of the chunks"""
+        if self.segment_bounds is None:
+            self._gen_segments()
+        if self.one_hot:
+            is_intergenic = self.segment_rows[:, 0] == 1
+        else:
+            is_intergenic = np.all(self.segment_rows == 0, axis=1)
+        seg_starts = self.segment_bounds[:-1]
+        seg_lengths = np.diff(self.segment_bounds)
+        steps = np.array(self.paired_steps, dtype=np.int64).reshape((-1, 2))
+        counts = []
+        for per_base in [self.segment_error_mask, is_intergenic]:
+            cumulative = np.concatenate([[0], np.cumsum(seg_lengths * per_base)])
+
+            def count_before(pos):
+                seg = np.clip(np.searchsorted(seg_starts, pos, side='right') - 1, 0, None)
+                return cumulative[seg] + (pos - seg_starts[seg]) * per_base[seg]
+
+            counts.append(count_before(steps[:, 1]) - count_before(steps[:, 0]))
+        return counts
 
 
 class CoordNumerifier(object):
     """Combines the different Numerifiers which need to operate on the same Coordinate
     to ensure consistent parameters.
     Currently just selects all Features of the given Coordinate.
+
+    Both strands are numerified from the same object: the sequence is only encoded once and
+    the minus strand chunks are reversed and complemented views of the plus strand matrix.
     """
-    def __init__(self, geenuff_exporter, coord, coord_features, is_plus_strand, max_len, one_hot):
-        assert isinstance(is_plus_strand, bool)
+    def __init__(self, geenuff_exporter, coord, coord_features, max_len, one_hot, gc_contents=None,
+                 timings=None, keep_errors=True):
+        """gc_contents can be a dict of coordinate id to gc content that was preloaded in bulk,
+        otherwise the gc content is queried for this coordinate alone.
+        timings can be a dict (with default 0), to which the seconds spent numerifying the
+        sequence and the annotation and looking up the gc content are added.
+        Without keep_errors the chunks that are completely masked as error are dropped, which
+        is decided on the annotation before their sequence is encoded."""
         assert isinstance(max_len, int) and max_len > 0
         self.geenuff_exporter = geenuff_exporter
         self.coord = coord
+        self.gc_contents = gc_contents
+        self.gc_content = None
+        self.timings = timings
+        self.keep_errors = keep_errors
 
         if not coord_features:
             logging.warning('Sequence {} has no annoations'.format(self.coord.seqid))
 
-        self.anno_numerifier = BasePairAnnotationNumerifier(coord=self.coord,
-                                                            features=coord_features,
-                                                            is_plus_strand=is_plus_strand,
-                                                            max_len=max_len,
-                                                            one_hot=one_hot)
-
-        self.seq_numerifier = SequenceNumerifier(coord=self.coord,
-                                                 is_plus_strand=is_plus_strand,
-                                                 max_len=max_len)
-
-    def numerify(self):
-        inputs, input_masks = self.seq_numerifier.coord_to_matrices()
-        labels, label_masks = self.anno_numerifier.coord_to_matrices()
-
+        # sort the features by strand once, so each numerifier only sees its own
+        strand_features = {True: [], False: []}
+        for feature in coord_features:
+            strand_features[feature.is_plus_strand].append(feature)
+
+        self.anno_numerifiers, self.seq_numerifiers = {}, {}
+        for is_plus_strand in [True, False]:
+            self.anno_numerifiers[is_plus_strand] = BasePairAnnotationNumerifier(
+                coord=self.coord,
+                features=strand_features[is_plus_strand],
+                is_plus_strand=is_plus_strand,
+                max_len=max_len,
+                one_hot=one_hot)
+        self.seq_numerifiers[True] = SequenceNumerifier(coord=self.coord,
+                                                        is_plus_strand=True,
+                                                        max_len=max_len)
+        self.seq_numerifiers[False] = SequenceNumerifier(coord=self.coord,
+                                                         is_plus_strand=False,
+                                                         max_len=max_len,
+                                                         plus_strand=self.seq_numerifiers[True])
+
+    def _add_time(self, stage, start):
+        if self.timings is not None:
+            self.timings[stage] += time.perf_counter() - start
+
+    def _get_gc_content(self):
+        if self.gc_content is None:
+            start = time.perf_counter()
+            if self.gc_contents is not None:
+                self.gc_content = self.gc_contents.get(self.coord.id)
+            else:
+                try:
+                    # need to hijack the session from geenuff_exporter as the Mer table does not exist there
+                    self.gc_content = (self.geenuff_exporter.session.query(Mer.count)
+                        .filter(Mer.coordinate == self.coord)
+                        .filter(Mer.mer_sequence == 'C')
+                        .one()[0])
+                except NoResultFound:
+                    pass
+            if self.gc_content is None:
+                self.gc_content = 0
+                logging.warning('No gc_content found for coord {}, set to 0 in the data'
+                                     .format(self.coord.seqid))
+            self._add_time('mer_lookup', start)
+        return self.gc_content
+
+    def _start_ends(self, is_plus_strand):
+        paired_steps = self.anno_numerifiers[is_plus_strand].paired_steps
         # flip the start ends back for - strand
-        if self.anno_numerifier.is_plus_strand:
-            start_ends = self.anno_numerifier.paired_steps
-        else:
-            start_ends = [(x[1], x[0]) for x in self.anno_numerifier.paired_steps]
-
-        try:
-            # need to hijack the session from geenuff_exporter as the Mer table does not exist there
-            gc_content = (self.geenuff_exporter.session.query(Mer.count)
-                .filter(Mer.coordinate == self.coord)
-                .filter(Mer.mer_sequence == 'C')
-                .one()[0])
-        except NoResultFound:
-            gc_content = 0
-            logging.warning('No gc_content found for coord {}, set to 0 in the data'
-                                 .format(self.coord.seqid))
-        # do not output the input_masks as it is not used for anything
+        if is_plus_strand:
+            return list(paired_steps)
+        return [(x[1], x[0]) for x in paired_steps]
+
+    def _chunk_counts(self, is_plus_strand):
+        """The length, the masked and the intergenic bases of each chunk and whether it is kept"""
+        start = time.perf_counter()
+        steps = np.array(self.anno_numerifiers[is_plus_strand].paired_steps).reshape((-1, 2))
+        lengths = steps[:, 1] - steps[:, 0]
+        n_valid, n_intergenic = self.anno_numerifiers[is_plus_strand].chunk_counts()
+        keep = np.ones(len(lengths), dtype=bool) if self.keep_errors else n_valid > 0
+        self._add_time('annotation_numerify', start)
+        return lengths - n_valid, n_intergenic, keep
+
+    def _out(self, inputs, labels, label_masks, start_ends, n_masked_bases, n_intergenic_bases):
+        """The numerified chunks and the amount of masked and intergenic bases in them and in
+        the dropped erroneous chunks since the previous output"""
         out = {
             'inputs': inputs,
             'labels': labels,
             'label_masks': label_masks,
-            'gc_contents': gc_content,
+            # not needed without any chunks, which saves the lookup for fully erroneous coordinates
+            'gc_contents': self._get_gc_content() if inputs else 0,
             'coord_lengths': self.coord.length,
             'species': self.coord.genome.species.encode('ASCII'),
             'seqids': self.coord.seqid.encode('ASCII'),
             'start_ends': start_ends,
+            'n_masked_bases': int(n_masked_bases),
+            'n_intergenic_bases': int(n_intergenic_bases),
         }
         return out
+
+    def numerify(self, is_plus_strand):
+        assert isinstance(is_plus_strand, bool)
+        n_masked, n_intergenic, keep = self._chunk_counts(is_plus_strand)
+        start_ends = list(compress(self._start_ends(is_plus_strand), keep))
+        start = time.perf_counter()
+        if np.all(keep):
+            labels, label_masks = self.anno_numerifiers[is_plus_strand].coord_to_matrices()
+        else:
+            labels, label_masks = self._kept_chunk_matrices(self.anno_numerifiers[is_plus_strand],
+                                                            keep)
+        self._add_time('annotation_numerify', start)
+        start = time.perf_counter()
+        if np.all(keep):
+            inputs, _ = self.seq_numerifiers[is_plus_strand].coord_to_matrices()
+        else:
+            # encoded between the dropped chunks, so these are never encoded
+            inputs = self.seq_numerifiers[is_plus_strand].window_chunk_matrices(np.flatnonzero(keep))
+        self._add_time('sequence_numerify', start)
+        # the input_masks are not output as they are not used for anything
+        return self._out(inputs, labels, label_masks, start_ends, np.sum(n_masked),
+                         np.sum(n_intergenic))
+
+    @staticmethod
+    def _kept_chunk_matrices(numerifier, keep):
+        data, error_masks = [], []
+        for i in np.flatnonzero(keep):
+            data_slice, error_mask_slice = numerifier.chunk_matrices(i)
+            data.append(data_slice)
+            error_masks.append(error_mask_slice)
+        return data, error_masks
+
+    def numerify_in_batches(self, is_plus_strand, max_chunks, first=0, last=None):
+        """Streaming version of numerify(). Yields the same output but for at most max_chunks
+        chunks at a time, so the memory usage is bounded by max_chunks instead of by the
+        length of the coordinate.
+        With first and last only the chunks [first, last) of the strand are numerified and
+        counted, so parts of a coordinate can be numerified independently of each other."""
+        assert isinstance(is_plus_strand, bool)
+        assert isinstance(max_chunks, int) and max_chunks > 0
+        n_masked, n_intergenic, keep = self._chunk_counts(is_plus_strand)
+        start_ends = self._start_ends(is_plus_strand)
+        if last is None:
+            last = len(start_ends)
+        kept = first + np.flatnonzero(keep[first:last])
+        batches = [kept[i:i + max_chunks] for i in range(0, len(kept), max_chunks)]
+        if first < last and (not batches or batches[-1][-1] < last - 1):
+            # the last output passes on the counts also if all chunks after it were dropped
+            batches.append(kept[:0])
+        batch_start = first
+        for i, batch in enumerate(batches):
+            batch_end = last if i == len(batches) - 1 else batch[-1] + 1
+            start = time.perf_counter()
+            labels, label_masks = [], []
+            for j in batch:
+                label, label_mask = self.anno_numerifiers[is_plus_strand].chunk_matrices(j)
+                labels.append(label)
+                label_masks.append(label_mask)
+            self._add_time('annotation_numerify', start)
+            start = time.perf_counter()
+            # the sequence of the batch is encoded at once and not chunk by chunk
+            inputs = self.seq_numerifiers[is_plus_strand].window_chunk_matrices(batch)
+            self._add_time('sequence_numerify', start)
+            yield self._out(inputs, labels, label_masks, [start_ends[j] for j in batch],
+                            np.sum(n_masked[batch_start:batch_end]),
+                            np.sum(n_intergenic[batch_start:batch_end]))
+            batch_start = batch_end
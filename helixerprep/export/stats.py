@@ -0,0 +1,112 @@
+"""opt-in timers and counters of the export stages, aggregated per genome and for the whole run"""
+import json
+import time
+import resource
+
+STAGES = ['db_fetch', 'mer_lookup', 'sequence_numerify', 'annotation_numerify', 'encode',
+          'h5_write']
+
+
+def peak_rss_mb():
+    """The peak resident set size of this process and the largest one of its finished child
+    processes (e.g. numerify workers) in MB"""
+    # ru_maxrss is in kilobytes on linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return own, children
+
+
+class ExportStats(object):
+    """Collects the seconds spent in each of STAGES, the amount of coordinates, bases, chunks
+    and bytes handed to the h5 writers, per genome and for the whole run. Stage times that
+    can not be attributed to a genome (like the initial queries) are only counted for the run.
+    The wall time of a genome is the time between finishing its coordinates and the one
+    before, so it includes everything, also waiting for worker processes. The stage times of
+    coordinates numerified by workers are measured in the workers and can add up to more than
+    the wall time."""
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.last_coord_time = self.start_time
+        self.run = self._empty()
+        self.genomes = {}
+
+    @staticmethod
+    def _empty():
+        return {
+            'seconds': {stage: 0.0 for stage in STAGES},
+            'wall_seconds': 0.0,
+            'coords': 0,
+            'bases': 0,
+            'chunks': 0,
+            'bytes_written': 0,
+            'skipped_bases': 0,
+            'peak_rss_mb': 0.0,
+        }
+
+    def _genome(self, species):
+        if species not in self.genomes:
+            self.genomes[species] = self._empty()
+        return self.genomes[species]
+
+    def add_seconds(self, stage, seconds, species=None):
+        self.run['seconds'][stage] += seconds
+        if species is not None:
+            self._genome(species)['seconds'][stage] += seconds
+
+    def add_coord(self, species, n_bases, n_chunks, n_bytes, timings=None, n_skipped_bases=0):
+        """Counts a finished coordinate, timings can be a dict of stage to the seconds it took
+        and n_skipped_bases are the bases of the erroneous chunks that were dropped"""
+        now = time.perf_counter()
+        genome = self._genome(species)
+        for stats in [self.run, genome]:
+            stats['wall_seconds'] += now - self.last_coord_time
+            stats['coords'] += 1
+            stats['bases'] += n_bases
+            stats['chunks'] += n_chunks
+            stats['bytes_written'] += n_bytes
+            stats['skipped_bases'] += n_skipped_bases
+        for stage, seconds in (timings or {}).items():
+            self.add_seconds(stage, seconds, species)
+        genome['peak_rss_mb'] = max(peak_rss_mb())
+        self.last_coord_time = now
+
+    @staticmethod
+    def _with_rates(stats):
+        stats = dict(stats, seconds=dict(stats['seconds']))
+        wall_seconds = stats['wall_seconds']
+        stats['bases_per_second'] = stats['bases'] / wall_seconds if wall_seconds else 0.0
+        stats['chunks_per_second'] = stats['chunks'] / wall_seconds if wall_seconds else 0.0
+        return stats
+
+    def report(self, file_bytes=None):
+        """The whole report as dict, file_bytes can be a dict of file name to its final size"""
+        run = self._with_rates(dict(self.run, wall_seconds=time.perf_counter() - self.start_time))
+        run['peak_rss_mb'], run['peak_rss_workers_mb'] = peak_rss_mb()
+        if file_bytes is not None:
+            run['file_bytes'] = file_bytes
+        return {
+            'run': run,
+            'genomes': {species: self._with_rates(stats) for species, stats in self.genomes.items()},
+        }
+
+    def write(self, path, file_bytes=None):
+        report = self.report(file_bytes)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        return report
+
+    @staticmethod
+    def print_summary(report):
+        run = report['run']
+        print('\nExport stages (seconds, measured in the workers when numerified in parallel):')
+        for stage, seconds in run['seconds'].items():
+            print('  {:<20} {:>10.2f}'.format(stage, seconds))
+        print('{} bases ({} skipped as erroneous) in {} chunks in {:.1f}s ({:.0f} bases/s), '
+              '{:.1f} MB handed to the writers, peak RSS {:.0f} MB (workers: {:.0f} MB)'.format(
+                  run['bases'], run['skipped_bases'], run['chunks'], run['wall_seconds'],
+                  run['bases_per_second'],
+                  run['bytes_written'] / 2 ** 20, run['peak_rss_mb'], run['peak_rss_workers_mb']))
+        for species, genome in report['genomes'].items():
+            print('  {}: {} coordinates in {:.1f}s ({:.0f} bases/s)'.format(
+                species, genome['coords'], genome['wall_seconds'], genome['bases_per_second']))
+
@@ -0,0 +1,293 @@
+"""buffered writing of the numerified data into the /data group of an h5 file"""
+import time
+import numpy as np
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+
+COMPRESSIONS = ['lzf', 'gzip', 'blosc', 'zstd', 'none']
+
+
+def compression_kwargs(compression, level=None):
+    """Returns the h5py create_dataset() kwargs of a compression codec. blosc and zstd are
+    only available when hdf5plugin is installed. Whether the h5 shuffle filter should be
+    used is part of the returned kwargs, as blosc does its own shuffling."""
+    if compression == 'lzf':
+        return {'compression': 'lzf', 'shuffle': True}
+    elif compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': 4 if level is None else level,
+                'shuffle': True}
+    elif compression == 'none':
+        return {'shuffle': False}
+    elif compression in ['blosc', 'zstd']:
+        if hdf5plugin is None:
+            raise ValueError('The {} compression needs the hdf5plugin package'.format(compression))
+        if compression == 'blosc':
+            plugin = hdf5plugin.Blosc(cname='lz4', clevel=5 if level is None else level,
+                                      shuffle=hdf5plugin.Blosc.SHUFFLE)
+            return dict(plugin, shuffle=False)
+        return dict(hdf5plugin.Zstd(clevel=3 if level is None else level), shuffle=True)
+    raise ValueError('Unknown compression {}, choose from {}'.format(compression, COMPRESSIONS))
+
+
+class BufferedH5Writer(object):
+    """Collects the already padded and encoded arrays of many coordinates and writes them
+    with one resize and one contiguous block write per dataset once more than max_buffer_mb
+    are buffered. The h5 file is only flushed after such a block write, so thousands of small
+    coordinates do not cause thousands of tiny resizes, chunk rewrites and flushes.
+    The arrays passed to add() have to be a dict of dataset name (without '/data/') to array,
+    with one entry per chunk along the first axis.
+
+    Alongside the data a manifest is kept in the /manifest group, which records for each finished
+    coordinate and strand the range of rows it occupies. It is written in the same block as the
+    data, but after it, so the rows after the last manifest entry are the partial tail of an
+    interrupted export, which drop_unfinished() removes again.
+    """
+    # these have one value per base and are chunked by rows_per_chunk samples
+    per_base_keys = ['X', 'y', 'sample_weights']
+
+    def __init__(self, h5_file, max_buffer_mb=256, rows_per_chunk=1, compression='lzf',
+                 compression_level=None):
+        assert isinstance(rows_per_chunk, int) and rows_per_chunk > 0
+        self.h5_file = h5_file
+        self.max_buffer_bytes = int(max_buffer_mb * 2 ** 20)
+        self.rows_per_chunk = rows_per_chunk
+        self.compression_kwargs = compression_kwargs(compression, compression_level)
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.n_block_writes = 0
+        # for the export stats, everything ever added and the time spent in flush()
+        self.bytes_added = 0
+        self.write_seconds = 0.0
+        # (coord_id, is_plus_strand, row_start, row_end) of the coordinates finished since the last flush
+        self.manifest_buffer = []
+        # rows of all finished coordinates, written or not, and the strands of the current one
+        self.n_finished_rows = self._manifest_end()
+        self.coord_rows = {True: 0, False: 0}
+
+    def __len__(self):
+        return sum([len(arrays['X']) for arrays in self.buffer])
+
+    def add(self, arrays):
+        if not len(arrays['X']):
+            return
+        # the minus strand start_ends are flipped
+        n_plus = int(np.count_nonzero(arrays['start_ends'][:, 0] < arrays['start_ends'][:, 1]))
+        self.coord_rows[True] += n_plus
+        self.coord_rows[False] += len(arrays['X']) - n_plus
+        self.buffer.append(arrays)
+        n_bytes = sum([a.nbytes for a in arrays.values()])
+        self.buffered_bytes += n_bytes
+        self.bytes_added += n_bytes
+        if self.buffered_bytes >= self.max_buffer_bytes:
+            self.flush()
+
+    def finish_coord(self, coord_id):
+        """Marks all rows added since the last call as the rows of coord_id. Both strands get
+        an entry, also if they have no rows in this file."""
+        row_start = self.n_finished_rows
+        # the plus strand is always numerified first
+        for is_plus_strand in [True, False]:
+            row_end = row_start + self.coord_rows[is_plus_strand]
+            self.manifest_buffer.append((coord_id, is_plus_strand, row_start, row_end))
+            row_start = row_end
+        self.n_finished_rows = row_start
+        self.coord_rows = {True: 0, False: 0}
+
+    def _manifest_end(self):
+        if '/manifest/row_ends' not in self.h5_file or not len(self.h5_file['/manifest/row_ends']):
+            return 0
+        return int(self.h5_file['/manifest/row_ends'][-1])
+
+    def manifest_coord_ids(self):
+        """The ids of all coordinates that were completely written"""
+        if '/manifest/coord_ids' not in self.h5_file:
+            return set()
+        return set(self.h5_file['/manifest/coord_ids'][:].tolist())
+
+    def drop_unfinished(self, finished_coord_ids):
+        """Removes the manifest entries of the coordinates not in finished_coord_ids, which must
+        all be at the end of the manifest, and truncates all data to the remaining entries,
+        which also drops any rows that were written without a manifest entry"""
+        assert not self.buffer and not self.manifest_buffer
+        if '/manifest/coord_ids' in self.h5_file:
+            # an interrupted manifest write can leave the manifest datasets with different lengths
+            n_entries = min([len(dset) for dset in self.h5_file['manifest'].values()])
+            coord_ids = self.h5_file['/manifest/coord_ids'][:n_entries]
+            is_finished = np.isin(coord_ids, list(finished_coord_ids))
+            n_keep = int(np.count_nonzero(is_finished))
+            if not np.all(is_finished[:n_keep]):
+                raise ValueError('Unfinished coordinates are not at the end of the manifest of {}'
+                                 .format(self.h5_file.filename))
+            for key in self.h5_file['manifest'].keys():
+                self.h5_file['/manifest/' + key].resize(n_keep, axis=0)
+        elif '/data/X' in self.h5_file and len(self.h5_file['/data/X']):
+            raise ValueError('{} has data but no manifest'.format(self.h5_file.filename))
+        self.n_finished_rows = self._manifest_end()
+        if 'data' in self.h5_file:
+            for key in self.h5_file['data'].keys():
+                self.h5_file['/data/' + key].resize(self.n_finished_rows, axis=0)
+        self.h5_file.flush()
+
+    def _write_manifest(self):
+        manifest = {
+            'coord_ids': np.array([m[0] for m in self.manifest_buffer], dtype=np.int64),
+            'is_plus_strand': np.array([m[1] for m in self.manifest_buffer], dtype=bool),
+            'row_starts': np.array([m[2] for m in self.manifest_buffer], dtype=np.int64),
+            'row_ends': np.array([m[3] for m in self.manifest_buffer], dtype=np.int64),
+        }
+        self._create_manifest()
+        for key, array in manifest.items():
+            dset = self.h5_file['/manifest/' + key]
+            old_len = dset.shape[0]
+            dset.resize(old_len + len(array), axis=0)
+            dset[old_len:] = array
+        self.manifest_buffer = []
+
+    def _create_manifest(self):
+        if '/manifest/coord_ids' in self.h5_file:
+            return
+        for key, dtype in [('coord_ids', np.int64), ('is_plus_strand', bool),
+                           ('row_starts', np.int64), ('row_ends', np.int64)]:
+            self.h5_file.create_dataset('/manifest/' + key, shape=(0,), maxshape=(None,), dtype=dtype)
+
+    def _create_datasets(self, data):
+        # the manifest is created together with the data, so data without a manifest can only
+        # come from a file written before there was one
+        self._create_manifest()
+        for key, array in data.items():
+            kwargs = dict(self.compression_kwargs)
+            if key in BufferedH5Writer.per_base_keys:
+                kwargs['chunks'] = (self.rows_per_chunk,) + array.shape[1:]
+                # the shuffle filter is only for the compression and not used for the uint8 encodings
+                kwargs['shuffle'] = kwargs['shuffle'] and array.dtype != np.uint8
+            else:
+                kwargs['shuffle'] = False
+            self.h5_file.create_dataset('/data/' + key,
+                                        shape=(0,) + array.shape[1:],
+                                        maxshape=(None,) + array.shape[1:],
+                                        dtype=array.dtype,
+                                        **kwargs)
+
+    def flush(self):
+        """Writes everything buffered as one block per dataset, followed by the manifest entries
+        of the coordinates finished in the meantime"""
+        if not self.buffer and not self.manifest_buffer:
+            return
+        start = time.perf_counter()
+        if self.buffer:
+            data = {key: np.concatenate([arrays[key] for arrays in self.buffer])
+                    for key in self.buffer[0].keys()}
+            if '/data/X' not in self.h5_file:
+                self._create_datasets(data)
+            for key, array in data.items():
+                dset = self.h5_file['/data/' + key]
+                old_len = dset.shape[0]
+                dset.resize(old_len + len(array), axis=0)
+                dset[old_len:] = array
+            self.n_block_writes += 1
+            self.buffer = []
+            self.buffered_bytes = 0
+        if self.manifest_buffer:
+            self._write_manifest()
+        self.h5_file.flush()
+        self.write_seconds += time.perf_counter() - start
+
+
+def true_ranges(mask, offset=0):
+    """Returns the [start, end) ranges of the runs of True in mask as (n, 2) array, shifted by offset"""
+    padded = np.concatenate([[False], mask, [False]])
+    changes = np.flatnonzero(padded[1:] != padded[:-1])
+    return changes.reshape((-1, 2)).astype(np.int64) + offset
+
+
+class ContiguousH5Writer(object):
+    """Writes each coordinate strand as one contiguous run of encoded bases into the per base
+    datasets of the /bases group, without cutting it into chunks. The /strands group has one
+    entry per strand with its offset and length in /bases and the per coordinate metadata.
+    The minus strand is stored reversed and complemented, so it is read in the same direction
+    as the plus strand. The bases that are erroneous or not intergenic are stored as sorted
+    [start, end) ranges in /ranges/error and /ranges/genic, so readers can find the erroneous
+    and fully intergenic chunks without scanning the bases.
+    """
+    per_base_keys = ['X', 'y', 'sample_weights']
+    strand_keys = ['offsets', 'lengths', 'is_plus_strand', 'coord_ids', 'gc_contents',
+                   'coord_lengths', 'species', 'seqids']
+
+    def __init__(self, h5_file, max_buffer_mb=256, compression='lzf', compression_level=None,
+                 bases_per_chunk=2 ** 16):
+        self.h5_file = h5_file
+        self.max_buffer_bytes = int(max_buffer_mb * 2 ** 20)
+        self.bases_per_chunk = bases_per_chunk
+        self.compression_kwargs = compression_kwargs(compression, compression_level)
+        self.buffer = {'bases': [], 'strands': [], 'error': [], 'genic': []}
+        self.buffered_bytes = 0
+        self.n_block_writes = 0
+        # for the export stats, everything ever added and the time spent in flush()
+        self.bytes_added = 0
+        self.write_seconds = 0.0
+        # the base offset of everything added so far and of the current strand
+        self.n_bases = 0
+        self.strand_offset = 0
+
+    def add_bases(self, arrays, is_error, is_genic):
+        """Appends the next bases of the current strand, arrays has to be a dict with X, y
+        and sample_weights with one entry per base"""
+        self.buffer['bases'].append(arrays)
+        for key, mask in [('error', is_error), ('genic', is_genic)]:
+            ranges = true_ranges(mask, self.n_bases)
+            previous = self.buffer[key][-1] if self.buffer[key] else None
+            if len(ranges) and previous is not None and len(previous) and previous[-1, 1] == ranges[0, 0]:
+                # the run continues from the previous bases
+                previous[-1, 1] = ranges[0, 1]
+                ranges = ranges[1:]
+            self.buffer[key].append(ranges)
+        self.n_bases += len(arrays['X'])
+        n_bytes = sum([a.nbytes for a in arrays.values()])
+        self.buffered_bytes += n_bytes
+        self.bytes_added += n_bytes
+
+    def finish_strand(self, is_plus_strand, coord_id, gc_content, coord_length, species, seqid):
+        """Records the bases added since the last call as one strand"""
+        self.buffer['strands'].append((self.strand_offset, self.n_bases - self.strand_offset,
+                                       is_plus_strand, coord_id, gc_content, coord_length,
+                                       species, seqid))
+        self.strand_offset = self.n_bases
+        if self.buffered_bytes >= self.max_buffer_bytes:
+            self.flush()
+
+    def _append(self, path, array, **kwargs):
+        if path not in self.h5_file:
+            self.h5_file.create_dataset(path, shape=(0,) + array.shape[1:],
+                                        maxshape=(None,) + array.shape[1:], dtype=array.dtype,
+                                        **kwargs)
+        dset = self.h5_file[path]
+        old_len = dset.shape[0]
+        dset.resize(old_len + len(array), axis=0)
+        dset[old_len:] = array
+
+    def flush(self):
+        """Writes everything buffered as one block per dataset, which has to be whole strands"""
+        assert self.strand_offset == self.n_bases, 'the current strand is not finished'
+        if not self.buffer['strands']:
+            return
+        start = time.perf_counter()
+        for key in ContiguousH5Writer.per_base_keys:
+            array = np.concatenate([arrays[key] for arrays in self.buffer['bases']])
+            kwargs = dict(self.compression_kwargs)
+            kwargs['chunks'] = (self.bases_per_chunk,) + array.shape[1:]
+            kwargs['shuffle'] = kwargs['shuffle'] and array.dtype != np.uint8
+            self._append('/bases/' + key, array, **kwargs)
+        strands = list(zip(*self.buffer['strands']))
+        dtypes = [np.int64, np.int64, bool, np.int64, np.uint64, np.uint64, 'S25', 'S50']
+        for key, values, dtype in zip(ContiguousH5Writer.strand_keys, strands, dtypes):
+            self._append('/strands/' + key, np.array(values, dtype=dtype), chunks=True)
+        for key in ['error', 'genic']:
+            self._append('/ranges/' + key, np.concatenate(self.buffer[key]), chunks=True)
+        self.buffer = {'bases': [], 'strands': [], 'error': [], 'genic': []}
+        self.buffered_bytes = 0
+        self.n_block_writes += 1
+        self.h5_file.flush()
+        self.write_seconds += time.perf_counter() - start
@@ -7,11 +7,10 @@ from HelixerModel import HelixerModel, HelixerSequence
 
 
 class CNNSequence(HelixerSequence):
-    def __getitem__(self, idx):
+    def _get_batch(self, usable_idx_slice):
         assert self.exclude_errors  # no other way of dealing with errors in a CNN
-        usable_idx_slice = self.usable_idx[idx * self.batch_size:(idx + 1) * self.batch_size]
-        X = np.stack(self.x_dset[sorted(list(usable_idx_slice))])  # got to provide a sorted list of idx
-        y = np.stack(self.y_dset[sorted(list(usable_idx_slice))])
+        X = self._get_x(usable_idx_slice)
+        y = self._get_y(usable_idx_slice)
         return X, y
 
 
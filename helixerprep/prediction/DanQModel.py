@@ -15,46 +15,13 @@ class DanQSequence(HelixerSequence):
         if self.class_weights is not None:
             assert not mode == 'test'  # only use class weights during training and validation
 
-    def __getitem__(self, idx):
-        pool_size = self.model.pool_size
-        usable_idx_slice = self.usable_idx[idx * self.batch_size:(idx + 1) * self.batch_size]
-        usable_idx_slice = sorted(list(usable_idx_slice))  # got to always provide a sorted list of idx
-        X = np.stack(self.x_dset[usable_idx_slice])
-        y = np.stack(self.y_dset[usable_idx_slice])
-        sw = np.stack(self.sw_dset[usable_idx_slice])
-
-        if pool_size > 1:
-            if y.shape[1] % pool_size != 0:
-                # clip to maximum size possible with the pooling length
-                overhang = y.shape[1] % pool_size
-                X = X[:, :-overhang]
-                y = y[:, :-overhang]
-                sw = sw[:, :-overhang]
-
-            # make labels 2d so we can use the standard softmax / loss functions
-            y = y.reshape((
-                y.shape[0],
-                y.shape[1] // pool_size,
-                pool_size,
-                y.shape[-1],
-            ))
-
-            # mark any multi-base timestep as error if any base has an error
-            sw = sw.reshape((sw.shape[0], -1, pool_size))
-            sw = np.logical_not(np.any(sw == 0, axis=2)).astype(np.int8)
-
-            if self.class_weights is not None:
-                # class weights are only used during training and validation to keep the loss
-                # comparable and are additive for the individual timestep predictions
-                # giving even more weight to transition points
-                # class weights without pooling not supported yet
-                cls_arrays = [np.any((y[:, :, :, col] == 1), axis=2) for col in range(4)]
-                cls_arrays = np.stack(cls_arrays, axis=2).astype(np.int8)
-                # add class weights to applicable timesteps
-                cw_arrays = np.multiply(cls_arrays, np.tile(self.class_weights, y.shape[:2] + (1,)))
-                cw = np.sum(cw_arrays, axis=2)
-                # multiply with previous sample weights
-                sw = np.multiply(sw, cw)
+    def _get_batch(self, usable_idx_slice):
+        if self.pool_size > 1:
+            X, y, sw = self._get_pooled_batch(usable_idx_slice)
+        else:
+            X = self._get_x(usable_idx_slice)
+            y = self._get_y(usable_idx_slice)
+            sw = self._get_sw(usable_idx_slice)
 
         # put together returned inputs/outputs
         if self.meta_losses:
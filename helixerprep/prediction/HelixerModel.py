@@ -10,7 +10,6 @@ except ImportError:
     pass
 import time
 import h5py
-import random
 import argparse
 import datetime
 import importlib
@@ -18,16 +17,20 @@ import numpy as np
 import tensorflow as tf
 from pprint import pprint
 from functools import partial
-from sklearn.preprocessing import MinMaxScaler
 
 from keras_layer_normalization import LayerNormalization
 from keras.callbacks import EarlyStopping, ModelCheckpoint, History, CSVLogger, Callback
 from keras import optimizers
 from keras import backend as K
 from keras.models import load_model
-from keras.utils import multi_gpu_model, Sequence
+from keras.utils import multi_gpu_model
 
+from helixerprep.core.helpers import read_summary
+from helixerprep.core.contiguous import open_data_file
+from helixerprep.core.memmap_cache import MemmapCachedFile
 from ConfusionMatrix import ConfusionMatrix
+from HelixerSequence import HelixerSequence
+from PrefetchSequence import PrefetchSequence, PrefetchStats
 
 
 def acc_region(y_true, y_pred, col, value):
@@ -74,54 +77,6 @@ class ConfusionMatrixTrain(Callback):
             nni.report_final_result(self.best_genic_f1)
 
 
-class HelixerSequence(Sequence):
-    def __init__(self, model, h5_file, mode, shuffle):
-        assert mode in ['train', 'val', 'test']
-        assert mode != 'test' or model.load_model_path  # assure that the mode param is correct
-        self.model = model
-        self.h5_file = h5_file
-        self.mode = mode
-        self.batch_size = self.model.batch_size
-        self.float_precision = self.model.float_precision
-        self.class_weights = self.model.class_weights
-        self.meta_losses = self.model.meta_losses
-        self.x_dset = h5_file['/data/X']
-        self.y_dset = h5_file['/data/y']
-        self.sw_dset = h5_file['/data/sample_weights']
-        self._load_and_scale_meta_info()
-
-        # set array of usable indexes, always exclude all erroneous sequences during training
-        if mode == 'train':
-            self.usable_idx = np.flatnonzero(np.array(h5_file['/data/err_samples']) == False)
-        else:
-            self.usable_idx = list(range(self.x_dset.shape[0]))
-        if shuffle:
-            random.shuffle(self.usable_idx)
-
-    def _load_and_scale_meta_info(self):
-        self.gc_contents = np.array(self.h5_file['/data/gc_contents'], dtype=self.float_precision)
-        self.coord_lengths = np.array(self.h5_file['/data/coord_lengths'], dtype=self.float_precision)
-        # scale gc content by their coord lengths
-        self.gc_contents /= self.coord_lengths
-        # log transform and standardize coord_lengths to [0, 1]
-        # gc_contents should have a fine scale already
-        self.coord_lengths = np.log(self.coord_lengths)
-        self.coord_lengths = self.coord_lengths.reshape(-1, 1)
-        self.coord_lengths = MinMaxScaler().fit(self.coord_lengths).transform(self.coord_lengths)
-        # need to clip as values can be slightly above 1.0 (docs say otherwise..)
-        self.coord_lengths = np.clip(self.coord_lengths, 0.0, 1.0).squeeze()
-        assert np.all(np.logical_and(self.gc_contents >= 0.0, self.gc_contents <= 1.0))
-        assert np.all(np.logical_and(self.coord_lengths >= 0.0, self.coord_lengths <= 1.0))
-
-    def __len__(self):
-        # return 1
-        return int(np.ceil(len(self.usable_idx) / float(self.batch_size)))
-
-    @abstractmethod
-    def __getitem__(self, idx):
-        pass
-
-
 class HelixerModel(ABC):
     def __init__(self):
         tf.logging.set_verbosity(tf.logging.ERROR)
@@ -130,6 +85,8 @@ class HelixerModel(ABC):
         self.parser = argparse.ArgumentParser()
         self.parser.add_argument('-d', '--data-dir', type=str, default='')
         self.parser.add_argument('-sm', '--save-model-path', type=str, default='./best_model.h5')
+        # only used for data exported with --contiguous, which is cut into chunks when read
+        self.parser.add_argument('-cs', '--chunk-size', type=int, default=20000)
         # training params
         self.parser.add_argument('-e', '--epochs', type=int, default=10000)
         # self.parser.add_argument('-p', '--patience', type=int, default=10)
@@ -149,6 +106,19 @@ class HelixerModel(ABC):
         self.parser.add_argument('-gpus', '--gpus', type=int, default=1)
         self.parser.add_argument('-cpus', '--cpus', type=int, default=8)
         self.parser.add_argument('--specific-gpu-id', type=int, default=-1)
+        # processes loading the training batches in the background, 0 loads them in the main thread
+        self.parser.add_argument('-pw', '--prefetch-workers', type=int, default=0)
+        self.parser.add_argument('-pq', '--prefetch-queue', type=int, default=10)
+        # local scratch folder to cache the training and validation data uncompressed in
+        self.parser.add_argument('-mcd', '--memmap-cache-dir', type=str, default='')
+        # shuffle the training rows in blocks of consecutive rows again in every epoch,
+        # 0 shuffles single rows once at the start
+        self.parser.add_argument('-sbs', '--shuffle-block-size', type=int, default=0,
+                                 help=('shuffle the training rows in blocks of this many '
+                                       'consecutive rows, can not be combined with '
+                                       '--length-buckets as that sorts the rows by length'))
+        self.parser.add_argument('-sw', '--shuffle-window', type=int, default=1,
+                                 help='amount of shuffled blocks whose rows are mixed')
         # misc flags
         self.parser.add_argument('-nni', '--nni', action='store_true')
         self.parser.add_argument('-v', '--verbose', action='store_true')
@@ -237,22 +207,35 @@ class HelixerModel(ABC):
 
     def open_data_files(self):
         def get_n_correct_seqs(h5_file):
-            err_samples = np.array(h5_file['/data/err_samples'])
-            n_correct = np.count_nonzero(err_samples == False)
+            summary = read_summary(h5_file)
+            if summary is not None:
+                n_correct = summary.attrs['n_rows'] - summary.attrs['n_err_samples']
+            else:
+                err_samples = np.array(h5_file['/data/err_samples'])
+                n_correct = np.count_nonzero(err_samples == False)
             if n_correct == 0:
                 print('WARNING: no fully correct sample found')
             return n_correct
 
         def get_n_intergenic_seqs(h5_file):
-            ic_samples = np.array(h5_file['/data/fully_intergenic_samples'])
-            n_fully_ig = np.count_nonzero(ic_samples == True)
+            summary = read_summary(h5_file)
+            if summary is not None:
+                n_fully_ig = summary.attrs['n_fully_intergenic_samples']
+            else:
+                ic_samples = np.array(h5_file['/data/fully_intergenic_samples'])
+                n_fully_ig = np.count_nonzero(ic_samples == True)
             if n_fully_ig == 0:
                 print('WARNING: no fully intergenic samples found')
             return n_fully_ig
 
         if not self.load_model_path:
-            self.h5_train = h5py.File(os.path.join(self.data_dir, 'training_data.h5'), 'r')
-            self.h5_val = h5py.File(os.path.join(self.data_dir, 'validation_data.h5'), 'r')
+            self.h5_train = open_data_file(os.path.join(self.data_dir, 'training_data.h5'),
+                                           self.chunk_size)
+            self.h5_val = open_data_file(os.path.join(self.data_dir, 'validation_data.h5'),
+                                         self.chunk_size)
+            if self.memmap_cache_dir:
+                self.h5_train = MemmapCachedFile(self.h5_train, self.memmap_cache_dir)
+                self.h5_val = MemmapCachedFile(self.h5_val, self.memmap_cache_dir)
             self.shape_train = self.h5_train['/data/X'].shape
             self.shape_val = self.h5_val['/data/X'].shape
 
@@ -265,7 +248,7 @@ class HelixerModel(ABC):
             n_intergenic_train_seqs = get_n_intergenic_seqs(self.h5_train)
             n_intergenic_val_seqs = get_n_intergenic_seqs(self.h5_val)
         else:
-            self.h5_test = h5py.File(self.test_data, 'r')
+            self.h5_test = open_data_file(self.test_data, self.chunk_size)
             self.shape_test = self.h5_test['/data/X'].shape
 
             n_test_correct_seqs = get_n_correct_seqs(self.h5_test)
@@ -366,6 +349,13 @@ class HelixerModel(ABC):
         self.open_data_files()
         # we either train or predict
         if not self.load_model_path:
+            train_generator = self.gen_training_data()
+            callbacks = self.generate_callbacks()
+            if self.prefetch_workers > 0:
+                # the workers are forked before the model is built
+                train_generator = PrefetchSequence(train_generator, self.prefetch_workers,
+                                                   max_queue=self.prefetch_queue)
+                callbacks.append(PrefetchStats(train_generator))
             model = self.model()
             if self.gpus >= 2:
                 model = multi_gpu_model(model, gpus=self.gpus)
@@ -374,13 +364,15 @@ class HelixerModel(ABC):
             self.optimizer = optimizers.Adam(lr=self.learning_rate, clipnorm=self.clip_norm)
             self.compile_model(model)
 
-            model.fit_generator(generator=self.gen_training_data(),
+            model.fit_generator(generator=train_generator,
                                 epochs=self.epochs,
-                                workers=0,  # run in main thread
+                                workers=0,  # run in main thread, prefetching has its own workers
                                 # workers=1,
                                 validation_data=self.gen_validation_data(),
-                                callbacks=self.generate_callbacks(),
+                                callbacks=callbacks,
                                 verbose=True)
+            if self.prefetch_workers > 0:
+                train_generator.close()
 
             # set all model instance variables so predictions are made on the validation set
             self.h5_test = self.h5_val
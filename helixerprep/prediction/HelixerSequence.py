@@ -0,0 +1,209 @@
+"""reading the batches of the HelixerModels from exported h5 files"""
+import random
+import numpy as np
+from abc import abstractmethod
+from sklearn.preprocessing import MinMaxScaler
+
+from keras.utils import Sequence
+
+from helixerprep.core.helpers import (x_encoding, decode_base_codes, label_encoding,
+                                     decode_class_indexes, unpack_sample_weights, read_summary,
+                                     block_shuffle, read_rows, read_pooled, pool_labels,
+                                     class_weighted, pooled_sample_weights)
+from helixerprep.core.contiguous import open_data_file
+from helixerprep.core.memmap_cache import MemmapCachedFile
+
+
+class HelixerSequence(Sequence):
+    def __init__(self, model, h5_file, mode, shuffle):
+        assert mode in ['train', 'val', 'test']
+        assert mode != 'test' or model.load_model_path  # assure that the mode param is correct
+        self.model = model
+        self.h5_file = h5_file
+        self.mode = mode
+        self.batch_size = self.model.batch_size
+        self.float_precision = self.model.float_precision
+        self.class_weights = self.model.class_weights
+        self.meta_losses = self.model.meta_losses
+        self.x_dset = h5_file['/data/X']
+        self.x_encoding = x_encoding(h5_file)
+        self.label_encoding = label_encoding(h5_file)
+        self.y_dset = h5_file['/data/y']
+        self.sw_dset = h5_file['/data/sample_weights']
+        self.summary = read_summary(h5_file)
+        self.pool_size = getattr(self.model, 'pool_size', 1)
+        # precomputed by scripts/add_pooled_labels.py
+        self.pooled = read_pooled(h5_file, self.pool_size) if self.pool_size > 1 else None
+        self._load_and_scale_meta_info()
+        self._load_row_lengths()
+
+        # set array of usable indexes, always exclude all erroneous sequences during training
+        if mode == 'train' and self.summary is not None:
+            self.usable_idx = np.array(self.summary['clean_idx'])
+        elif mode == 'train':
+            self.usable_idx = np.flatnonzero(np.array(h5_file['/data/err_samples']) == False)
+        else:
+            self.usable_idx = list(range(self.x_dset.shape[0]))
+        self.shuffle = shuffle
+        # the single rows are only shuffled once like before, the blocks again in every epoch
+        self.reshuffle = shuffle and getattr(self.model, 'shuffle_block_size', 0) > 1
+        # the predictions have to stay in the order of the rows
+        self.length_buckets = getattr(self.model, 'length_buckets', False) and mode != 'test'
+        # sorting the rows by length would undo the blocks of consecutive rows
+        assert not (self.length_buckets and self.reshuffle), \
+            '--length-buckets can not be combined with --shuffle-block-size'
+        if shuffle or self.length_buckets:
+            self._shuffle()
+
+    def _shuffle(self):
+        """Shuffles the rows either one by one or, with --shuffle-block-size, in blocks of
+        consecutive rows that can be read with a few slices per batch. With --length-buckets
+        the rows are then grouped into batches of rows of similar length."""
+        if self.shuffle:
+            block_size = getattr(self.model, 'shuffle_block_size', 0)
+            if block_size > 1:
+                self.usable_idx = block_shuffle(self.usable_idx, block_size,
+                                                window=getattr(self.model, 'shuffle_window', 1))
+            else:
+                random.shuffle(self.usable_idx)
+        if self.length_buckets:
+            self._bucket_by_length()
+
+    def _bucket_by_length(self):
+        """Sorts the rows by their length and cuts them into batches in that order, so each batch
+        can be trimmed to its longest row. The order of the batches is shuffled if the rows are."""
+        usable_idx = np.asarray(self.usable_idx)
+        # stable, so the rows of the same length stay shuffled
+        usable_idx = usable_idx[np.argsort(self.row_lengths[usable_idx], kind='stable')]
+        batches = np.split(usable_idx, range(self.batch_size, len(usable_idx), self.batch_size))
+        if self.shuffle:
+            # the last batch can be incomplete and has to stay last, so the batches stay intact
+            n_full = len(usable_idx) // self.batch_size
+            full_batches = batches[:n_full]
+            random.shuffle(full_batches)
+            batches = full_batches + batches[n_full:]
+        self.usable_idx = np.concatenate(batches)
+
+    def on_epoch_end(self):
+        if self.reshuffle:
+            self._shuffle()
+
+    def _load_and_scale_meta_info(self):
+        self.gc_contents = np.array(self.h5_file['/data/gc_contents'], dtype=self.float_precision)
+        self.coord_lengths = np.array(self.h5_file['/data/coord_lengths'], dtype=self.float_precision)
+        # scale gc content by their coord lengths
+        self.gc_contents /= self.coord_lengths
+        # log transform and standardize coord_lengths to [0, 1]
+        # gc_contents should have a fine scale already
+        self.coord_lengths = np.log(self.coord_lengths)
+        if self.summary is not None:
+            # the same as fitting the MinMaxScaler, but with the range precomputed by the exporter
+            log_min = self.summary.attrs['log_length_min']
+            log_range = self.summary.attrs['log_length_max'] - log_min
+            if log_range == 0:
+                log_range = 1.0
+            self.coord_lengths = ((self.coord_lengths - log_min) / log_range).astype(self.float_precision)
+        else:
+            self.coord_lengths = self.coord_lengths.reshape(-1, 1)
+            self.coord_lengths = MinMaxScaler().fit(self.coord_lengths).transform(self.coord_lengths)
+        # need to clip as values can be slightly above 1.0 (docs say otherwise..)
+        self.coord_lengths = np.clip(self.coord_lengths, 0.0, 1.0).squeeze()
+        assert np.all(np.logical_and(self.gc_contents >= 0.0, self.gc_contents <= 1.0))
+        assert np.all(np.logical_and(self.coord_lengths >= 0.0, self.coord_lengths <= 1.0))
+
+    def reopen_data_file(self):
+        """Opens the data file again, for worker processes that can not safely use the h5 handles
+        inherited from the main process"""
+        if isinstance(self.h5_file, MemmapCachedFile):
+            # the memory maps can be shared with forked processes, but not the file they wrap
+            self.h5_file.reopen()
+        else:
+            keep_errors = getattr(self.h5_file, 'keep_errors', False)
+            self.h5_file = open_data_file(self.h5_file.filename, self.model.chunk_size,
+                                          keep_errors=keep_errors)
+        self.x_dset = self.h5_file['/data/X']
+        self.y_dset = self.h5_file['/data/y']
+        self.sw_dset = self.h5_file['/data/sample_weights']
+        if self.pooled is not None:
+            self.pooled = read_pooled(self.h5_file, self.pool_size)
+
+    def _load_row_lengths(self):
+        """The amount of bases of each row without the zero padding, computed from the start_ends
+        for files exported before it was stored"""
+        if '/data/row_lengths' in self.h5_file:
+            self.row_lengths = np.array(self.h5_file['/data/row_lengths'])
+        else:
+            start_ends = np.array(self.h5_file['/data/start_ends'])
+            self.row_lengths = np.abs(start_ends[:, 1] - start_ends[:, 0])
+
+    def _n_bases(self, usable_idx_slice):
+        """The bases of each row of the batch that are read. With --length-buckets only the ones
+        up to the end of the longest row of the batch, rounded up to whole timesteps of
+        pool_size bases, the rest is zero padding in all rows."""
+        chunk_size = self.x_dset.shape[1]
+        if not self.length_buckets or not len(usable_idx_slice):
+            return chunk_size
+        longest = int(np.max(self.row_lengths[usable_idx_slice]))
+        return min(-(-longest // self.pool_size) * self.pool_size, chunk_size)
+
+    def _get_x(self, usable_idx_slice):
+        """Loads X of the given sorted indexes, expanding uint8 base codes if needed"""
+        X = read_rows(self.x_dset, usable_idx_slice, self._n_bases(usable_idx_slice))
+        if self.x_encoding == 'base_codes':
+            X = decode_base_codes(X)
+        return X
+
+    def _get_y(self, usable_idx_slice):
+        """Loads y of the given sorted indexes, expanding class indexes if needed"""
+        y = read_rows(self.y_dset, usable_idx_slice, self._n_bases(usable_idx_slice))
+        if self.label_encoding == 'compact':
+            y = decode_class_indexes(y)
+        return y
+
+    def _get_sw(self, usable_idx_slice):
+        """Loads the sample weights of the given sorted indexes, unpacking them if needed"""
+        n_bases = self._n_bases(usable_idx_slice)
+        if self.label_encoding == 'compact':
+            # 8 bases per byte
+            sw = read_rows(self.sw_dset, usable_idx_slice, (n_bases + 7) // 8)
+            sw = unpack_sample_weights(sw, n_bases)
+        else:
+            sw = read_rows(self.sw_dset, usable_idx_slice, n_bases)
+        return sw
+
+    def _get_pooled_batch(self, usable_idx_slice):
+        """Loads X clipped to whole timesteps of pool_size bases, y reshaped to
+        (rows, timesteps, pool_size, classes) and the pooled sample weights of the timesteps,
+        multiplied with the class weights if there are any. The sample weights are looked up
+        from the precomputed /pooled_<pool_size> group if there is one."""
+        X = self._get_x(usable_idx_slice)
+        y = self._get_y(usable_idx_slice)
+        if self.pooled is not None:
+            codes = read_rows(self.pooled['codes'], usable_idx_slice, y.shape[1] // self.pool_size)
+            sw = pooled_sample_weights(codes, y.shape[-1], self.class_weights)
+        else:
+            # class weights are only used during training and validation to keep the loss
+            # comparable, class weights without pooling are not supported yet
+            sw, classes = pool_labels(y, self._get_sw(usable_idx_slice), self.pool_size)
+            if self.class_weights is not None:
+                sw = class_weighted(sw, classes, self.class_weights)
+        n_steps = y.shape[1] // self.pool_size
+        X = X[:, :n_steps * self.pool_size]
+        y = y[:, :n_steps * self.pool_size].reshape((y.shape[0], n_steps, self.pool_size,
+                                                     y.shape[-1]))
+        return X, y, sw
+
+    def __len__(self):
+        # return 1
+        return int(np.ceil(len(self.usable_idx) / float(self.batch_size)))
+
+    def batch_idx(self, idx):
+        """The sorted row indexes of batch idx, h5py can only read sorted indexes"""
+        return sorted(list(self.usable_idx[idx * self.batch_size:(idx + 1) * self.batch_size]))
+
+    def __getitem__(self, idx):
+        return self._get_batch(self.batch_idx(idx))
+
+    @abstractmethod
+    def _get_batch(self, usable_idx_slice):
+        pass
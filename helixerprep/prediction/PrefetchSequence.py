@@ -0,0 +1,87 @@
+"""loading the batches of a HelixerSequence ahead of time in forked worker processes"""
+import time
+import multiprocessing
+
+from keras.callbacks import Callback
+from keras.utils import Sequence
+
+# the sequence the prefetch workers load batches from, inherited when they are forked
+_prefetch_sequence = None
+
+
+def _init_prefetch_worker():
+    _prefetch_sequence.reopen_data_file()
+
+
+def _prefetch_batch(usable_idx_slice):
+    return _prefetch_sequence._get_batch(usable_idx_slice)
+
+
+class PrefetchSequence(Sequence):
+    """Wraps a HelixerSequence and loads the next max_queue batches in the background with a pool
+    of forked worker processes, which each open the data file on their own. The batches are
+    requested in the order they are expected to be needed, so reading, decompressing and
+    reshaping overlaps with the training step of the previous batches. The seconds spent waiting
+    for batches and the amount of already loaded batches at each request (the queue depth) are
+    collected for PrefetchStats."""
+    def __init__(self, sequence, workers, max_queue=10):
+        global _prefetch_sequence
+        assert workers > 0 and max_queue > 0
+        self.sequence = sequence
+        self.max_queue = max_queue
+        self.pending = {}
+        _prefetch_sequence = sequence
+        # forked, so the sequence does not have to be pickled
+        self.pool = multiprocessing.get_context('fork').Pool(workers,
+                                                             initializer=_init_prefetch_worker)
+        _prefetch_sequence = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.n_batches, self.wait_seconds, self.queue_depth_sum = 0, 0.0, 0
+
+    def __len__(self):
+        return len(self.sequence)
+
+    def __getitem__(self, idx):
+        # request the batches up to max_queue ahead, wrapping around into the next epoch
+        for ahead in range(self.max_queue):
+            next_idx = (idx + ahead) % len(self)
+            if next_idx not in self.pending:
+                # the rows are sent along, as the workers do not see the reshuffling
+                usable_idx_slice = self.sequence.batch_idx(next_idx)
+                self.pending[next_idx] = self.pool.apply_async(_prefetch_batch,
+                                                               (usable_idx_slice,))
+        self.queue_depth_sum += sum([result.ready() for result in self.pending.values()])
+        start = time.time()
+        batch = self.pending.pop(idx).get()
+        self.wait_seconds += time.time() - start
+        self.n_batches += 1
+        return batch
+
+    def on_epoch_end(self):
+        self.sequence.on_epoch_end()
+        if self.sequence.reshuffle:
+            # the batches requested ahead for the next epoch have the rows of the old order
+            self.pending = {}
+
+    def close(self):
+        self.pool.terminate()
+
+
+class PrefetchStats(Callback):
+    """Logs how long the training waited for batches of the PrefetchSequence in each epoch
+    and how many were already loaded when requested, a mostly empty queue means the
+    training is limited by the input pipeline"""
+    def __init__(self, prefetch_sequence):
+        self.prefetch_sequence = prefetch_sequence
+
+    def on_epoch_end(self, epoch, logs=None):
+        seq = self.prefetch_sequence
+        mean_depth = seq.queue_depth_sum / max(seq.n_batches, 1)
+        print('\nprefetching: waited {:.1f}s for {} batches, mean queue depth {:.1f} of {}'.format(
+            seq.wait_seconds, seq.n_batches, mean_depth, seq.max_queue))
+        if logs is not None:
+            logs['data_wait_seconds'] = seq.wait_seconds
+            logs['mean_queue_depth'] = mean_depth
+        seq.reset_stats()
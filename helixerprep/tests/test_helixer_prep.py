@@ -1,5 +1,7 @@
 import os
-from shutil import copy
+import json
+from types import SimpleNamespace
+from shutil import copy, rmtree
 from sklearn.metrics import precision_recall_fscore_support as f1_scores
 from sklearn.metrics import accuracy_score
 import numpy as np
@@ -13,11 +15,21 @@ from geenuff.base.orm import SuperLocus, Genome, Coordinate
 from geenuff.base.helpers import reverse_complement
 from ..core.controller import HelixerController
 from ..core.orm import Mer
+from ..core.kmers import canonical_mer_counts
+from ..core.helpers import (decode_base_codes, read_x, read_y, read_sample_weights, read_summary,
+                            write_summary, block_shuffle, read_rows, pool_labels, class_weighted,
+                            encode_pooled, pooled_sample_weights, write_pooled, read_pooled,
+                            sequence_start_rows)
 from ..export import numerify
 from ..export.numerify import (SequenceNumerifier, BasePairAnnotationNumerifier, Stepper,
-                               AMBIGUITY_DECODE)
+                               CoordNumerifier, AMBIGUITY_DECODE)
 from ..export.exporter import HelixerExportController
+from ..core.contiguous import open_data_file, VirtualChunkFile
+from ..core.memmap_cache import MemmapCachedFile
+from ..export.writer import BufferedH5Writer, ContiguousH5Writer, compression_kwargs
 from ..prediction.ConfusionMatrix import ConfusionMatrix
+from ..prediction.HelixerSequence import HelixerSequence
+from ..prediction.PrefetchSequence import PrefetchSequence, PrefetchStats
 
 TMP_DB = 'testdata/tmp.db'
 DUMMYLOCI_DB = 'testdata/dummyloci.sqlite3'
@@ -169,6 +181,28 @@ def test_short_sequence_numerify():
     assert np.array_equal(expect, matrix)
 
 
+def test_sequence_numerify_lookup():
+    # every IUPAC code has to come out exactly as with AMBIGUITY_DECODE
+    sequence = ''.join(AMBIGUITY_DECODE.keys()) * 3
+    coord = Coordinate(sequence=sequence, length=len(sequence), seqid='iupac')
+    numerifier = SequenceNumerifier(coord=coord, is_plus_strand=True, max_len=100)
+    matrix = numerifier.coord_to_matrices()[0][0]
+    expect = np.array([AMBIGUITY_DECODE[bp] for bp in sequence], dtype=np.float16)
+    assert matrix.dtype == np.float16
+    assert matrix.tobytes() == expect.tobytes()
+
+    # minus strand is reversed and has the base columns inverted
+    numerifier = SequenceNumerifier(coord=coord, is_plus_strand=False, max_len=100)
+    matrix = numerifier.coord_to_matrices()[0][0]
+    assert np.array_equal(matrix, np.flip(expect, axis=(0, 1)))
+
+    # unknown characters are not silently encoded
+    coord = Coordinate(sequence='ACGX', length=4, seqid='bad')
+    numerifier = SequenceNumerifier(coord=coord, is_plus_strand=True, max_len=100)
+    with pytest.raises(ValueError):
+        numerifier.coord_to_matrices()
+
+
 def test_base_level_annotation_numerify():
     _, _, coord = setup_dummyloci()
     numerifier = BasePairAnnotationNumerifier(coord=coord,
@@ -185,6 +219,24 @@ def test_base_level_annotation_numerify():
     assert np.array_equal(nums, expect)
 
 
+def test_annotation_range_to_matrices():
+    _, _, coord = setup_dummyloci()
+    for is_plus_strand in [True, False]:
+        for one_hot in [True, False]:
+            numerifier = BasePairAnnotationNumerifier(coord=coord,
+                                                      features=coord.features,
+                                                      is_plus_strand=is_plus_strand,
+                                                      max_len=5000,
+                                                      one_hot=one_hot)
+            numerifier.coord_to_matrices()
+            assert numerifier.matrix.shape == (coord.length, 4 if one_hot else 3)
+            # encoding only a part has to give the same result as slicing the full matrix
+            for start, end in [(0, 1), (5, 405), (110, 120), (400, 1801), (700, 700)]:
+                matrix, error_mask = numerifier.range_to_matrices(start, end)
+                assert np.array_equal(matrix, numerifier.matrix[start:end])
+                assert np.array_equal(error_mask, numerifier.error_mask[start:end])
+
+
 def test_sequence_slicing():
     _, coords = memory_import_fasta('testdata/basic_sequences.fa')
     seq_numerifier = SequenceNumerifier(coord=coords[0], is_plus_strand=True, max_len=50)
@@ -275,6 +327,691 @@ def test_minus_strand_numerify():
     assert np.array_equal(num_list[1], np.flip(expect[0:50], axis=0))
 
 
+def test_dual_strand_coord_numerifier():
+    _, controller, coord = setup_dummyloci()
+    numerifier = CoordNumerifier(controller.geenuff_exporter, coord, coord.features, 100, False)
+    for is_plus_strand in [True, False]:
+        coord_data = numerifier.numerify(is_plus_strand)
+        seq_ref = SequenceNumerifier(coord=coord, is_plus_strand=is_plus_strand, max_len=100)
+        anno_ref = BasePairAnnotationNumerifier(coord=coord,
+                                                features=coord.features,
+                                                is_plus_strand=is_plus_strand,
+                                                max_len=100,
+                                                one_hot=False)
+        seq_ref_slices = seq_ref.coord_to_matrices()[0]
+        anno_ref_slices, mask_ref_slices = anno_ref.coord_to_matrices()
+        assert len(coord_data['inputs']) == len(seq_ref_slices) == 19
+        for i in range(len(seq_ref_slices)):
+            assert np.array_equal(coord_data['inputs'][i], seq_ref_slices[i])
+            assert np.array_equal(coord_data['labels'][i], anno_ref_slices[i])
+            assert np.array_equal(coord_data['label_masks'][i], mask_ref_slices[i])
+    # the minus strand has to be a view on the once encoded plus strand
+    plus_matrix = numerifier.seq_numerifiers[True].matrix
+    assert np.shares_memory(coord_data['inputs'][0], plus_matrix)
+
+
+def test_coord_numerifier_in_batches():
+    _, controller, coord = setup_dummyloci()
+    numerifier = CoordNumerifier(controller.geenuff_exporter, coord, coord.features, 100, True)
+    for is_plus_strand in [True, False]:
+        full = numerifier.numerify(is_plus_strand)
+        batches = list(numerifier.numerify_in_batches(is_plus_strand, max_chunks=4))
+        # 19 chunks in groups of at most 4
+        assert [len(b['inputs']) for b in batches] == [4, 4, 4, 4, 3]
+        # the sequence of a batch is encoded once and the chunks are views of it
+        for b in batches:
+            window = b['inputs'][0].base
+            assert window is not None and all([chunk.base is window for chunk in b['inputs']])
+        for key in ['inputs', 'labels', 'label_masks']:
+            streamed = [chunk for b in batches for chunk in b[key]]
+            assert len(streamed) == len(full[key])
+            for chunk, expect in zip(streamed, full[key]):
+                assert np.array_equal(chunk, expect)
+        assert [se for b in batches for se in b['start_ends']] == full['start_ends']
+
+
+def test_coord_numerifier_drops_erroneous_chunks():
+    _, controller, coord = setup_dummyloci()
+    keeping = CoordNumerifier(controller.geenuff_exporter, coord, coord.features, 100, True)
+    dropping = CoordNumerifier(controller.geenuff_exporter, coord, coord.features, 100, True,
+                               keep_errors=False)
+    for is_plus_strand in [True, False]:
+        full = keeping.numerify(is_plus_strand)
+        valid = [m.any() for m in full['label_masks']]
+        assert not all(valid)
+        # the counts include the dropped chunks and match the encoded chunks
+        assert full['n_masked_bases'] == sum([np.count_nonzero(m == 0) for m in full['label_masks']])
+        assert full['n_intergenic_bases'] == sum([np.count_nonzero(l[:, 0] == 1) for l in full['labels']])
+        for out in [dropping.numerify(is_plus_strand),
+                    list(dropping.numerify_in_batches(is_plus_strand, max_chunks=4))]:
+            if isinstance(out, list):
+                batches = out
+                out = {key: [v for b in batches for v in b[key]]
+                       for key in ['inputs', 'labels', 'label_masks', 'start_ends']}
+                for key in ['n_masked_bases', 'n_intergenic_bases']:
+                    out[key] = sum([b[key] for b in batches])
+            for key in ['inputs', 'labels', 'label_masks', 'start_ends']:
+                expect = [v for v, is_valid in zip(full[key], valid) if is_valid]
+                assert len(out[key]) == len(expect)
+                for chunk, expect_chunk in zip(out[key], expect):
+                    assert np.array_equal(chunk, expect_chunk)
+            assert out['n_masked_bases'] == full['n_masked_bases']
+            assert out['n_intergenic_bases'] == full['n_intergenic_bases']
+
+
+def test_export_in_batches_equals_export():
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=200, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=False)
+    f = h5py.File(H5_OUT_FILE, 'r')
+    expect = {key: np.array(f['/data/' + key]) for key in f['data'].keys()}
+    f.close()
+
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=200, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=False, max_chunks=3)
+    f = h5py.File(H5_OUT_FILE, 'r')
+    for key, value in expect.items():
+        assert np.array_equal(np.array(f['/data/' + key]), value)
+    f.close()
+
+
+def test_parallel_export_equals_serial_export():
+    _, controller, _ = setup_dummyloci(only_test_set=False)
+    controller.export(chunk_size=200, genomes='', exclude='', val_size=0.5, one_hot=True,
+                      split_coordinates=True, keep_errors=False, seed=3)
+    f = h5py.File(H5_OUT_FOLDER + 'training_data.h5', 'r')
+    expect = {key: np.array(f['/data/' + key]) for key in f['data'].keys()}
+    f.close()
+
+    _, controller, _ = setup_dummyloci(only_test_set=False)
+    controller.export(chunk_size=200, genomes='', exclude='', val_size=0.5, one_hot=True,
+                      split_coordinates=True, keep_errors=False, workers=2, seed=3)
+    f = h5py.File(H5_OUT_FOLDER + 'training_data.h5', 'r')
+    for key, value in expect.items():
+        assert np.array_equal(np.array(f['/data/' + key]), value)
+    f.close()
+
+
+def test_parallel_export_in_parts_equals_serial_export():
+    _, controller, coord = setup_dummyloci()
+    parts = controller._coord_parts(coord.length, 100, 4)
+    # 19 chunks per strand
+    assert [(is_plus_strand, last - first) for is_plus_strand, first, last in parts] == \
+        [(True, 4)] * 4 + [(True, 3)] + [(False, 4)] * 4 + [(False, 3)]
+    numerify_args = dict(chunk_size=100, one_hot=True, keep_errors=False, max_chunks=4)
+    whole = list(controller._numerify_coord(controller.geenuff_exporter, coord, coord.features,
+                                            **numerify_args))
+    in_parts = [out for part in parts
+                for out in controller._numerify_coord(controller.geenuff_exporter, coord,
+                                                      coord.features, parts=[part], **numerify_args)]
+    assert max([len(flat_data['inputs']) for flat_data, _, _ in in_parts]) <= 4
+    for i in [1, 2]:
+        assert sum([out[i] for out in in_parts]) == sum([out[i] for out in whole])
+    for key in ['inputs', 'labels', 'label_masks', 'start_ends']:
+        expect = [v for flat_data, _, _ in whole for v in flat_data[key]]
+        got = [v for flat_data, _, _ in in_parts for v in flat_data[key]]
+        assert len(got) == len(expect)
+        for v, expect_v in zip(got, expect):
+            assert np.array_equal(v, expect_v)
+
+    # with split sequences the random assignment of every chunk has to match as well
+    export_args = dict(chunk_size=200, genomes='', exclude='', val_size=0.5, one_hot=True,
+                       split_coordinates=False, keep_errors=False, seed=3)
+    _, controller, _ = setup_dummyloci(only_test_set=False)
+    controller.export(**export_args)
+    expect = {}
+    for name in ['training_data.h5', 'validation_data.h5']:
+        f = h5py.File(H5_OUT_FOLDER + name, 'r')
+        expect[name] = {key: np.array(f['/data/' + key]) for key in f['data'].keys()}
+        f.close()
+
+    _, controller, _ = setup_dummyloci(only_test_set=False)
+    controller.export(**dict(export_args, workers=2, max_chunks=2))
+    for name in ['training_data.h5', 'validation_data.h5']:
+        f = h5py.File(H5_OUT_FOLDER + name, 'r')
+        for key, value in expect[name].items():
+            assert np.array_equal(np.array(f['/data/' + key]), value)
+        f.close()
+
+
+def test_base_codes_round_trip():
+    sequence = ''.join(AMBIGUITY_DECODE.keys()) * 2
+    for is_plus_strand in [True, False]:
+        matrix = numerify.encode_sequence(sequence, is_plus_strand)
+        # add zero padding like in the h5 files
+        matrix = np.concatenate([matrix, np.zeros((5, 4), dtype=np.float16)])
+        codes = numerify.encode_base_codes(matrix)
+        assert codes.dtype == np.uint8
+        assert np.all(codes[-5:] == 0)
+        assert decode_base_codes(codes).tobytes() == matrix.tobytes()
+
+    with pytest.raises(ValueError):
+        numerify.encode_base_codes(np.full((3, 4), 0.1, dtype=np.float16))
+
+
+def test_block_shuffle_and_read_rows():
+    idx = np.arange(0, 100, 2)[::-1]
+    shuffled = block_shuffle(idx, block_size=5, window=2, rng=np.random.RandomState(0))
+    assert sorted(shuffled) == sorted(idx)
+    # each window of 2 blocks contains exactly the rows of 2 blocks of consecutive rows
+    for i in range(0, len(shuffled), 10):
+        blocks = set([np.searchsorted(np.sort(idx), row) // 5 for row in shuffled[i:i + 10]])
+        assert len(blocks) == 2
+    assert list(block_shuffle(idx, block_size=1, window=1)) != list(np.sort(idx))
+
+    dset = np.arange(40).reshape((20, 2))
+    rows = [0, 1, 2, 7, 9, 10, 19]
+    assert np.array_equal(read_rows(dset, rows), dset[rows])
+    assert read_rows(dset, []).shape == (0, 2)
+    assert np.array_equal(read_rows(dset, rows, n_cols=1), dset[rows, :1])
+
+
+class DummySequence(object):
+    """Stands in for a HelixerSequence, its batches are the row indexes together with the id of
+    the process that last (re)opened the data file"""
+    def __init__(self, n_rows, batch_size, reshuffle):
+        self.usable_idx = np.arange(n_rows)
+        self.batch_size = batch_size
+        self.reshuffle = reshuffle
+        self.opened_in = os.getpid()
+        np.random.shuffle(self.usable_idx)
+
+    def reopen_data_file(self):
+        self.opened_in = os.getpid()
+
+    def on_epoch_end(self):
+        if self.reshuffle:
+            np.random.shuffle(self.usable_idx)
+
+    def __len__(self):
+        return int(np.ceil(len(self.usable_idx) / float(self.batch_size)))
+
+    def batch_idx(self, idx):
+        return sorted(list(self.usable_idx[idx * self.batch_size:(idx + 1) * self.batch_size]))
+
+    def __getitem__(self, idx):
+        return self._get_batch(self.batch_idx(idx))
+
+    def _get_batch(self, usable_idx_slice):
+        return np.array(usable_idx_slice), self.opened_in
+
+
+def test_prefetch_sequence():
+    np.random.seed(0)
+    sequence = DummySequence(n_rows=50, batch_size=8, reshuffle=True)
+    prefetching = PrefetchSequence(sequence, workers=2, max_queue=3)
+    stats = PrefetchStats(prefetching)
+    assert len(prefetching) == len(sequence) == 7
+    for epoch in range(2):
+        # the batches come back in order and the same as without prefetching
+        for i in range(len(prefetching)):
+            rows, opened_in = prefetching[i]
+            assert np.array_equal(rows, sequence[i][0])
+            # loaded by a worker, which reopened the data file after it was forked
+            assert opened_in != os.getpid()
+        # the first batches of the next epoch were already requested with the old order
+        assert 0 in prefetching.pending
+        order = sequence.usable_idx.copy()
+        prefetching.on_epoch_end()
+        assert not np.array_equal(order, sequence.usable_idx)
+        assert not prefetching.pending
+
+        logs = {}
+        stats.on_epoch_end(epoch, logs)
+        assert logs['data_wait_seconds'] >= 0
+        assert 0 <= logs['mean_queue_depth'] <= 3
+        assert prefetching.n_batches == 0
+    prefetching.close()
+
+    # without reshuffling the batches loaded ahead for the next epoch are kept
+    sequence = DummySequence(n_rows=20, batch_size=8, reshuffle=False)
+    prefetching = PrefetchSequence(sequence, workers=1, max_queue=2)
+    for i in range(len(prefetching)):
+        assert np.array_equal(prefetching[i][0], sequence[i][0])
+    first_batch = sequence[0][0]
+    prefetching.on_epoch_end()
+    assert list(prefetching.pending.keys()) == [0]
+    assert np.array_equal(prefetching[0][0], first_batch)
+    prefetching.close()
+
+
+class PooledSequence(HelixerSequence):
+    """Reads the batches like the LSTMSequence, together with the h5 ids of the pooled labels
+    and of the file wrapped by the memory mapped cache they were read through"""
+    def _get_batch(self, usable_idx_slice):
+        X, y, sw = self._get_pooled_batch(usable_idx_slice)
+        return X, y, sw, self.pooled.id.id, self.h5_file.h5_file.id.id
+
+
+def test_prefetch_from_memmap_cache_with_pooled_labels():
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=200, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=False, label_encoding='compact')
+    h5_file = h5py.File(H5_OUT_FILE, 'r+')
+    write_pooled(h5_file, 10)
+    h5_file.close()
+    cache_root = 'testdata/memmap_cache'
+    model = SimpleNamespace(batch_size=4, float_precision='float32', class_weights=None,
+                            meta_losses=False, load_model_path='', pool_size=10, chunk_size=200)
+    cached = MemmapCachedFile(h5py.File(H5_OUT_FILE, 'r'), cache_root)
+    sequence = PooledSequence(model, cached, 'val', shuffle=False)
+    assert sequence.pooled is not None
+    assert isinstance(sequence.x_dset, np.memmap)
+    prefetching = PrefetchSequence(sequence, workers=2, max_queue=3)
+    for i in range(len(prefetching)):
+        batch = prefetching[i]
+        expect = sequence[i]
+        for array, expect_array in zip(batch[:3], expect[:3]):
+            assert np.array_equal(array, expect_array)
+        # the workers read the pooled labels through the file they reopened themselves,
+        # and not through the h5 handle inherited from this process
+        assert batch[3] != expect[3]
+        assert batch[4] != expect[4]
+    prefetching.close()
+    cached.close()
+    rmtree(cache_root)
+
+
+def test_length_buckets_are_not_block_shuffled():
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=200, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=False)
+    h5_file = h5py.File(H5_OUT_FILE, 'r')
+    model = SimpleNamespace(batch_size=4, float_precision='float32', class_weights=None,
+                            meta_losses=False, load_model_path='', pool_size=10, chunk_size=200,
+                            length_buckets=True, shuffle_block_size=4)
+    # the length buckets would undo the blocks
+    with pytest.raises(AssertionError):
+        PooledSequence(model, h5_file, 'train', shuffle=True)
+    # without shuffling there are no blocks
+    sequence = PooledSequence(model, h5_file, 'val', shuffle=False)
+    assert np.all(np.diff(sequence.row_lengths[sequence.usable_idx]) >= 0)
+    model.shuffle_block_size = 0
+    sequence = PooledSequence(model, h5_file, 'train', shuffle=True)
+    assert sorted(sequence.usable_idx) == sorted(np.flatnonzero(~h5_file['/data/err_samples'][:]))
+    h5_file.close()
+
+
+def test_export_base_codes():
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=200, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=False)
+    f = h5py.File(H5_OUT_FILE, 'r')
+    expect = {key: np.array(f['/data/' + key]) for key in f['data'].keys()}
+    f.close()
+
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=200, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=False, x_encoding='base_codes')
+    f = h5py.File(H5_OUT_FILE, 'r')
+    assert f.attrs['x_encoding'] == 'base_codes'
+    assert f['/data/X'].dtype == np.uint8
+    assert f['/data/X'].shape == expect['X'].shape[:2]
+    assert np.array_equal(read_x(f), expect['X'])
+    for key, value in expect.items():
+        if key != 'X':
+            assert np.array_equal(np.array(f['/data/' + key]), value)
+    f.close()
+
+
+def test_export_compact_labels():
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=200, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=True)
+    f = h5py.File(H5_OUT_FILE, 'r')
+    expect = {key: np.array(f['/data/' + key]) for key in f['data'].keys()}
+    f.close()
+
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=200, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=True, label_encoding='compact')
+    f = h5py.File(H5_OUT_FILE, 'r')
+    assert f.attrs['label_encoding'] == 'compact'
+    assert f['/data/y'].dtype == np.uint8 and f['/data/y'].shape == expect['y'].shape[:2]
+    assert f['/data/sample_weights'].shape == (len(expect['sample_weights']), 25)
+    assert np.array_equal(read_y(f), expect['y'])
+    assert np.array_equal(read_sample_weights(f), expect['sample_weights'])
+    assert np.array_equal(read_sample_weights(f, 3), expect['sample_weights'][3])
+    for key in ['X', 'err_samples', 'fully_intergenic_samples']:
+        assert np.array_equal(np.array(f['/data/' + key]), expect[key])
+    f.close()
+
+    # class indexes need one-hot labels
+    _, controller, _ = setup_dummyloci()
+    with pytest.raises(ValueError):
+        controller.export(chunk_size=200, genomes='', exclude='', val_size=0.2, one_hot=False,
+                          split_coordinates=False, keep_errors=True, label_encoding='compact')
+
+
+def test_buffered_h5_writer():
+    f = h5py.File(H5_OUT_FOLDER + 'writer_test.h5', 'w')
+    # 10 chunks of 100 + 50 + 16 bytes fill the buffer
+    writer = BufferedH5Writer(f, max_buffer_mb=1660 / 2 ** 20)
+    for i in range(25):
+        writer.add({'X': np.full((1, 100), i, dtype=np.int8),
+                    'seqids': np.array([str(i).encode()], dtype='S50'),
+                    'start_ends': np.array([[0, 100]], dtype=np.int64)})
+        assert len(writer) == (i + 1) % 10
+    assert writer.n_block_writes == 2
+    writer.flush()
+    assert writer.n_block_writes == 3
+    assert np.array_equal(f['/data/X'][:, 0], np.arange(25))
+    assert f['/data/X'].chunks == (1, 100)
+    assert f['/data/seqids'][-1] == b'24'
+    f.close()
+
+
+def test_export_chunk_layout_and_compression():
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=200, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=False)
+    f = h5py.File(H5_OUT_FILE, 'r')
+    expect = {key: np.array(f['/data/' + key]) for key in f['data'].keys()}
+    f.close()
+
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=200, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=False, rows_per_chunk=4,
+                      compression='gzip', compression_level=2)
+    f = h5py.File(H5_OUT_FILE, 'r')
+    assert f['/data/X'].chunks == (4, 200, 4)
+    assert f['/data/sample_weights'].chunks == (4, 200)
+    assert f['/data/y'].compression == 'gzip' and f['/data/y'].compression_opts == 2
+    for key, value in expect.items():
+        assert np.array_equal(np.array(f['/data/' + key]), value)
+    f.close()
+
+    with pytest.raises(ValueError):
+        compression_kwargs('snappy')
+
+
+def test_resume_export_from_manifest():
+    export_args = dict(chunk_size=200, genomes='', exclude='', val_size=0.2, one_hot=True,
+                       split_coordinates=False, keep_errors=False)
+    _, controller, _ = setup_dummyloci()
+    controller.export(**export_args)
+    f = h5py.File(H5_OUT_FILE, 'r')
+    expect = {key: np.array(f['/data/' + key]) for key in f['data'].keys()}
+    row_starts, row_ends = f['/manifest/row_starts'][:], f['/manifest/row_ends'][:]
+    assert row_starts[0] == 0 and row_ends[-1] == len(expect['X'])
+    assert np.array_equal(row_starts[1:], row_ends[:-1])
+    f.close()
+    # simulate an export that was interrupted after the last coordinate was partially written
+    f = h5py.File(H5_OUT_FILE, 'r+')
+    for key in f['manifest'].keys():
+        f['/manifest/' + key].resize(len(row_ends) - 2, axis=0)
+    f.close()
+
+    controller = HelixerExportController(TMP_DB, H5_OUT_FOLDER, only_test_set=True, append=True)
+    with pytest.raises(ValueError):
+        controller.export(**dict(export_args, chunk_size=400))
+    controller = HelixerExportController(TMP_DB, H5_OUT_FOLDER, only_test_set=True, append=True)
+    controller.export(**export_args)
+    f = h5py.File(H5_OUT_FILE, 'r')
+    for key, value in expect.items():
+        assert np.array_equal(np.array(f['/data/' + key]), value)
+    assert np.array_equal(f['/manifest/row_ends'][:], row_ends)
+    f.close()
+
+
+def test_export_from_coord_cache():
+    cache_dir = 'testdata/tmp_coord_cache/'
+    export_args = dict(chunk_size=200, genomes='', exclude='', val_size=0.2, one_hot=True,
+                       split_coordinates=False, keep_errors=False, cache_dir=cache_dir)
+    _, controller, _ = setup_dummyloci()
+    controller.export(**export_args)
+    assert controller.cache.hits == 0 and controller.cache.misses > 0
+    n_coords = controller.cache.misses
+    f = h5py.File(H5_OUT_FILE, 'r')
+    expect = {key: np.array(f['/data/' + key]) for key in f['data'].keys()}
+    f.close()
+
+    _, controller, _ = setup_dummyloci()
+    controller.export(**export_args)
+    assert controller.cache.hits == n_coords and controller.cache.misses == 0
+    f = h5py.File(H5_OUT_FILE, 'r')
+    for key, value in expect.items():
+        assert np.array_equal(np.array(f['/data/' + key]), value)
+    f.close()
+
+    # other parameters must not find the same entries
+    _, controller, _ = setup_dummyloci()
+    controller.export(**dict(export_args, chunk_size=400))
+    assert controller.cache.hits == 0
+    rmtree(cache_dir)
+
+
+def test_parallel_export_from_full_coord_cache():
+    cache_dir = 'testdata/tmp_coord_cache/'
+    export_args = dict(chunk_size=200, genomes='', exclude='', val_size=0.2, one_hot=True,
+                       split_coordinates=False, keep_errors=False, cache_dir=cache_dir)
+    _, controller, _ = setup_dummyloci()
+    controller.export(**export_args)
+    f = h5py.File(H5_OUT_FILE, 'r')
+    expect = {key: np.array(f['/data/' + key]) for key in f['data'].keys()}
+    f.close()
+    # remove the entries of every other coordinate, so hits and misses are interleaved
+    genome_coord_features = controller._feature_records(
+        controller.geenuff_exporter.genome_query('', ''))
+    numerify_args = {'chunk_size': 200, 'one_hot': True, 'keep_errors': False}
+    n_coords = 0
+    for coord_features in genome_coord_features.values():
+        coords = controller._coord_records(coord_features.keys())
+        for coord, features in zip(coords, coord_features.values()):
+            if n_coords % 2 == 0:
+                os.remove(controller.cache._path(controller._cache_key(coord, features,
+                                                                       numerify_args)))
+            n_coords += 1
+    assert n_coords > 1
+
+    # every store of a miss evicts everything that is not pinned, which must not include the
+    # hits still waiting to be written
+    _, controller, _ = setup_dummyloci()
+    controller.export(**dict(export_args, workers=2, cache_size_mb=0.0001))
+    assert controller.cache.hits == n_coords // 2
+    assert controller.cache.misses == n_coords - n_coords // 2
+    assert controller.cache.evictions > 0
+    f = h5py.File(H5_OUT_FILE, 'r')
+    for key, value in expect.items():
+        assert np.array_equal(np.array(f['/data/' + key]), value)
+    f.close()
+    rmtree(cache_dir)
+
+
+def test_export_summary_index():
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=200, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=False)
+    f = h5py.File(H5_OUT_FILE, 'r+')
+    summary = read_summary(f)
+    err_samples = np.array(f['/data/err_samples'])
+    assert summary.attrs['n_rows'] == len(err_samples)
+    assert summary.attrs['n_err_samples'] == np.count_nonzero(err_samples)
+    assert np.array_equal(summary['clean_idx'], np.flatnonzero(~err_samples))
+    assert np.array_equal(summary['genic_idx'],
+                          np.flatnonzero(~np.array(f['/data/fully_intergenic_samples'])))
+    assert np.isclose(summary.attrs['log_length_max'], np.log(np.max(f['/data/coord_lengths'])))
+    # the ranges cover all rows and match the species and seqids of the rows
+    seqids = np.array(f['/data/seqids'])
+    assert summary['seqid_ranges'][0, 0] == 0 and summary['seqid_ranges'][-1, 1] == len(seqids)
+    for seqid, (start, end) in zip(summary['seqids'], summary['seqid_ranges']):
+        assert np.all(seqids[start:end] == seqid)
+    assert list(summary['species']) == [b'dummy']
+
+    # the same when indexed in small blocks
+    expect = {key: np.array(summary[key]) for key in summary.keys()}
+    write_summary(f, block_size=3)
+    for key, value in expect.items():
+        assert np.array_equal(np.array(f['/summary/' + key]), value)
+    # outdated summaries are ignored
+    f['/data/X'].resize(1, axis=0)
+    assert read_summary(f) is None
+    f.close()
+
+
+def test_sequence_start_rows():
+    # two species that both have a chr1, the second one does not start at row 0
+    species = [b'a'] * 3 + [b'b'] * 4
+    seqids = [b'chr1', b'chr1', b'chr2', b'chr1', b'chr2', b'chr2', b'chr3']
+    path = 'testdata/sequence_start_rows.h5'
+    f = h5py.File(path, 'w')
+    f.create_dataset('/data/X', data=np.zeros((7, 2, 4), dtype=np.float16))
+    f.create_dataset('/data/err_samples', data=np.zeros(7, dtype=bool))
+    f.create_dataset('/data/fully_intergenic_samples', data=np.zeros(7, dtype=bool))
+    f.create_dataset('/data/coord_lengths', data=np.full(7, 10, dtype=np.uint64))
+    f.create_dataset('/data/species', data=np.array(species, dtype='S25'))
+    f.create_dataset('/data/seqids', data=np.array(seqids, dtype='S50'))
+    write_summary(f)
+    expect = ({'a': 0, 'b': 3}, {'a': {'chr1': 0, 'chr2': 2}, 'b': {'chr1': 3, 'chr2': 4, 'chr3': 6}})
+    # the summary and the scan of the datasets give the same absolute rows
+    assert sequence_start_rows(f, read_summary(f)) == expect
+    assert sequence_start_rows(f) == expect
+    f.close()
+    os.remove(path)
+
+
+def test_pooled_labels():
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=205, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=True, label_encoding='compact')
+    f = h5py.File(H5_OUT_FILE, 'r+')
+    y, sw = read_y(f), read_sample_weights(f)
+    sw_pooled, classes = pool_labels(y, sw, 10)
+    assert sw_pooled.shape == (len(y), 20) and classes.shape == (len(y), 20, 4)
+    for row in range(len(y)):
+        for step in range(20):
+            bases = slice(step * 10, (step + 1) * 10)
+            assert sw_pooled[row, step] == int(np.all(sw[row, bases] != 0))
+            assert np.array_equal(classes[row, step], np.any(y[row, bases] == 1, axis=0))
+    class_weights = np.array([0.5, 1.0, 2.0, 4.0], dtype=np.float32)
+    weighted = class_weighted(sw_pooled, classes, class_weights)
+    assert np.allclose(weighted, sw_pooled * np.sum(classes * class_weights, axis=2))
+
+    codes = encode_pooled(sw_pooled, classes)
+    assert np.array_equal(pooled_sample_weights(codes, 4), sw_pooled)
+    assert np.allclose(pooled_sample_weights(codes, 4, class_weights), weighted)
+
+    assert read_pooled(f, 10) is None
+    write_pooled(f, 10, block_size=3)
+    assert np.array_equal(read_pooled(f, 10)['codes'], codes)
+    assert read_pooled(f, 5) is None
+    f.close()
+
+
+def test_bulk_coord_records():
+    session, controller, _ = setup_dummyloci()
+    coords = session.query(Coordinate).order_by(Coordinate.id.desc()).all()
+    coord_keys = [(c.id, c.length) for c in coords]
+    # the order of the keys is kept, also across batches
+    for max_batch_coords in [1, 2, 500]:
+        records = list(controller._coord_records(coord_keys, max_batch_coords=max_batch_coords))
+        assert [r.id for r in records] == [c.id for c in coords]
+        for record, coord in zip(records, coords):
+            assert record.sequence == coord.sequence and record.seqid == coord.seqid
+            assert record.genome.species == coord.genome.species == 'dummy'
+
+
+def test_contiguous_export_virtual_chunks():
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=500, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=False, contiguous=True,
+                      x_encoding='base_codes', label_encoding='compact')
+    # outside of the output folder, which is cleared by setup_dummyloci()
+    contiguous_file = 'testdata/contiguous_data.h5'
+    os.rename(H5_OUT_FILE, contiguous_file)
+
+    # the virtual chunks have to be exactly what a chunked export stores, for any chunk size
+    for chunk_size in [200, 1000]:
+        _, controller, _ = setup_dummyloci()
+        controller.export(chunk_size=chunk_size, genomes='', exclude='', val_size=0.2, one_hot=True,
+                          split_coordinates=False, keep_errors=False, x_encoding='base_codes',
+                          label_encoding='compact')
+        f = h5py.File(H5_OUT_FILE, 'r')
+        virtual = open_data_file(contiguous_file, chunk_size)
+        assert isinstance(virtual, VirtualChunkFile)
+        assert virtual['/data/X'].shape == f['/data/X'].shape
+        for key in f['data'].keys():
+            assert np.array_equal(virtual['/data/' + key][:], f['/data/' + key][:])
+        assert np.array_equal(read_y(virtual, [0, 2]), read_y(f, [0, 2]))
+        assert np.array_equal(read_sample_weights(virtual, [1]), read_sample_weights(f, [1]))
+        f.close()
+        virtual.close()
+
+    with pytest.raises(ValueError):
+        open_data_file(contiguous_file)
+    os.remove(contiguous_file)
+
+
+def test_contiguous_coord_without_chunks():
+    _, controller, _ = setup_dummyloci()
+    h5_file = h5py.File(H5_OUT_FOLDER + 'no_chunks.h5', 'w')
+    writer = ContiguousH5Writer(h5_file)
+    # what _numerify_coord() yields for a coordinate without any chunks
+    numerify_outputs = [(controller._empty_flat_data(), 400, 0)]
+    assert controller._write_contiguous_coord(writer, 1, numerify_outputs, True) == (0, 400, 0)
+    writer.flush()
+    assert '/strands/offsets' not in h5_file
+    h5_file.close()
+
+
+def test_memmap_cache():
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=200, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=False, label_encoding='compact')
+    cache_root = 'testdata/memmap_cache'
+    f = h5py.File(H5_OUT_FILE, 'r')
+    cached = MemmapCachedFile(h5py.File(H5_OUT_FILE, 'r'), cache_root)
+    for key in ['X', 'y', 'sample_weights']:
+        assert isinstance(cached['/data/' + key], np.memmap)
+        assert np.array_equal(cached['/data/' + key][:], f['/data/' + key][:])
+    # everything else is read from the h5 file
+    assert np.array_equal(cached['/data/err_samples'], f['/data/err_samples'])
+    assert np.array_equal(read_sample_weights(cached, [1, 2]), read_sample_weights(f, [1, 2]))
+    # the wrapped file can be opened again for forked processes, the memory maps are kept
+    inherited, memmaps = cached.h5_file, dict(cached.datasets)
+    cached.reopen()
+    assert cached.h5_file is not inherited
+    inherited.close()
+    assert np.array_equal(cached['/data/err_samples'], f['/data/err_samples'])
+    assert all([cached.datasets[key] is memmaps[key] for key in memmaps])
+    # the cache is reused until the file changes
+    assert MemmapCachedFile(h5py.File(H5_OUT_FILE, 'r'), cache_root).cache_dir == cached.cache_dir
+    f.close()
+    cached.close()
+    os.utime(H5_OUT_FILE, (0, 0))
+    changed = MemmapCachedFile(h5py.File(H5_OUT_FILE, 'r'), cache_root)
+    assert changed.cache_dir != cached.cache_dir
+    changed.close()
+    rmtree(cache_root)
+
+
+def test_export_row_lengths():
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=500, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=True, contiguous=True)
+    contiguous_file = 'testdata/contiguous_data.h5'
+    os.rename(H5_OUT_FILE, contiguous_file)
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=500, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=True)
+    f = h5py.File(H5_OUT_FILE, 'r')
+    row_lengths = np.array(f['/data/row_lengths'])
+    start_ends = np.array(f['/data/start_ends'])
+    assert np.array_equal(row_lengths, np.abs(start_ends[:, 1] - start_ends[:, 0]))
+    assert np.any(row_lengths < 500)
+    # everything after the true length is zero padding
+    for i, length in enumerate(row_lengths):
+        assert not np.any(f['/data/X'][i, length:])
+    # the virtual chunks have the same lengths and can be read only up to a length
+    virtual = open_data_file(contiguous_file, 500, keep_errors=True)
+    assert np.array_equal(virtual['/data/row_lengths'], row_lengths)
+    assert np.array_equal(virtual['/data/X'][[0, 2], :100], f['/data/X'][[0, 2], :100])
+    virtual.close()
+    f.close()
+    os.remove(contiguous_file)
+
+
 def test_coord_numerifier_and_h5_gen_plus_strand():
     _, controller, _ = setup_dummyloci()
     # dump the whole db in chunks into a .h5 file
@@ -386,6 +1123,69 @@ def test_coord_numerifier_and_h5_gen_minus_strand():
     assert np.array_equal(label_masks[1][:50], label_mask_expect[200:250])
 
 
+def test_gc_contents_preloaded():
+    mer_controller, controller = mk_controllers(DUMMYLOCI_DB)
+    coords = mer_controller.session.query(Coordinate).order_by(Coordinate.id).all()
+    expect = {}
+    for i, coord in enumerate(coords):
+        expect[coord.seqid.encode('ASCII')] = i + 10
+        mer_controller.session.add(Mer(coordinate_id=coord.id, mer_sequence='C', count=i + 10,
+                                       length=1))
+    mer_controller.session.commit()
+    controller.export(chunk_size=500, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=True)
+    # one query for the single genome instead of one per coordinate and strand
+    assert controller.n_mer_queries == 1
+
+    f = h5py.File(H5_OUT_FILE, 'r')
+    for seqid, gc_content in zip(f['/data/seqids'], f['/data/gc_contents']):
+        assert gc_content == expect[seqid]
+    f.close()
+
+
+def test_bulk_mer_counts():
+    mer_controller, _ = mk_controllers(DUMMYLOCI_DB)
+    coords = mer_controller.session.query(Coordinate).order_by(Coordinate.id).all()
+    kmer_dir = 'testdata/tmp_kmers/dummy/meta_collection/kmers/'
+    os.makedirs(kmer_dir, exist_ok=True)
+    with open(kmer_dir + 'kmers.tsv', 'w') as f:
+        f.write('seqid\tkmer\tcount\tlength\n')
+        for coord in coords:
+            # AAC and GTT are reverse complements of each other, so are C and G
+            for mer, count in [('AAC', 1), ('C', 2), ('G', 3), ('GTT', 4), ('TA', 5)]:
+                f.write('{}\t{}\t{}\t{}\n'.format(coord.seqid, mer, count, len(mer)))
+    mer_controller.meta_info_root_path = 'testdata/tmp_kmers'
+    # blocks that end within and at the end of a seqid
+    mer_controller.add_mer_counts_to_db(block_size=3)
+    rmtree('testdata/tmp_kmers')
+    for coord in coords:
+        mers = mer_controller.session.query(Mer).filter(Mer.coordinate_id == coord.id).all()
+        assert sorted([(m.mer_sequence, m.count, m.length) for m in mers]) == [('AAC', 5, 3),
+                                                                                ('C', 5, 1),
+                                                                                ('TA', 5, 2)]
+
+
+def test_count_mers_in_db():
+    # GT is counted as AC and the kmers with N are skipped
+    assert canonical_mer_counts('ACGTNaac', 2) == {'A': 4, 'C': 3, 'AA': 1, 'AC': 3, 'CG': 1}
+    mer_controller, controller = mk_controllers(DUMMYLOCI_DB)
+    mer_controller.count_mers_in_db(max_k=3, workers=2)
+    coords = mer_controller.session.query(Coordinate).all()
+    for coord in coords:
+        sequence = coord.sequence.upper()
+        c_mer = (mer_controller.session.query(Mer)
+                     .filter(Mer.coordinate_id == coord.id)
+                     .filter(Mer.mer_sequence == 'C')
+                     .one())
+        assert c_mer.count == sequence.count('C') + sequence.count('G')
+    # the counts are used as gc content in the export
+    controller.export(chunk_size=500, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=True)
+    f = h5py.File(H5_OUT_FILE, 'r')
+    assert np.all(np.array(f['/data/gc_contents']) > 0)
+    f.close()
+
+
 def test_numerify_with_end_neg1():
     def check_one(coord, is_plus_strand, expect, maskexpect):
         numerifier = BasePairAnnotationNumerifier(coord=coord,
@@ -777,3 +1577,25 @@ def test_confusion_matrix():
     # test accuracy
     acc_true = accuracy_score(y_pred, y_true)
     assert np.allclose(acc_true, cm._total_accuracy())
+
+
+def test_export_stats_report():
+    _, controller, _ = setup_dummyloci()
+    controller.export(chunk_size=200, genomes='', exclude='', val_size=0.2, one_hot=True,
+                      split_coordinates=False, keep_errors=False, stats=True)
+    with open(H5_OUT_FOLDER + 'export_stats.json') as f:
+        report = json.load(f)
+    f = h5py.File(H5_OUT_FILE, 'r')
+    n_chunks = f['/data/X'].shape[0]
+    coord_lengths = np.unique(f['/data/coord_lengths'])
+    f.close()
+    run, genome = report['run'], report['genomes']['dummy']
+    # everything was exported from the one genome
+    for key in ['coords', 'bases', 'chunks', 'bytes_written']:
+        assert run[key] == genome[key]
+    assert run['chunks'] == n_chunks
+    # both strands of each coordinate
+    assert run['coords'] == len(coord_lengths) and run['bases'] == 2 * np.sum(coord_lengths)
+    assert run['file_bytes'] == {'test_data.h5': os.path.getsize(H5_OUT_FILE)}
+    assert all([run['seconds'][stage] > 0 for stage in ['db_fetch', 'annotation_numerify', 'h5_write']])
+    assert run['peak_rss_mb'] > 0
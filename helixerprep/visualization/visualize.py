@@ -10,7 +10,8 @@ import argparse
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
 
-from helixerprep.export.numerify import AMBIGUITY_DECODE
+from helixerprep.core.helpers import (AMBIGUITY_DECODE, read_x, read_y, read_sample_weights,
+                                     label_encoding, read_summary, sequence_start_rows)
 
 class Visualization():
     def __init__(self, root, args):
@@ -24,7 +25,10 @@ class Visualization():
         self.h5_predictions = h5py.File(args.predictions, 'r')
 
         # detect labels
-        self.label_dim = self.h5_data['/data/y'].shape[-1]
+        if label_encoding(self.h5_data) == 'compact':
+            self.label_dim = 4
+        else:
+            self.label_dim = self.h5_data['/data/y'].shape[-1]
         self.one_hot = self.label_dim > 3
 
         # set a few constants
@@ -51,8 +55,12 @@ class Visualization():
         if self.args.exclude_errors:
             self.err_idx = np.squeeze(np.argwhere(np.array(self.h5_data['/data/err_samples']) == True))
 
-        fully_intergenic_bool = self.h5_data['/data/fully_intergenic_samples']
-        self.genic_indexes = np.squeeze(np.argwhere(np.array(fully_intergenic_bool) == False))
+        self.summary = read_summary(self.h5_data)
+        if self.summary is not None:
+            self.genic_indexes = np.array(self.summary['genic_idx'])
+        else:
+            fully_intergenic_bool = self.h5_data['/data/fully_intergenic_samples']
+            self.genic_indexes = np.squeeze(np.argwhere(np.array(fully_intergenic_bool) == False))
         self.load_sequence_infos()
 
         if self.args.exclude_errors:
@@ -146,24 +154,9 @@ class Visualization():
 
     def load_sequence_infos(self):
         """parses the /data/species and /data/seqid datasets into a usable dict format"""
-        def start_idx_dict(arr):
-            data_raw, start_idx = np.unique(arr, return_index=True)
-            data = [d.decode('utf-8') for d in data_raw]
-            d = {d:i for d, i in zip(data, start_idx)}
-            return d
-
-        species_arr = np.array(self.h5_data['/data/species'])
-        seqids_arr = np.array(self.h5_data['/data/seqids'])
-
-        # construct species start dict
-        self.species_start_idx = start_idx_dict(species_arr)
-        self.all_species_names = list(self.species_start_idx.keys())
-
-        # construct seqid dict
-        self.seqids_start_idx = {}
-        for species in self.all_species_names:
-            species_idx = np.where(species_arr == species.encode())[0]
-            self.seqids_start_idx[species] = start_idx_dict(seqids_arr[species_idx])
+        self.species_start_idx, self.seqids_start_idx = sequence_start_rows(self.h5_data,
+                                                                            self.summary)
+        self.all_species_names = sorted(self.species_start_idx.keys())
 
     def load_sequence(self, offset, seq_len, include_dummy=True):
         """loads data for the heatmap and possibly inputs dummy data that serves as margin"""
@@ -176,9 +169,9 @@ class Visualization():
             return new_dset
 
         off_lim = offset + seq_len
-        labels = np.array(self.h5_data['/data/y'][self.seq_index][offset:off_lim])
+        labels = read_y(self.h5_data, self.seq_index)[offset:off_lim]
         predictions = np.array(self.h5_predictions['/predictions'][self.seq_index][offset:off_lim])
-        label_masks = np.array(self.h5_data['/data/sample_weights'][self.seq_index][offset:off_lim])
+        label_masks = read_sample_weights(self.h5_data, self.seq_index)[offset:off_lim]
 
         if off_lim > self.chunk_len - self.cutoff:
             # append 0-padding and set sample weights at the very end to make everything evenly long
@@ -208,7 +201,7 @@ class Visualization():
 
         if include_dummy and self.toggle_dna_state.get():
             # add genic sequence to string annotations
-            genic_seq = np.array(self.h5_data['/data/X'][self.seq_index][offset:off_lim])
+            genic_seq = read_x(self.h5_data, (self.seq_index, slice(offset, off_lim)))
             decode_dict = {tuple(a):c for c, a in AMBIGUITY_DECODE.items()}
             genic_seq = np.array([decode_dict[tuple(i)] for i in genic_seq])
             genic_seq = genic_seq.reshape((self.args.n_rows, self.BASE_COUNT_X))
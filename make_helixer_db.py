@@ -10,7 +10,11 @@ def main(args):
     controller = HelixerController(args.db_path_in, args.db_path_out, args.meta_info_root_path,
                                    args.meta_info_csv_path)
     # lookup kmers and add what we find
-    controller.add_mer_counts_to_db()
+    if os.path.exists(args.meta_info_root_path):
+        controller.add_mer_counts_to_db()
+    if args.count_kmers:
+        # for all genomes without a kmers.tsv
+        controller.count_mers_in_db(max_k=args.max_k, workers=args.workers)
     controller.add_meta_info_to_db()
 
 
@@ -31,7 +35,14 @@ if __name__ == '__main__':
     fasta_specific.add_argument('--meta-info-csv-path', type=str,
                                 help='Path to the csv file containing all the meta data',
                                 default='metadata.csv')
+    fasta_specific.add_argument('--count-kmers', action='store_true',
+                                help=('Count the kmers of the genomes without a kmers.tsv file '
+                                      'directly from the sequences in the database.'))
+    fasta_specific.add_argument('--max-k', type=int, default=6,
+                                help='Kmers of length 1 to max-k are counted with --count-kmers.')
+    fasta_specific.add_argument('--workers', type=int, default=1,
+                                help='Number of processes counting kmers in parallel.')
     args = parser.parse_args()
-    assert os.path.exists(args.meta_info_root_path)
+    assert os.path.exists(args.meta_info_root_path) or args.count_kmers
     assert os.path.exists(args.meta_info_csv_path)
     main(args)
@@ -4,7 +4,7 @@ import numpy as np
 import argparse
 from helixerprep.prediction.ConfusionMatrix import ConfusionMatrix as ConfusionMatrix
 import sys
-from helixerprep.core.helpers import mk_keys, mk_seqonly_keys
+from helixerprep.core.helpers import mk_keys, mk_seqonly_keys, read_y, read_sample_weights
 import os
 import csv
 
@@ -18,7 +18,7 @@ class Exporter(object):
     def add_data(self, h5_in, labs, preds, lab_mask, lab_lexsort, sample_weights, start, end):
         if not self.saved1:
             self.saved1 = True
-            self.mk_datasets(h5_in, labs)
+            self.mk_datasets(h5_in, labs, sample_weights)
 
         length = labs.shape[0]
         for key in h5_in['data'].keys():
@@ -47,10 +47,17 @@ class Exporter(object):
         dset.resize(old_len + length, axis=0)
         dset[old_len:] = data
 
-    def mk_datasets(self, h5_in, labs):
+    def mk_datasets(self, h5_in, labs, sample_weights):
+        # labels and sample weights are always written expanded, everything else as in the input
+        self.h5_file.attrs.update(h5_in.attrs)
+        self.h5_file.attrs['label_encoding'] = 'int8'
         # setup datasets
         for key in h5_in['data'].keys():
             dset = h5_in['data/' + key]
+            if key == 'y':
+                dset = labs
+            elif key == 'sample_weights':
+                dset = sample_weights
             shape = list(dset.shape)
             shape[0] = 0
             self.h5_file.create_dataset('data/' + key,
@@ -87,11 +94,11 @@ def main(args):
         # get comparable subset of data
         if not args.unsorted or all_coords_match(h5_data, h5_pred, (d_start, d_end), (p_start, p_end)):
             length = d_end - d_start
-            h5_data_y = np.array(h5_data['/data/y'][d_start:d_end])
+            h5_data_y = read_y(h5_data, slice(d_start, d_end))
             h5_pred_y = np.array(h5_pred[args.h5_prediction_dataset][p_start:p_end])
             lab_mask = [True] * length
             lab_lexsort = np.arange(length)
-            h5_sample_weights = np.array(h5_data['/data/sample_weights'][d_start:d_end])
+            h5_sample_weights = read_sample_weights(h5_data, slice(d_start, d_end))
         else:
             h5_data_y, h5_pred_y, lab_mask, lab_lexsort, h5_sample_weights = match_up(h5_data, h5_pred,
                                                                                       lab_keys, pred_keys,
@@ -171,9 +178,9 @@ def match_up(h5_data, h5_pred, lab_keys, pred_keys, h5_prediction_dataset, data_
     pred_mask = [x in shared for x in pred_keys]
 
     # setup output arrays (with shared indexes)
-    labs = np.array(h5_data['data/y'][data_start_end[0]:data_start_end[1]])[lab_mask]
+    labs = read_y(h5_data, slice(data_start_end[0], data_start_end[1]))[lab_mask]
     preds = np.array(h5_pred[h5_prediction_dataset][pred_start_end[0]:pred_start_end[1]])[pred_mask]
-    sample_weights = np.array(h5_data['data/sample_weights'][data_start_end[0]:data_start_end[1]][lab_mask])
+    sample_weights = read_sample_weights(h5_data, slice(data_start_end[0], data_start_end[1]))[lab_mask]
     # check if sorting matches
     shared_lab_keys = np.array(lab_keys)[lab_mask]
     shared_pred_keys = np.array(pred_keys)[pred_mask]
@@ -0,0 +1,31 @@
+#! /usr/bin/env python3
+"""writes the /pooled_<pool_size> groups with the encoded sample weight and class membership of
+each timestep into exported h5 files, which the LSTM and DanQ sequences with that pool size
+then read instead of pooling every batch, see helixerprep.core.helpers.write_pooled()"""
+import h5py
+import argparse
+
+from helixerprep.core.helpers import write_pooled, read_pooled, data_layout
+
+parser = argparse.ArgumentParser()
+parser.add_argument('h5_files', type=str, nargs='+', help='exported h5 files to add to')
+parser.add_argument('-ps', '--pool-sizes', type=str, default='10',
+                    help='comma separated pool sizes of the models that are going to be trained')
+parser.add_argument('--force', action='store_true', help='rewrite also up to date groups')
+parser.add_argument('--block-size', type=int, default=2 ** 12, help='rows pooled at once')
+args = parser.parse_args()
+
+for path in args.h5_files:
+    h5_file = h5py.File(path, 'r+')
+    if data_layout(h5_file) != 'chunked':
+        print('skipping {}, only chunked exports can be pooled in advance'.format(path))
+        h5_file.close()
+        continue
+    for pool_size in [int(p) for p in args.pool_sizes.split(',')]:
+        if read_pooled(h5_file, pool_size) is not None and not args.force:
+            print('{} already has up to date labels pooled by {}'.format(path, pool_size))
+        else:
+            write_pooled(h5_file, pool_size, block_size=args.block_size)
+            print('{}: pooled the labels of {} rows by {}'.format(
+                path, h5_file['data/y'].shape[0], pool_size))
+    h5_file.close()
@@ -0,0 +1,27 @@
+#! /usr/bin/env python3
+"""writes the /summary group into h5 files that were exported before the exporter did so
+(or were changed afterwards), see helixerprep.core.helpers.write_summary()"""
+import h5py
+import argparse
+
+from helixerprep.core.helpers import write_summary, read_summary
+
+parser = argparse.ArgumentParser()
+parser.add_argument('h5_files', type=str, nargs='+', help='exported h5 files to index')
+parser.add_argument('--force', action='store_true', help='rewrite also up to date summaries')
+parser.add_argument('--block-size', type=int, default=2 ** 20,
+                    help='rows of the per chunk datasets read at once')
+args = parser.parse_args()
+
+for path in args.h5_files:
+    h5_file = h5py.File(path, 'r+')
+    if read_summary(h5_file) is not None and not args.force:
+        print('{} already has an up to date summary'.format(path))
+    else:
+        write_summary(h5_file, block_size=args.block_size)
+        summary = h5_file['summary']
+        print('{}: {} rows, {} erroneous, {} fully intergenic, {} species, {} seqids'.format(
+            path, summary.attrs['n_rows'], summary.attrs['n_err_samples'],
+            summary.attrs['n_fully_intergenic_samples'], len(summary['species']),
+            len(summary['seqids'])))
+    h5_file.close()
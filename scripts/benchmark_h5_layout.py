@@ -0,0 +1,91 @@
+#! /usr/bin/env python3
+"""rewrites the data of an exported h5 file with different chunk layouts and compression codecs
+and reports file size, write time and random batch read throughput for each of them"""
+import os
+import time
+import h5py
+import argparse
+import tempfile
+import numpy as np
+
+from helixerprep.export.writer import BufferedH5Writer, COMPRESSIONS, hdf5plugin
+
+
+def rewrite(h5_in, path, rows_per_chunk, compression, level, block_size):
+    h5_out = h5py.File(path, 'w')
+    h5_out.attrs.update(h5_in.attrs)
+    writer = BufferedH5Writer(h5_out, rows_per_chunk=rows_per_chunk, compression=compression,
+                              compression_level=level)
+    n_rows = h5_in['data/X'].shape[0]
+    start = time.perf_counter()
+    for i in range(0, n_rows, block_size):
+        writer.add({key: h5_in['data/' + key][i:i + block_size] for key in h5_in['data'].keys()})
+    writer.flush()
+    h5_out.close()
+    return time.perf_counter() - start
+
+
+def read_random_batches(path, batch_size, n_batches, seed):
+    """reads X, y and sample_weights of random batches the same way HelixerSequence does"""
+    rng = np.random.RandomState(seed)
+    h5 = h5py.File(path, 'r')
+    dsets = [h5['data/' + key] for key in ['X', 'y', 'sample_weights']]
+    n_rows = dsets[0].shape[0]
+    n_bytes = 0
+    start = time.perf_counter()
+    for _ in range(n_batches):
+        idx = sorted(rng.choice(n_rows, size=min(batch_size, n_rows), replace=False))
+        for dset in dsets:
+            n_bytes += dset[idx].nbytes
+    duration = time.perf_counter() - start
+    h5.close()
+    return n_batches / duration, n_bytes / duration / 2 ** 20
+
+
+def main(args):
+    h5_in = h5py.File(args.data, 'r')
+    layouts = [('input', None, None)]
+    for compression in args.compressions.split(','):
+        if compression in ['blosc', 'zstd'] and hdf5plugin is None:
+            print('skipping {} as hdf5plugin is not installed'.format(compression))
+            continue
+        for rows_per_chunk in [int(r) for r in args.rows_per_chunk.split(',')]:
+            layouts.append((compression, rows_per_chunk, args.compression_level))
+
+    print('{:>8} {:>6} {:>10} {:>9} {:>10} {:>10}'.format('codec', 'rows', 'size (MB)', 'write (s)',
+                                                          'batches/s', 'read MB/s'))
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        for compression, rows_per_chunk, level in layouts:
+            if compression == 'input':
+                path, write_time = args.data, float('nan')
+                rows_per_chunk = h5_in['data/X'].chunks[0]
+            else:
+                path = os.path.join(tmp_dir, '{}_{}.h5'.format(compression, rows_per_chunk))
+                write_time = rewrite(h5_in, path, rows_per_chunk, compression, level,
+                                     args.block_size)
+            batches_per_s, mb_per_s = read_random_batches(path, args.batch_size, args.n_batches,
+                                                          args.seed)
+            print('{:>8} {:>6} {:>10.1f} {:>9.2f} {:>10.1f} {:>10.1f}'.format(
+                compression, rows_per_chunk, os.path.getsize(path) / 2 ** 20, write_time,
+                batches_per_s, mb_per_s))
+            if path != args.data:
+                os.remove(path)
+    h5_in.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--data', type=str, required=True, help='an exported h5 file')
+    parser.add_argument('--compressions', type=str, default='lzf,gzip,blosc,zstd',
+                        help='comma separated list of codecs out of {}'.format(COMPRESSIONS))
+    parser.add_argument('--compression-level', type=int, default=None)
+    parser.add_argument('--rows-per-chunk', type=str, default='1,4,16',
+                        help='comma separated list of the rows per chunk to try')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--n-batches', type=int, default=50, help='random batches read per layout')
+    parser.add_argument('--block-size', type=int, default=1000,
+                        help='rows read from the input at once while rewriting')
+    parser.add_argument('--tmp-dir', type=str, default=None,
+                        help='where the rewritten files are stored, should be on the storage to test')
+    parser.add_argument('--seed', type=int, default=42)
+    main(parser.parse_args())
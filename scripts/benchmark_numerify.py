@@ -0,0 +1,73 @@
+#! /usr/bin/env python3
+"""times the vectorized SequenceNumerifier against the previous per-base python loop"""
+import time
+import argparse
+import numpy as np
+from collections import namedtuple
+
+from helixerprep.export.numerify import SequenceNumerifier, AMBIGUITY_DECODE
+
+# the numerifiers only need the sequence and its length from a coordinate
+FakeCoord = namedtuple('FakeCoord', ['sequence', 'length'])
+
+
+def per_base_loop(sequence, is_plus_strand):
+    """the encoding as it was done before the lookup table, kept as reference"""
+    matrix = np.zeros((len(sequence), 4), dtype=np.float16)
+    for i, bp in enumerate(sequence):
+        matrix[i] = AMBIGUITY_DECODE[bp]
+    if not is_plus_strand:
+        matrix = np.flip(matrix, axis=1)
+    return matrix
+
+
+def random_sequence(length, ambiguity_rate, seed):
+    rng = np.random.RandomState(seed)
+    bases = np.array(list('CATG'))
+    ambiguous = np.array([bp for bp in AMBIGUITY_DECODE.keys() if bp not in 'CATG'])
+    seq = bases[rng.randint(0, 4, size=length)]
+    is_ambiguous = rng.random_sample(length) < ambiguity_rate
+    seq[is_ambiguous] = ambiguous[rng.randint(0, len(ambiguous), size=np.sum(is_ambiguous))]
+    return ''.join(seq)
+
+
+def time_it(fn, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), out
+
+
+def main(args):
+    sequence = random_sequence(args.length, args.ambiguity_rate, args.seed)
+    coord = FakeCoord(sequence=sequence, length=len(sequence))
+    for is_plus_strand in [True, False]:
+        def vectorized():
+            numerifier = SequenceNumerifier(coord=coord, is_plus_strand=is_plus_strand,
+                                            max_len=args.chunk_size)
+            return numerifier._unflipped_coord_to_matrix()
+
+        t_new, new = time_it(vectorized, args.repeats)
+        if args.skip_reference:
+            print('strand {}: lookup {:.4f}s ({:.1f} Mbp/s)'.format(
+                '+' if is_plus_strand else '-', t_new, args.length / t_new / 1e6))
+            continue
+        t_old, old = time_it(lambda: per_base_loop(sequence, is_plus_strand), args.repeats)
+        assert new.dtype == old.dtype and new.tobytes() == old.tobytes(), 'encodings differ'
+        print('strand {}: loop {:.4f}s, lookup {:.4f}s ({:.1f} Mbp/s), speedup {:.1f}x'.format(
+            '+' if is_plus_strand else '-', t_old, t_new, args.length / t_new / 1e6, t_old / t_new))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--length', type=int, default=1000000, help='length of the random sequence')
+    parser.add_argument('--ambiguity-rate', type=float, default=0.01,
+                        help='fraction of bases drawn from the ambiguity codes')
+    parser.add_argument('--chunk-size', type=int, default=20000)
+    parser.add_argument('--repeats', type=int, default=3, help='best of n repeats is reported')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--skip-reference', action='store_true',
+                        help='do not time (and compare against) the slow per-base loop')
+    main(parser.parse_args())
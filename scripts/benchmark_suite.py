@@ -0,0 +1,236 @@
+#! /usr/bin/env python3
+"""times the hot paths of the data preparation on synthetic genomes of several sizes and saves the
+results as json, so they can be compared between commits with --compare"""
+import os
+import sys
+import json
+import time
+import h5py
+import argparse
+import datetime
+import tempfile
+import subprocess
+import numpy as np
+from types import SimpleNamespace
+
+from make_synthetic_db import make_synthetic_db
+from helixerprep.export.exporter import HelixerExportController
+from helixerprep.export.numerify import SequenceNumerifier, BasePairAnnotationNumerifier
+from helixerprep.evaluation.coverage_counter import CoverageCounter
+
+# the models are run as scripts from the prediction folder and import each other that way
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'helixerprep',
+                             'prediction'))
+try:
+    from ConfusionMatrix import ConfusionMatrix
+except ImportError:
+    ConfusionMatrix = None
+try:
+    from LSTMModel import LSTMSequence
+except ImportError:
+    LSTMSequence = None
+
+
+def time_it(fn, repeats):
+    """best of repeats seconds and the output of the last call"""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), out
+
+
+def result(seconds, n_bases):
+    return {'seconds': seconds, 'bases': int(n_bases),
+            'bases_per_second': n_bases / seconds if seconds else 0.0}
+
+
+def bench_numerifiers(controller, args):
+    """SequenceNumerifier and BasePairAnnotationNumerifier over both strands of all coordinates"""
+    genome_coord_features = controller._feature_records(
+        controller.geenuff_exporter.genome_query([], []))
+    coord_features = {}
+    for coords in genome_coord_features.values():
+        coord_features.update(coords)
+    coords = list(controller._coord_records(coord_features.keys()))
+    n_bases = 2 * sum([coord.length for coord in coords])
+
+    def numerify_sequences():
+        for coord in coords:
+            for is_plus_strand in [True, False]:
+                SequenceNumerifier(coord, is_plus_strand, args.chunk_size).coord_to_matrices()
+
+    def numerify_annotations():
+        for coord in coords:
+            features = coord_features[(coord.id, coord.length)]
+            for is_plus_strand in [True, False]:
+                BasePairAnnotationNumerifier(coord, features, is_plus_strand, args.chunk_size,
+                                             one_hot=True).coord_to_matrices()
+
+    return {
+        'SequenceNumerifier': result(time_it(numerify_sequences, args.repeats)[0], n_bases),
+        'BasePairAnnotationNumerifier': result(time_it(numerify_annotations, args.repeats)[0],
+                                               n_bases),
+    }
+
+
+def bench_export(db_path, out_dir, args):
+    """The whole export with its stage timers, the h5_write stage replaces the former _save_data"""
+    controller = HelixerExportController(db_path, out_dir, only_test_set=True)
+    start = time.perf_counter()
+    controller.export(chunk_size=args.chunk_size, genomes='', exclude='', val_size=0.2,
+                      one_hot=True, split_coordinates=False, keep_errors=False, stats=True)
+    seconds = time.perf_counter() - start
+    with open(os.path.join(out_dir, 'export_stats.json')) as f:
+        stats = json.load(f)['run']
+    return {
+        'export': result(seconds, stats['bases']),
+        'h5_write': result(stats['seconds']['h5_write'], stats['bases']),
+    }
+
+
+def bench_sequence(h5_path, args):
+    """LSTMSequence.__getitem__ over all batches of the exported file"""
+    if LSTMSequence is None:
+        print('skipping HelixerSequence.__getitem__ as keras is not installed')
+        return {}
+    model = SimpleNamespace(batch_size=args.batch_size, float_precision='float32',
+                            class_weights=None, meta_losses=False, load_model_path='',
+                            pool_size=args.pool_size, shuffle_block_size=args.shuffle_block_size,
+                            shuffle_window=1)
+    h5_file = h5py.File(h5_path, 'r')
+    sequence = LSTMSequence(model, h5_file, 'val', shuffle=True)
+
+    def all_batches():
+        for i in range(len(sequence)):
+            sequence[i]
+
+    seconds = time_it(all_batches, args.repeats)[0]
+    n_bases = len(sequence.usable_idx) * h5_file['/data/X'].shape[1]
+    h5_file.close()
+    return {'HelixerSequence.__getitem__': result(seconds, n_bases)}
+
+
+def bench_evaluation(n_bases, args):
+    """ConfusionMatrix._add_to_cm and CoverageCounter.increment on random labels of n_bases"""
+    rng = np.random.RandomState(args.seed)
+    n_rows = max(n_bases // args.chunk_size, 1)
+
+    def one_hot(size):
+        return np.eye(4, dtype=np.int8)[rng.randint(0, 4, size=size)]
+
+    results = {}
+    if ConfusionMatrix is None:
+        print('skipping ConfusionMatrix._add_to_cm as terminaltables is not installed')
+    else:
+        y_true = one_hot((n_rows, args.chunk_size))
+        y_pred = rng.random_sample((n_rows, args.chunk_size, 4)).astype(np.float32)
+        sw = (rng.random_sample((n_rows, args.chunk_size)) > 0.05).astype(np.int8)
+        cm = ConfusionMatrix(None)
+        seconds = time_it(lambda: cm._add_to_cm(y_true, y_pred, sw), args.repeats)[0]
+        results['ConfusionMatrix._add_to_cm'] = result(seconds, n_rows * args.chunk_size)
+
+    counter = CoverageCounter()
+    length = n_rows * args.chunk_size
+    counter.latest = {
+        'X': one_hot(length).astype(np.float16),
+        'y': one_hot(length),
+        'predictions': rng.random_sample((length, 4)).astype(np.float32),
+        'coverage': rng.poisson(5, size=length),
+        'spliced_coverage': rng.poisson(1, size=length),
+    }
+    seconds = time_it(counter.increment, args.repeats)[0]
+    results['CoverageCounter.increment'] = result(seconds, length)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return ''
+
+
+def compare(old, new):
+    print('\n{:>10} {:<30} {:>12} {:>12} {:>8}'.format('scale', 'benchmark', 'old bp/s', 'new bp/s',
+                                                      'ratio'))
+    for scale, benchmarks in new['results'].items():
+        for name, res in benchmarks.items():
+            old_res = old['results'].get(scale, {}).get(name)
+            if old_res is None or not old_res['bases_per_second']:
+                continue
+            print('{:>10} {:<30} {:>12.0f} {:>12.0f} {:>7.2f}x'.format(
+                scale, name, old_res['bases_per_second'], res['bases_per_second'],
+                res['bases_per_second'] / old_res['bases_per_second']))
+
+
+def main(args):
+    report = {
+        'commit': git_commit(),
+        'timestamp': str(datetime.datetime.now()),
+        'params': vars(args),
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        if args.db:
+            dbs = [(os.path.basename(db), db) for db in args.db.split(',')]
+        else:
+            dbs = []
+            for genome_size in [int(float(s)) for s in args.genome_sizes.split(',')]:
+                db_path = os.path.join(tmp_dir, 'synthetic_{}.sqlite3'.format(genome_size))
+                n_genes, n_error_genes = make_synthetic_db(
+                    db_path, genome_size=genome_size, n_scaffolds=args.scaffolds,
+                    genes_per_mbp=args.genes_per_mbp, error_rate=args.error_rate, seed=args.seed)
+                print('generated {} bp with {} genes ({} erroneous)'.format(genome_size, n_genes,
+                                                                            n_error_genes))
+                dbs.append((str(genome_size), db_path))
+
+        for scale, db_path in dbs:
+            out_dir = os.path.join(tmp_dir, 'out_' + scale)
+            os.mkdir(out_dir)
+            results = bench_export(db_path, out_dir, args)
+            # the controller opens the output file for writing, so it gets a folder of its own
+            numerify_dir = os.path.join(tmp_dir, 'numerify_' + scale)
+            os.mkdir(numerify_dir)
+            controller = HelixerExportController(db_path, numerify_dir, only_test_set=True)
+            results.update(bench_numerifiers(controller, args))
+            controller.h5_test.close()
+            results.update(bench_sequence(os.path.join(out_dir, 'test_data.h5'), args))
+            results.update(bench_evaluation(results['export']['bases'], args))
+            report['results'][scale] = results
+            for name, res in results.items():
+                print('{:>10} {:<30} {:>8.3f}s {:>12.0f} bp/s'.format(scale, name, res['seconds'],
+                                                                     res['bases_per_second']))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('saved to {}'.format(args.output))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--genome-sizes', type=str, default='1e6,1e7',
+                        help='comma separated sizes of the generated genomes in bases')
+    parser.add_argument('--db', type=str, default='',
+                        help='comma separated existing Helixer databases to use instead of generating')
+    parser.add_argument('--scaffolds', type=int, default=20)
+    parser.add_argument('--genes-per-mbp', type=float, default=50)
+    parser.add_argument('--error-rate', type=float, default=0.1)
+    parser.add_argument('--chunk-size', type=int, default=20000)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--shuffle-block-size', type=int, default=0,
+                        help='read the batches in shuffled blocks of consecutive rows')
+    parser.add_argument('--repeats', type=int, default=3, help='best of n repeats is reported')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--tmp-dir', type=str, default=None,
+                        help='where the databases and h5 files are generated')
+    parser.add_argument('-o', '--output', type=str, default='benchmark_results.json')
+    parser.add_argument('--compare', type=str, default='',
+                        help='results of an earlier run, e.g. of another commit, to compare with')
+    main(parser.parse_args())
@@ -0,0 +1,147 @@
+#! /usr/bin/env python3
+"""generates a random genome with gene models of a configurable size, scaffold count, gene density
+and rate of erroneous genes and imports it into a Helixer database, e.g. for benchmarks"""
+import os
+import argparse
+import numpy as np
+
+from geenuff.applications.importer import ImportController
+from helixerprep.core.controller import HelixerController
+
+
+def _gene_models(rng, scaffold_length, genes_per_mbp, error_rate, max_exons):
+    """Yields non overlapping (start, end, is_plus_strand, exons, cds_start, cds_end, is_error)
+    in 1 based, inclusive coordinates. The genes with is_error have their CDS aligned with the
+    start of the transcript, which leaves no room for a 5' UTR and is masked as error by GeenuFF."""
+    n_genes = rng.poisson(genes_per_mbp * scaffold_length / 10 ** 6)
+    if n_genes == 0:
+        return
+    # evenly spaced slots, so the genes never overlap
+    slot_length = scaffold_length // n_genes
+    for slot_start in range(0, slot_length * n_genes, slot_length):
+        n_exons = rng.randint(1, max_exons + 1)
+        exon_lengths = rng.randint(150, 600, size=n_exons)
+        intron_lengths = rng.randint(80, 400, size=n_exons - 1)
+        gene_length = np.sum(exon_lengths) + np.sum(intron_lengths)
+        if gene_length >= slot_length:
+            continue
+        start = slot_start + rng.randint(0, slot_length - gene_length) + 1
+        exons, pos = [], start
+        for i, exon_length in enumerate(exon_lengths):
+            exons.append((pos, pos + exon_length - 1))
+            pos += exon_length + (intron_lengths[i] if i < n_exons - 1 else 0)
+        end = exons[-1][1]
+        is_error = rng.random_sample() < error_rate
+        if is_error:
+            utr5, utr3 = 0, 0
+        else:
+            utr5, utr3 = rng.randint(20, 100, size=2)
+        # trim the 3' UTR side, so the CDS is a multiple of 3 long
+        utr3 += (np.sum(exon_lengths) - utr5 - utr3) % 3
+        is_plus_strand = bool(rng.randint(2))
+        if is_plus_strand:
+            cds_start, cds_end = _genomic_pos(exons, utr5), _genomic_pos(exons, -utr3 - 1)
+        else:
+            cds_start, cds_end = _genomic_pos(exons, utr3), _genomic_pos(exons, -utr5 - 1)
+        yield start, end, is_plus_strand, exons, cds_start, cds_end, is_error
+
+
+def _genomic_pos(exons, offset):
+    """The position of the offset-th exonic base, counted from the end if offset is negative"""
+    positions = np.concatenate([np.arange(s, e + 1) for s, e in exons])
+    return int(positions[offset])
+
+
+def _gff_lines(seqid, gene_id, start, end, is_plus_strand, exons, cds_start, cds_end):
+    strand = '+' if is_plus_strand else '-'
+    transcript_id = gene_id + '.t1'
+    line = '\t'.join([seqid, 'synthetic', '{}', '{}', '{}', '.', strand, '{}', '{}'])
+    lines = [line.format('gene', start, end, '.', 'ID=' + gene_id),
+             line.format('mRNA', start, end, '.', 'ID={};Parent={}'.format(transcript_id, gene_id))]
+    cds_parts = []
+    for i, (exon_start, exon_end) in enumerate(exons):
+        lines.append(line.format('exon', exon_start, exon_end, '.',
+                                 'ID={}.exon{};Parent={}'.format(transcript_id, i, transcript_id)))
+        if exon_end >= cds_start and exon_start <= cds_end:
+            cds_parts.append((max(exon_start, cds_start), min(exon_end, cds_end)))
+    # the phase counts from the start codon, so in reverse on the minus strand
+    phases, cds_length = {}, 0
+    for part in (cds_parts if is_plus_strand else reversed(cds_parts)):
+        phases[part] = (3 - cds_length % 3) % 3
+        cds_length += part[1] - part[0] + 1
+    for i, part in enumerate(cds_parts):
+        lines.append(line.format('CDS', part[0], part[1], phases[part],
+                                 'ID={}.cds{};Parent={}'.format(transcript_id, i, transcript_id)))
+    return lines
+
+
+def write_synthetic_genome(fasta_path, gff_path, genome_size, n_scaffolds, genes_per_mbp=50,
+                           error_rate=0.1, n_rate=0.001, max_exons=6, seed=42):
+    """Writes a random genome of genome_size bases, split into n_scaffolds scaffolds of random
+    length, and its gene models. Returns the amount of genes and erroneous genes."""
+    rng = np.random.RandomState(seed)
+    # at least 10% of an even split per scaffold
+    shares = rng.random_sample(n_scaffolds) + 0.1
+    lengths = np.maximum((shares / np.sum(shares) * genome_size).astype(np.int64), 1)
+    bases = np.array(list('ACGT'))
+    n_genes, n_error_genes = 0, 0
+    with open(fasta_path, 'w') as fasta, open(gff_path, 'w') as gff:
+        gff.write('##gff-version 3\n')
+        for i, length in enumerate(lengths):
+            seqid = 'scaffold_{}'.format(i)
+            sequence = bases[rng.randint(0, 4, size=length)]
+            sequence[rng.random_sample(length) < n_rate] = 'N'
+            fasta.write('>{}\n'.format(seqid))
+            for line_start in range(0, length, 80):
+                fasta.write(''.join(sequence[line_start:line_start + 80]) + '\n')
+            models = _gene_models(rng, length, genes_per_mbp, error_rate, max_exons)
+            for j, (start, end, is_plus_strand, exons, cds_start, cds_end, is_error) in enumerate(models):
+                gene_id = '{}.g{}'.format(seqid, j)
+                lines = _gff_lines(seqid, gene_id, start, end, is_plus_strand, exons, cds_start,
+                                   cds_end)
+                gff.write('\n'.join(lines) + '\n')
+                n_genes += 1
+                n_error_genes += is_error
+    return n_genes, n_error_genes
+
+
+def make_synthetic_db(db_path, species='synthetic', **genome_args):
+    """Generates a synthetic genome with write_synthetic_genome() next to db_path and imports
+    it into a new Helixer database at db_path"""
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    prefix = os.path.splitext(db_path)[0]
+    fasta_path, gff_path = prefix + '.fa', prefix + '.gff3'
+    n_genes, n_error_genes = write_synthetic_genome(fasta_path, gff_path, **genome_args)
+    controller = ImportController(database_path='sqlite:///' + db_path)
+    controller.add_genome(fasta_path, gff_path, genome_args={'species': species})
+    # adds the Helixer specific tables, there are no kmer counts to add
+    HelixerController(db_path, '', '', '')
+    return n_genes, n_error_genes
+
+
+def main(args):
+    n_genes, n_error_genes = make_synthetic_db(args.db_path_out, species=args.species,
+                                               genome_size=args.genome_size,
+                                               n_scaffolds=args.scaffolds,
+                                               genes_per_mbp=args.genes_per_mbp,
+                                               error_rate=args.error_rate, n_rate=args.n_rate,
+                                               max_exons=args.max_exons, seed=args.seed)
+    print('{} genes ({} erroneous) on {} scaffolds written to {}'.format(
+        n_genes, n_error_genes, args.scaffolds, args.db_path_out))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db-path-out', type=str, required=True,
+                        help='the fasta and gff3 files are written next to it')
+    parser.add_argument('--species', type=str, default='synthetic')
+    parser.add_argument('--genome-size', type=int, default=10 ** 7, help='total bases')
+    parser.add_argument('--scaffolds', type=int, default=20)
+    parser.add_argument('--genes-per-mbp', type=float, default=50)
+    parser.add_argument('--error-rate', type=float, default=0.1,
+                        help='fraction of genes without UTRs, which are masked as errors')
+    parser.add_argument('--n-rate', type=float, default=0.001, help='fraction of N bases')
+    parser.add_argument('--max-exons', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=42)
+    main(parser.parse_args())